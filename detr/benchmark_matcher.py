@@ -0,0 +1,118 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+A benchmark of the matcher on random predictions and targets, for several batch sizes.
+
+It compares the time spent computing the per-image cost matrices with the former cross-batch
+computation, which built the [batch_size * num_queries, total_num_targets] matrix and then only
+kept its per-image blocks, and reports the time of the full matching.
+It then compares the auction matcher to the exact Hungarian matching, in time and in quality: the
+relative increase of the total matching cost, and the fraction of targets matched to the same query.
+"""
+import argparse
+import time
+
+import torch
+
+from models.matcher import AuctionMatcher, HungarianMatcher
+from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("DETR matcher benchmark", add_help=False)
+    parser.add_argument("--batch_sizes", default=[1, 2, 4, 8, 16], type=int, nargs="+")
+    parser.add_argument("--num_queries", default=100, type=int)
+    parser.add_argument("--num_classes", default=91, type=int)
+    parser.add_argument("--max_targets", default=30, type=int,
+                        help="The number of targets of each image is drawn uniformly in [1, max_targets]")
+    parser.add_argument("--matcher_threads", default=4, type=int)
+    parser.add_argument("--auction_epsilon", default=1e-3, type=float)
+    parser.add_argument("--iterations", default=20, type=int)
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--seed", default=42, type=int)
+    return parser
+
+
+def random_inputs(batch_size, args, device):
+    outputs = {
+        "pred_logits": torch.randn(batch_size, args.num_queries, args.num_classes + 1, device=device),
+        "pred_boxes": torch.rand(batch_size, args.num_queries, 4, device=device) * 0.5 + 0.25,
+    }
+    targets = []
+    for n in torch.randint(1, args.max_targets + 1, (batch_size,)).tolist():
+        targets.append({"labels": torch.randint(args.num_classes, (n,), device=device),
+                        "boxes": torch.rand(n, 4, device=device) * 0.5 + 0.25})
+    return outputs, targets
+
+
+@torch.no_grad()
+def cross_batch_cost_matrix(matcher, outputs, targets):
+    """The cost between all the predictions and all the targets of the batch"""
+    out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)
+    out_bbox = outputs["pred_boxes"].flatten(0, 1)
+    tgt_ids = torch.cat([v["labels"] for v in targets])
+    tgt_bbox = torch.cat([v["boxes"] for v in targets])
+    cost_class = -out_prob[:, tgt_ids]
+    cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
+    cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
+    return matcher.cost_bbox * cost_bbox + matcher.cost_class * cost_class + matcher.cost_giou * cost_giou
+
+
+def matching_cost(C, indices):
+    return sum(C[i, query_ids, target_ids].sum().item() for i, (query_ids, target_ids) in enumerate(indices))
+
+
+def same_pairs(indices, reference):
+    same, total = 0, 0
+    for (query_ids, target_ids), (ref_query_ids, ref_target_ids) in zip(indices, reference):
+        pairs = set(zip(query_ids.tolist(), target_ids.tolist()))
+        same += len(pairs & set(zip(ref_query_ids.tolist(), ref_target_ids.tolist())))
+        total += len(ref_query_ids)
+    return same / max(total, 1)
+
+
+def timeit(fn, iterations, device):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(iterations):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / iterations
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    matcher = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2, num_threads=args.matcher_threads)
+
+    print("{:>6} {:>17} {:>17} {:>8} {:>15}".format(
+        "batch", "cross-batch (ms)", "per-image (ms)", "speedup", "matching (ms)"))
+    for batch_size in args.batch_sizes:
+        outputs, targets = random_inputs(batch_size, args, device)
+        cross_batch = timeit(lambda: cross_batch_cost_matrix(matcher, outputs, targets), args.iterations, device)
+        per_image = timeit(lambda: matcher.cost_matrix(outputs, targets), args.iterations, device)
+        matching = timeit(lambda: matcher(outputs, targets), args.iterations, device)
+        print("{:>6} {:>17.3f} {:>17.3f} {:>7.2f}x {:>15.3f}".format(
+            batch_size, 1000 * cross_batch, 1000 * per_image, cross_batch / per_image, 1000 * matching))
+
+    auction_matcher = AuctionMatcher(cost_class=1, cost_bbox=5, cost_giou=2, epsilon=args.auction_epsilon)
+    print("{:>6} {:>15} {:>14} {:>13} {:>11}".format(
+        "batch", "hungarian (ms)", "auction (ms)", "cost gap (%)", "same pairs"))
+    for batch_size in args.batch_sizes:
+        outputs, targets = random_inputs(batch_size, args, device)
+        hungarian = timeit(lambda: matcher(outputs, targets), args.iterations, device)
+        auction = timeit(lambda: auction_matcher(outputs, targets), args.iterations, device)
+        C = matcher.cost_matrix(outputs, targets).cpu()
+        exact_indices = matcher(outputs, targets)
+        auction_indices = auction_matcher(outputs, targets)
+        exact_cost, auction_cost = matching_cost(C, exact_indices), matching_cost(C, auction_indices)
+        print("{:>6} {:>15.3f} {:>14.3f} {:>13.4f} {:>10.1%}".format(
+            batch_size, 1000 * hungarian, 1000 * auction, 100 * (auction_cost - exact_cost) / abs(exact_cost),
+            same_pairs(auction_indices, exact_indices)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("DETR matcher benchmark", parents=[get_args_parser()])
+    main(parser.parse_args())
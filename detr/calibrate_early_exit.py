@@ -0,0 +1,72 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+A script to pick the number of decoder layers run at inference (--exit_dec_layers).
+
+The model is evaluated on the val set with each possible number of decoder layers (and optionally
+with some --exit_threshold values), and the cheapest setting whose box AP is within --max_ap_drop
+of the full decoder is reported.
+"""
+import argparse
+
+import torch
+from torch.utils.data import DataLoader
+
+import util.misc as utils
+from datasets import build_dataset, get_coco_api_from_dataset
+from datasets.coco_eval import CocoGroundTruth
+from engine import evaluate, measure_latency
+from main import get_args_parser
+from models import build_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("DETR early exit calibration", parents=[get_args_parser()])
+    parser.add_argument("--max_ap_drop", default=0.5, type=float,
+                        help="Maximal box AP drop, in AP points, with respect to running all the decoder layers")
+    parser.add_argument("--thresholds", default=[], type=float, nargs="*",
+                        help="--exit_threshold values to evaluate as well")
+    parser.add_argument("--latency_batches", default=20, type=int,
+                        help="Number of val batches used to measure the model latency")
+    return parser.parse_args()
+
+
+def main(args):
+    assert args.resume, "The checkpoint to calibrate must be given with --resume"
+    device = torch.device(args.device)
+
+    model, criterion, postprocessors = build_model(args)
+    checkpoint = torch.load(args.resume, map_location='cpu')
+    model.load_state_dict(checkpoint['model'])
+    model.to(device)
+
+    dataset_val = build_dataset(image_set='val', args=args)
+    sampler_val = torch.utils.data.SequentialSampler(dataset_val)
+    data_loader_val = DataLoader(dataset_val, args.batch_size, sampler=sampler_val,
+                                 drop_last=False, collate_fn=utils.collate_fn, num_workers=args.num_workers)
+    # indexed once, and shared by all the evaluations
+    base_ds = CocoGroundTruth(get_coco_api_from_dataset(dataset_val))
+
+    settings = [(num_layers, 0.0) for num_layers in range(1, args.dec_layers + 1)]
+    settings += [(0, threshold) for threshold in args.thresholds]
+    results = []
+    for exit_dec_layers, exit_threshold in settings:
+        model.exit_dec_layers, model.exit_threshold = exit_dec_layers, exit_threshold
+        test_stats, _ = evaluate(model, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir)
+        ap = 100 * test_stats['coco_eval_bbox'][0]
+        latency = measure_latency(model, data_loader_val, device, args.latency_batches)
+        results.append((exit_dec_layers, exit_threshold, ap, latency))
+
+    full_ap = results[args.dec_layers - 1][2]
+    print("{:>15} {:>15} {:>8} {:>15}".format("exit_dec_layers", "exit_threshold", "AP", "latency (ms)"))
+    for exit_dec_layers, exit_threshold, ap, latency in results:
+        print("{:>15} {:>15g} {:>8.2f} {:>15.1f}".format(exit_dec_layers, exit_threshold, ap, 1000 * latency))
+
+    acceptable = [r for r in results if r[2] >= full_ap - args.max_ap_drop]
+    exit_dec_layers, exit_threshold, ap, latency = min(acceptable, key=lambda r: r[3])
+    print("Fastest setting within {} AP of the full decoder: --exit_dec_layers {} --exit_threshold {:g} "
+          "({:.2f} AP, {:.1f} ms per image)".format(args.max_ap_drop, exit_dec_layers, exit_threshold,
+                                                    ap, 1000 * latency))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -5,10 +5,15 @@ COCO evaluator that works in distributed mode.
 Mostly copy-paste from https://github.com/pytorch/vision/blob/edfd5a7/references/detection/coco_eval.py
 The difference is that there is less copy-pasting from pycocotools
 in the end of the file, as python3 can suppress prints with contextlib
+
+Boxes and masks are not evaluated with pycocotools: each image is matched as soon as its
+predictions come in, and only the compact per-detection results are kept, in columnar arrays,
+to compute the same precision and recall as COCOeval.accumulate at the end.
 """
 import os
 import contextlib
 import copy
+import datetime
 import numpy as np
 import torch
 
@@ -21,45 +26,78 @@ from util.misc import all_gather
 
 class CocoEvaluator(object):
     def __init__(self, coco_gt, iou_types):
+        """coco_gt is a COCO api object, or a CocoGroundTruth to share it between evaluators"""
         assert isinstance(iou_types, (list, tuple))
-        coco_gt = copy.deepcopy(coco_gt)
-        self.coco_gt = coco_gt
+        if not isinstance(coco_gt, CocoGroundTruth):
+            coco_gt = CocoGroundTruth(coco_gt)
+        self.ground_truth = coco_gt
+        self.coco_gt = coco_gt.coco
 
         self.iou_types = iou_types
         self.coco_eval = {}
         for iou_type in iou_types:
-            self.coco_eval[iou_type] = COCOeval(coco_gt, iouType=iou_type)
+            # pycocotools modifies the annotations it evaluates, only keypoints still go through it
+            cocoGt = copy.deepcopy(self.coco_gt) if iou_type == "keypoints" else self.coco_gt
+            self.coco_eval[iou_type] = COCOeval(cocoGt, iouType=iou_type)
 
         self.img_ids = []
-        self.eval_imgs = {k: [] for k in iou_types}
+        # keypoints are evaluated with pycocotools, boxes and masks as the images come in
+        self.eval_imgs = {k: [] for k in iou_types if k == "keypoints"}
+        self.results = {}
 
     def update(self, predictions):
         img_ids = list(np.unique(list(predictions.keys())))
         self.img_ids.extend(img_ids)
 
         for iou_type in self.iou_types:
-            results = self.prepare(predictions, iou_type)
-
-            # suppress pycocotools prints
-            with open(os.devnull, 'w') as devnull:
-                with contextlib.redirect_stdout(devnull):
-                    coco_dt = COCO.loadRes(self.coco_gt, results) if results else COCO()
-            coco_eval = self.coco_eval[iou_type]
-
-            coco_eval.cocoDt = coco_dt
-            coco_eval.params.imgIds = list(img_ids)
-            img_ids, eval_imgs = evaluate(coco_eval)
-
-            self.eval_imgs[iou_type].append(eval_imgs)
+            if iou_type == "keypoints":
+                self.update_keypoints(predictions, img_ids)
+                continue
+            params = self.coco_eval[iou_type].params
+            if iou_type not in self.results:
+                self.results[iou_type] = make_columnar_results(params)
+            dt_results, gt_results = self.results[iou_type]
+            for img_id in img_ids:
+                gt = self.ground_truth.image(img_id, iou_type)
+                dt = image_detections(predictions[img_id], self.ground_truth.cat_ids, iou_type)
+                dt, gt = evaluate_image(params, gt, dt)
+                dt_results.append(image_id=np.full(len(dt["score"]), img_id), **dt)
+                gt_results.append(image_id=np.full(len(gt["category"]), img_id), **gt)
+
+    def update_keypoints(self, predictions, img_ids):
+        results = self.prepare(predictions, "keypoints")
+        coco_eval = self.coco_eval["keypoints"]
+
+        # suppress pycocotools prints
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                coco_dt = COCO.loadRes(coco_eval.cocoGt, results) if results else COCO()
+
+        coco_eval.cocoDt = coco_dt
+        coco_eval.params.imgIds = list(img_ids)
+        img_ids, eval_imgs = evaluate(coco_eval)
+
+        self.eval_imgs["keypoints"].append(eval_imgs)
 
     def synchronize_between_processes(self):
         for iou_type in self.iou_types:
-            self.eval_imgs[iou_type] = np.concatenate(self.eval_imgs[iou_type], 2)
-            create_common_coco_eval(self.coco_eval[iou_type], self.img_ids, self.eval_imgs[iou_type])
+            if iou_type == "keypoints":
+                self.eval_imgs[iou_type] = np.concatenate(self.eval_imgs[iou_type], 2)
+                create_common_coco_eval(self.coco_eval[iou_type], self.img_ids, self.eval_imgs[iou_type])
+                continue
+            if iou_type not in self.results:
+                self.results[iou_type] = make_columnar_results(self.coco_eval[iou_type].params)
+            dt_results, gt_results = self.results[iou_type]
+            img_ids, dt, gt = merge_results(self.img_ids, dt_results.arrays(), gt_results.arrays())
+            self.results[iou_type] = (dt, gt)
+            self.coco_eval[iou_type].params.imgIds = img_ids
 
     def accumulate(self):
-        for coco_eval in self.coco_eval.values():
-            coco_eval.accumulate()
+        for iou_type, coco_eval in self.coco_eval.items():
+            if iou_type == "keypoints":
+                coco_eval.accumulate()
+            else:
+                accumulate(coco_eval, *self.results[iou_type])
 
     def summarize(self):
         for iou_type, coco_eval in self.coco_eval.items():
@@ -106,21 +144,10 @@ class CocoEvaluator(object):
             if len(prediction) == 0:
                 continue
 
-            scores = prediction["scores"]
-            labels = prediction["labels"]
-            masks = prediction["masks"]
-
-            masks = masks > 0.5
-
             scores = prediction["scores"].tolist()
             labels = prediction["labels"].tolist()
 
-            rles = [
-                mask_util.encode(np.array(mask[0, :, :, np.newaxis], dtype=np.uint8, order="F"))[0]
-                for mask in masks
-            ]
-            for rle in rles:
-                rle["counts"] = rle["counts"].decode("utf-8")
+            rles = encode_masks(prediction)
 
             coco_results.extend(
                 [
@@ -167,6 +194,312 @@ def convert_to_xywh(boxes):
     return torch.stack((xmin, ymin, xmax - xmin, ymax - ymin), dim=1)
 
 
+def encode_masks(prediction):
+    if "rles" in prediction:
+        # already encoded by PostProcessSegm
+        return prediction["rles"]
+    masks = prediction["masks"] > 0.5
+    rles = [
+        mask_util.encode(np.array(mask[0, :, :, np.newaxis], dtype=np.uint8, order="F"))[0]
+        for mask in masks
+    ]
+    for rle in rles:
+        rle["counts"] = rle["counts"].decode("utf-8")
+    return rles
+
+
+class ColumnarResults(object):
+    """
+    Rows of results stored column by column, in preallocated arrays whose capacity is doubled when full.
+    columns maps the name of each column to its dtype and the shape of one row.
+    """
+
+    def __init__(self, columns, capacity=1024):
+        self.size = 0
+        self.data = {name: np.empty((capacity,) + shape, dtype=dtype) for name, (dtype, shape) in columns.items()}
+
+    def __len__(self):
+        return self.size
+
+    def append(self, **values):
+        num_rows = len(next(iter(values.values())))
+        capacity = len(next(iter(self.data.values())))
+        if self.size + num_rows > capacity:
+            capacity = max(2 * capacity, self.size + num_rows)
+            for name, column in self.data.items():
+                grown = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self.data[name] = grown
+        for name, value in values.items():
+            self.data[name][self.size:self.size + num_rows] = value
+        self.size += num_rows
+
+    def arrays(self):
+        return {name: column[:self.size] for name, column in self.data.items()}
+
+
+def make_columnar_results(params):
+    """The storage of the detection and annotation results of evaluate_image"""
+    A, T = len(params.areaRng), len(params.iouThrs)
+    dt_results = ColumnarResults({
+        "image_id": (np.int64, ()),
+        "category": (np.int64, ()),
+        "score": (np.float64, ()),
+        "rank": (np.int64, ()),
+        "matched": (bool, (A, T)),
+        "ignore": (bool, (A, T)),
+    })
+    gt_results = ColumnarResults({
+        "image_id": (np.int64, ()),
+        "category": (np.int64, ()),
+        "ignore": (bool, (A,)),
+    })
+    return dt_results, gt_results
+
+
+class CocoGroundTruth(object):
+    """
+    Read-only index of the annotations of a COCO api object, built once and shared by the evaluators
+    of all the epochs, instead of deep-copying the COCO object for each of them.
+    The annotations of each image are sorted by category, keeping their order within a category, and
+    stored as arrays: the index of their category in cat_ids, their area, crowd flag and xywh boxes.
+    The RLEs of their masks are only computed the first time they are needed.
+    """
+
+    def __init__(self, coco):
+        self.coco = coco
+        self.cat_ids = {cat_id: k for k, cat_id in enumerate(sorted(coco.getCatIds()))}
+        self.images = {}
+        for img_id in coco.getImgIds():
+            anns = [ann for ann in coco.imgToAnns.get(img_id, []) if ann["category_id"] in self.cat_ids]
+            anns.sort(key=lambda ann: self.cat_ids[ann["category_id"]])
+            gt = {
+                "id": np.array([ann["id"] for ann in anns], dtype=np.int64),
+                "category": np.array([self.cat_ids[ann["category_id"]] for ann in anns], dtype=np.int64),
+                "area": np.array([ann["area"] for ann in anns], dtype=np.float64),
+                "iscrowd": np.array([bool(ann.get("iscrowd", 0)) for ann in anns], dtype=bool),
+                "bbox": np.array([ann["bbox"] for ann in anns], dtype=np.float64).reshape(-1, 4),
+            }
+            for array in gt.values():
+                array.flags.writeable = False
+            self.images[img_id] = gt
+        self.rles = {}
+
+    def image(self, img_id, iou_type):
+        """The annotations of one image, with their geometry for iou_type (boxes or RLEs)"""
+        gt = self.images[img_id]
+        if iou_type == "segm":
+            if img_id not in self.rles:
+                self.rles[img_id] = [self.coco.annToRLE(ann) for ann in self.coco.loadAnns(gt["id"].tolist())]
+            geometry = self.rles[img_id]
+        else:
+            geometry = gt["bbox"]
+        return dict(gt, geometry=geometry)
+
+
+def image_detections(prediction, cat_ids, iou_type):
+    """The predictions of one image in the format of CocoGroundTruth.image, with their scores"""
+    if iou_type not in ("bbox", "segm"):
+        raise ValueError("Unknown iou type {}".format(iou_type))
+    if len(prediction) == 0 or len(prediction["scores"]) == 0:
+        return {"category": np.zeros(0, dtype=np.int64), "score": np.zeros(0), "area": np.zeros(0),
+                "geometry": [] if iou_type == "segm" else np.zeros((0, 4))}
+
+    category = np.array([cat_ids.get(label, -1) for label in prediction["labels"].tolist()], dtype=np.int64)
+    # as COCO.loadRes, the areas are those of the boxes, or of the masks
+    if iou_type == "segm":
+        geometry = encode_masks(prediction)
+        area = mask_util.area(geometry).astype(np.float64)
+    else:
+        geometry = convert_to_xywh(prediction["boxes"]).cpu().double().numpy()
+        area = geometry[:, 2] * geometry[:, 3]
+    # detections of categories that are not evaluated are dropped
+    keep = np.nonzero(category >= 0)[0]
+    return {
+        "category": category[keep],
+        "score": prediction["scores"].cpu().double().numpy()[keep],
+        "area": area[keep],
+        "geometry": [geometry[i] for i in keep] if iou_type == "segm" else geometry[keep],
+    }
+
+
+def evaluate_image(params, gt, dt):
+    """
+    Matches the detections dt of one image to its annotations gt as COCOeval.evaluateImg does, for all the
+    categories, area ranges and IoU thresholds at once.
+    The IoUs between all the detections and all the annotations are computed in a single call, and those
+    across categories are masked.
+    Returns the results of the detections kept (at most params.maxDets[-1] per category): their category,
+    score, rank within their category, whether they are matched and ignored [num_dt x num_area_ranges x num_thrs],
+    and the results of the annotations: their category and whether they are ignored [num_gt x num_area_ranges].
+    """
+    # by category, and by decreasing score within each category
+    order = np.lexsort((-dt["score"], dt["category"]))
+    category = dt["category"][order]
+    rank = np.arange(len(order)) - np.searchsorted(category, category)
+    keep = rank < params.maxDets[-1]
+    order, category, rank = order[keep], category[keep], rank[keep]
+
+    if len(order) > 0 and len(gt["category"]) > 0:
+        if params.iouType == "segm":
+            dt_geometry = [dt["geometry"][i] for i in order]
+        else:
+            dt_geometry = dt["geometry"][order]
+        ious = mask_util.iou(dt_geometry, gt["geometry"], gt["iscrowd"].astype(np.uint8))
+        ious[category[:, None] != gt["category"][None, :]] = -1
+    else:
+        ious = np.zeros((len(order), len(gt["category"])))
+
+    area_rngs = np.asarray(params.areaRng, dtype=np.float64)
+    dt_area = dt["area"][order]
+    # [num_area_ranges x num_gt] and [num_area_ranges x num_dt]
+    gt_ignore = gt["iscrowd"][None, :] | (gt["area"][None, :] < area_rngs[:, :1]) | \
+        (gt["area"][None, :] > area_rngs[:, 1:])
+    dt_out_of_range = (dt_area[None, :] < area_rngs[:, :1]) | (dt_area[None, :] > area_rngs[:, 1:])
+
+    iou_thrs = np.minimum(params.iouThrs, 1 - 1e-10)
+    dt_matched, dt_ignore = _greedy_match(ious, gt_ignore, gt["iscrowd"], iou_thrs)
+    dt_ignore |= ~dt_matched & dt_out_of_range[:, None, :]
+
+    dt_results = {
+        "category": category,
+        "score": dt["score"][order],
+        "rank": rank,
+        "matched": dt_matched.transpose(2, 0, 1),
+        "ignore": dt_ignore.transpose(2, 0, 1),
+    }
+    gt_results = {"category": gt["category"], "ignore": gt_ignore.T}
+    return dt_results, gt_results
+
+
+def _greedy_match(ious, gt_ignore, gt_crowd, iou_thrs):
+    """
+    The greedy matching of COCOeval.evaluateImg, for all the area ranges and IoU thresholds at once.
+    Parameters:
+        ious: [num_dt x num_gt], the detections being sorted by decreasing score
+        gt_ignore: [num_area_ranges x num_gt], gt_crowd: [num_gt]
+    Returns whether each detection is matched [num_area_ranges x num_thrs x num_dt], and whether it is
+    matched to an ignored annotation (same shape).
+    """
+    num_areas, num_gt = gt_ignore.shape
+    shape = (num_areas, len(iou_thrs))
+    dt_matched = np.zeros(shape + (len(ious),), dtype=bool)
+    dt_ignore = np.zeros(shape + (len(ious),), dtype=bool)
+    gt_matched = np.zeros(shape + (num_gt,), dtype=bool)
+
+    # only the annotations over the lowest IoU threshold can be matched to a detection
+    for d in np.nonzero((ious >= iou_thrs.min()).any(1))[0]:
+        g = np.nonzero(ious[d] >= iou_thrs.min())[0]
+        iou = ious[d, g]
+        # crowd annotations can be matched several times
+        candidates = (~gt_matched[..., g] | gt_crowd[g]) & (iou >= iou_thrs[:, None])
+        # annotations that are not ignored are preferred, whatever their IoU
+        not_ignored = candidates & ~gt_ignore[:, None, g]
+        candidates = np.where(not_ignored.any(-1, keepdims=True), not_ignored, candidates)
+        # the best annotation, the last one on ties as in COCOeval
+        best = len(g) - 1 - np.argmax(np.where(candidates, iou, -1)[..., ::-1], axis=-1)
+        a, t = np.nonzero(candidates.any(-1))
+        m = g[best[a, t]]
+        dt_matched[a, t, d] = True
+        gt_matched[a, t, m] = True
+        dt_ignore[a, t, d] = gt_ignore[a, m]
+    return dt_matched, dt_ignore
+
+
+def merge_results(img_ids, dt, gt):
+    """
+    Gathers the results of all processes. An image evaluated by several processes (as the distributed
+    sampler pads the dataset) only keeps the results of the first one.
+    """
+    all_img_ids = all_gather(img_ids)
+    all_dt = all_gather(dt)
+    all_gt = all_gather(gt)
+
+    seen = set()
+    merged_dt, merged_gt = [], []
+    for img_ids, dt, gt in zip(all_img_ids, all_dt, all_gt):
+        new_img_ids = np.array(sorted(set(img_ids) - seen), dtype=np.int64)
+        seen.update(img_ids)
+        merged_dt.append({name: column[np.isin(dt["image_id"], new_img_ids)] for name, column in dt.items()})
+        merged_gt.append({name: column[np.isin(gt["image_id"], new_img_ids)] for name, column in gt.items()})
+    dt = {name: np.concatenate([d[name] for d in merged_dt]) for name in merged_dt[0]}
+    gt = {name: np.concatenate([g[name] for g in merged_gt]) for name in merged_gt[0]}
+    return sorted(seen), dt, gt
+
+
+def accumulate(coco_eval, dt, gt):
+    """
+    Computes the precision and recall from the merged results of evaluate_image, and stores them in
+    coco_eval.eval as COCOeval.accumulate does.
+    The detections of each category are ordered by image and rank, as COCOeval concatenates them, before
+    being stably sorted by decreasing score, so that ties are broken in the same way.
+    """
+    p = coco_eval.params
+    T = len(p.iouThrs)
+    R = len(p.recThrs)
+    K = len(p.catIds)
+    A = len(p.areaRng)
+    M = len(p.maxDets)
+    precision = -np.ones((T, R, K, A, M))
+    recall = -np.ones((T, K, A, M))
+    scores = -np.ones((T, R, K, A, M))
+
+    # the number of annotations that are not ignored, per category and area range
+    npig = np.zeros((K, A), dtype=np.int64)
+    np.add.at(npig, gt["category"], ~gt["ignore"])
+
+    order = np.lexsort((dt["rank"], dt["image_id"], dt["category"]))
+    dt = {name: column[order] for name, column in dt.items()}
+    bounds = np.searchsorted(dt["category"], np.arange(K + 1))
+    for k in range(K):
+        rows = slice(bounds[k], bounds[k + 1])
+        for m, maxDet in enumerate(p.maxDets):
+            keep = dt["rank"][rows] < maxDet
+            dtScores = dt["score"][rows][keep]
+            # different sorting methods generate slightly different results,
+            # mergesort is used to be consistent with the Matlab implementation
+            inds = np.argsort(-dtScores, kind='mergesort')
+            dtScoresSorted = dtScores[inds]
+            matched = dt["matched"][rows][keep][inds]
+            ignore = dt["ignore"][rows][keep][inds]
+            nd = len(inds)
+            for a in range(A):
+                if npig[k, a] == 0:
+                    continue
+                dtm, dtIg = matched[:, a].T, ignore[:, a].T
+                tps = np.logical_and(dtm, np.logical_not(dtIg))
+                fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg))
+                tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+                if nd == 0:
+                    recall[:, k, a, m] = 0
+                    precision[:, :, k, a, m] = 0
+                    scores[:, :, k, a, m] = 0
+                    continue
+                rc = tp_sum / npig[k, a]
+                pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                recall[:, k, a, m] = rc[:, -1]
+                # make the precision monotonically decreasing
+                pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                for t in range(T):
+                    inds = np.searchsorted(rc[t], p.recThrs, side='left')
+                    valid = inds < nd
+                    q = np.zeros((R,))
+                    ss = np.zeros((R,))
+                    q[valid] = pr[t, inds[valid]]
+                    ss[valid] = dtScoresSorted[inds[valid]]
+                    precision[t, :, k, a, m] = q
+                    scores[t, :, k, a, m] = ss
+    coco_eval.eval = {
+        'params': p,
+        'counts': [T, R, K, A, M],
+        'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'precision': precision,
+        'recall': recall,
+        'scores': scores,
+    }
+
+
 def merge(img_ids, eval_imgs):
     all_img_ids = all_gather(img_ids)
     all_eval_imgs = all_gather(eval_imgs)
@@ -0,0 +1,149 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+Precomputed backbone features, for training with a frozen backbone (--lr_backbone 0).
+
+The backbone is run once on each training image, for a fixed set of deterministic views
+(the val transform, and optionally its horizontal flip), and its last feature map is stored
+as float16 in a single file read back through a numpy memmap.
+During training, the dataset then yields these features instead of the images, and the
+backbone body of the model is bypassed, so that only input_proj, the transformer and the
+heads are run.
+"""
+from contextlib import contextmanager
+import hashlib
+from pathlib import Path
+import random
+from typing import Dict
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+import datasets.transforms as T
+import util.misc as utils
+from util.misc import NestedTensor
+
+from .coco import make_coco_transforms
+
+
+class BackboneFeatureCache(object):
+    """Read-only view over the features and targets stored in cache_dir"""
+
+    def __init__(self, cache_dir, index):
+        self.cache_dir = Path(cache_dir)
+        self.meta = index["meta"]
+        # entries[idx][view] = (offset, shape, target)
+        self.entries = index["entries"]
+        self.features = np.memmap(self.cache_dir / "features.bin", dtype=np.float16, mode="r")
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def num_views(self):
+        return self.meta["views"]
+
+    def get(self, idx, view):
+        offset, shape, target = self.entries[idx][view]
+        numel = int(np.prod(shape))
+        features = torch.from_numpy(np.array(self.features[offset:offset + numel])).view(shape).float()
+        return features, {k: v.clone() for k, v in target.items()}
+
+
+class CachedFeatureDataset(torch.utils.data.Dataset):
+    """Yields (features [C x h x w], target) pairs, picking one of the cached views at random"""
+
+    def __init__(self, cache: BackboneFeatureCache):
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, idx):
+        return self.cache.get(idx, random.randrange(self.cache.num_views))
+
+
+def make_cache_transforms(view):
+    # view 0 is the val transform, view 1 its horizontal flip
+    transforms = make_coco_transforms('val')
+    if view == 1:
+        transforms = T.Compose([T.RandomHorizontalFlip(p=1.0), transforms])
+    return transforms
+
+
+def weights_fingerprint(module):
+    """Hash of the parameters and buffers of module, identifying the weights the features were computed with"""
+    sha = hashlib.sha1()
+    for name, tensor in sorted(module.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+@torch.no_grad()
+def build_feature_cache(backbone, dataset, cache_dir, views, args, device):
+    """
+    Loads the cache stored in cache_dir, or computes it if missing or built with different settings.
+    Parameters:
+        backbone: the frozen BackboneBase of the model, ie model.backbone[0]
+        dataset: the CocoDetection training dataset, its transforms are replaced by the deterministic views
+        views: number of views cached per image (1 or 2)
+    """
+    cache_dir = Path(cache_dir)
+    index_file = cache_dir / "index.pth"
+    meta = {"backbone": args.backbone, "dilation": args.dilation, "num_images": len(dataset), "views": views,
+            "weights": weights_fingerprint(backbone)}
+    if index_file.exists():
+        index = torch.load(index_file)
+        if index["meta"] == meta:
+            print("Loaded backbone feature cache from {}".format(cache_dir))
+            return BackboneFeatureCache(cache_dir, index)
+        print("Backbone feature cache in {} was built with different settings or backbone weights "
+              "({}), recomputing it".format(cache_dir, index["meta"]))
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    backbone.eval()
+    entries = [[] for _ in range(len(dataset))]
+    offset = 0
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    with open(cache_dir / "features.bin", "wb") as f:
+        for view in range(views):
+            dataset._transforms = make_cache_transforms(view)
+            # one image per batch, so that the features are not affected by padding
+            data_loader = DataLoader(dataset, batch_size=1, shuffle=False,
+                                     collate_fn=utils.collate_fn, num_workers=args.num_workers)
+            header = 'Caching backbone features, view [{}]:'.format(view)
+            for idx, (samples, targets) in enumerate(metric_logger.log_every(data_loader, 100, header)):
+                features = backbone.body(samples.tensors.to(device))["0"][0]
+                features = features.half().cpu().numpy()
+                f.write(features.tobytes())
+                entries[idx].append((offset, tuple(features.shape), targets[0]))
+                offset += features.size
+
+    index = {"meta": meta, "entries": entries}
+    torch.save(index, index_file)
+    return BackboneFeatureCache(cache_dir, index)
+
+
+class FeaturePassthrough(nn.Module):
+    """Stands in for BackboneBase when the samples already are the backbone features"""
+
+    def forward(self, tensor_list: NestedTensor):
+        out: Dict[str, NestedTensor] = {"0": tensor_list}
+        return out
+
+
+@contextmanager
+def cached_backbone(model, enabled=True):
+    """Within this context, the model takes precomputed backbone features as input instead of images"""
+    if not enabled:
+        yield model
+        return
+    joiner = model.backbone
+    backbone = joiner[0]
+    joiner[0] = FeaturePassthrough()
+    try:
+        yield model
+    finally:
+        joiner[0] = backbone
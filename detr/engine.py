@@ -5,6 +5,7 @@ Train and eval functions used in main.py
 import math
 import os
 import sys
+import time
 from typing import Iterable
 
 import torch
@@ -14,9 +15,26 @@ from datasets.coco_eval import CocoEvaluator
 from datasets.panoptic_eval import PanopticEvaluator
 
 
+def _prepare_samples(samples, device, channels_last):
+    samples = samples.to(device)
+    if channels_last:
+        samples.tensors = samples.tensors.contiguous(memory_format=torch.channels_last)
+    return samples
+
+
+def _to_float(outputs):
+    # the losses, the matcher and the postprocessors are computed in float32, even under autocast
+    if isinstance(outputs, dict):
+        return {k: _to_float(v) for k, v in outputs.items()}
+    if isinstance(outputs, list):
+        return [_to_float(v) for v in outputs]
+    return outputs.float()
+
+
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
-                    device: torch.device, epoch: int, max_norm: float = 0):
+                    device: torch.device, epoch: int, max_norm: float = 0,
+                    channels_last: bool = False, bf16: bool = False):
     model.train()
     criterion.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
@@ -26,10 +44,12 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     print_freq = 10
 
     for samples, targets in metric_logger.log_every(data_loader, print_freq, header):
-        samples = samples.to(device)
+        samples = _prepare_samples(samples, device, channels_last)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
-        outputs = model(samples)
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+            outputs = model(samples)
+        outputs = _to_float(outputs)
         loss_dict = criterion(outputs, targets)
         weight_dict = criterion.weight_dict
         losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
@@ -65,7 +85,8 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
 
 
 @torch.no_grad()
-def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, output_dir):
+def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, output_dir,
+             channels_last=False, bf16=False):
     model.eval()
     criterion.eval()
 
@@ -86,10 +107,12 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
         )
 
     for samples, targets in metric_logger.log_every(data_loader, 10, header):
-        samples = samples.to(device)
+        samples = _prepare_samples(samples, device, channels_last)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
-        outputs = model(samples)
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+            outputs = model(samples)
+        outputs = _to_float(outputs)
         loss_dict = criterion(outputs, targets)
         weight_dict = criterion.weight_dict
 
@@ -149,3 +172,23 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
         stats['PQ_th'] = panoptic_res["Things"]
         stats['PQ_st'] = panoptic_res["Stuff"]
     return stats, coco_evaluator
+
+
+@torch.no_grad()
+def measure_latency(model, data_loader, device, num_batches):
+    """Average model forward time per image, in seconds, over the first num_batches batches"""
+    model.eval()
+    total_time, num_images = 0.0, 0
+    for i, (samples, _) in enumerate(data_loader):
+        if i == num_batches:
+            break
+        samples = samples.to(device)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        model(samples)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        total_time += time.time() - start_time
+        num_images += len(samples.tensors)
+    return total_time / max(num_images, 1)
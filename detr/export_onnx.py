@@ -0,0 +1,95 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+A script to export a trained DETR to ONNX for deployment without a PyTorch runtime.
+
+The exported graph takes the images and their original sizes, and returns scores, labels and
+absolute boxes (see models/export.py). It is then checked against PyTorch with onnxruntime on
+CPU, on val images of different sizes, and both latencies are reported.
+"""
+import argparse
+import time
+
+import numpy as np
+import onnxruntime
+import torch
+from torch.utils.data import DataLoader
+
+import util.misc as utils
+from datasets import build_dataset
+from main import get_args_parser
+from models import build_model
+from models.export import INPUT_NAMES, OUTPUT_NAMES, export_onnx
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("DETR ONNX export", parents=[get_args_parser()])
+    parser.add_argument("--onnx_file", default="detr.onnx", type=str,
+                        help="Path of the exported ONNX model")
+    parser.add_argument("--top_k", default=0, type=int,
+                        help="Only output the top_k highest scoring detections of each image, 0 to output all queries")
+    parser.add_argument("--opset", default=12, type=int, help="ONNX opset version")
+    parser.add_argument("--validate_images", default=10, type=int,
+                        help="Number of val images the ONNX model is checked against PyTorch on")
+    parser.add_argument("--latency_batches", default=20, type=int,
+                        help="Number of val images used to measure the latencies")
+    return parser.parse_args()
+
+
+def main(args):
+    assert args.resume, "The checkpoint to export must be given with --resume"
+    assert not args.masks, "Only detection models can be exported"
+    assert args.device == 'cpu', "The exported model is validated with onnxruntime on CPU, pass --device cpu"
+
+    model, _, _ = build_model(args)
+    checkpoint = torch.load(args.resume, map_location='cpu')
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+
+    wrapper = export_onnx(model, args.onnx_file, args.top_k, args.opset)
+    print("Exported model to {}".format(args.onnx_file))
+    session = onnxruntime.InferenceSession(args.onnx_file, providers=["CPUExecutionProvider"])
+
+    # one image per batch, so that the images keep their own size and no padding is involved
+    dataset_val = build_dataset(image_set='val', args=args)
+    data_loader = DataLoader(dataset_val, 1, sampler=torch.utils.data.SequentialSampler(dataset_val),
+                             collate_fn=utils.collate_fn, num_workers=args.num_workers)
+
+    max_diff = {name: 0.0 for name in OUTPUT_NAMES}
+    torch_time, onnx_time, num_images = 0.0, 0.0, 0
+    for i, (samples, targets) in enumerate(data_loader):
+        if i == max(args.validate_images, args.latency_batches):
+            break
+        images = samples.tensors
+        target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
+
+        start_time = time.time()
+        with torch.no_grad():
+            torch_outputs = [o.numpy() for o in wrapper(images, target_sizes)]
+        torch_time += time.time() - start_time
+        start_time = time.time()
+        onnx_outputs = session.run(None, dict(zip(INPUT_NAMES, (images.numpy(), target_sizes.numpy()))))
+        onnx_time += time.time() - start_time
+        num_images += 1
+
+        if i < args.validate_images:
+            for name, torch_output, onnx_output in zip(OUTPUT_NAMES, torch_outputs, onnx_outputs):
+                if name == "labels":
+                    diff = np.mean(torch_output != onnx_output)
+                else:
+                    diff = np.max(np.abs(torch_output - onnx_output))
+                max_diff[name] = max(max_diff[name], float(diff))
+
+    print("Max difference with PyTorch over {} images: scores {:.2e}, boxes {:.2e} (pixels), "
+          "mismatched labels {:.2%}".format(min(args.validate_images, num_images), max_diff["scores"],
+                                            max_diff["boxes"], max_diff["labels"]))
+    if max_diff["scores"] > 1e-3:
+        raise RuntimeError("The ONNX model does not match PyTorch, max score difference {:.2e}".format(
+            max_diff["scores"]))
+
+    print("{:>12} {:>15}".format("runtime", "latency (ms)"))
+    for name, total_time in (("pytorch", torch_time), ("onnxruntime", onnx_time)):
+        print("{:>12} {:>15.1f}".format(name, 1000 * total_time / max(num_images, 1)))
+
+
+if __name__ == '__main__':
+    main(parse_args())
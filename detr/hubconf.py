@@ -1,7 +1,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 import torch
 
-from models.backbone import Backbone, Joiner
+from models.backbone import Backbone, Joiner, fold_frozen_batchnorm
+from models.compilation import compile_and_warmup
 from models.detr import DETR, PostProcess
 from models.position_encoding import PositionEmbeddingSine
 from models.segmentation import DETRsegm, PostProcessPanoptic
@@ -13,7 +14,7 @@ dependencies = ["torch", "torchvision"]
 def _make_detr(backbone_name: str, dilation=False, num_classes=91, mask=False):
     hidden_dim = 256
     backbone = Backbone(backbone_name, train_backbone=True, return_interm_layers=mask, dilation=dilation)
-    pos_enc = PositionEmbeddingSine(hidden_dim // 2, normalize=True)
+    pos_enc = PositionEmbeddingSine(hidden_dim // 2, normalize=True, cache_size=16)
     backbone_with_pos_enc = Joiner(backbone, pos_enc)
     backbone_with_pos_enc.num_channels = backbone.num_channels
     transformer = Transformer(d_model=hidden_dim, return_intermediate_dec=True)
@@ -23,11 +24,25 @@ def _make_detr(backbone_name: str, dilation=False, num_classes=91, mask=False):
     return detr
 
 
-def detr_resnet50(pretrained=False, num_classes=91, return_postprocessor=False):
+def _prepare_for_inference(model, fuse_batchnorm=False, compile_buckets=None):
+    model.eval()
+    if fuse_batchnorm:
+        fold_frozen_batchnorm(model)
+    if compile_buckets:
+        compile_and_warmup(model, compile_buckets, batch_size=1, device=next(model.parameters()).device,
+                           modes=("eval",))
+
+
+def detr_resnet50(pretrained=False, num_classes=91, return_postprocessor=False, fuse_batchnorm=False,
+                  compile_buckets=None):
     """
     DETR R50 with 6 encoder and 6 decoder layers.
 
     Achieves 42/62.4 AP/AP50 on COCO val5k.
+
+    fuse_batchnorm folds the frozen batchnorms of the backbone into its convolutions, for inference only.
+    compile_buckets is a list of (H, W) input sizes, for which the model is compiled with torch.compile,
+    inputs must then be padded to one of them (see util.misc.pad_to_bucket).
     """
     model = _make_detr("resnet50", dilation=False, num_classes=num_classes)
     if pretrained:
@@ -35,12 +50,15 @@ def detr_resnet50(pretrained=False, num_classes=91, return_postprocessor=False):
             url="https://dl.fbaipublicfiles.com/detr/detr-r50-e632da11.pth", map_location="cpu", check_hash=True
         )
         model.load_state_dict(checkpoint["model"])
+    if fuse_batchnorm or compile_buckets:
+        _prepare_for_inference(model, fuse_batchnorm, compile_buckets)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def detr_resnet50_dc5(pretrained=False, num_classes=91, return_postprocessor=False):
+def detr_resnet50_dc5(pretrained=False, num_classes=91, return_postprocessor=False, fuse_batchnorm=False,
+                      compile_buckets=None):
     """
     DETR-DC5 R50 with 6 encoder and 6 decoder layers.
 
@@ -54,12 +72,15 @@ def detr_resnet50_dc5(pretrained=False, num_classes=91, return_postprocessor=Fal
             url="https://dl.fbaipublicfiles.com/detr/detr-r50-dc5-f0fb7ef5.pth", map_location="cpu", check_hash=True
         )
         model.load_state_dict(checkpoint["model"])
+    if fuse_batchnorm or compile_buckets:
+        _prepare_for_inference(model, fuse_batchnorm, compile_buckets)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def detr_resnet101(pretrained=False, num_classes=91, return_postprocessor=False):
+def detr_resnet101(pretrained=False, num_classes=91, return_postprocessor=False, fuse_batchnorm=False,
+                   compile_buckets=None):
     """
     DETR-DC5 R101 with 6 encoder and 6 decoder layers.
 
@@ -71,12 +92,15 @@ def detr_resnet101(pretrained=False, num_classes=91, return_postprocessor=False)
             url="https://dl.fbaipublicfiles.com/detr/detr-r101-2c7b67e5.pth", map_location="cpu", check_hash=True
         )
         model.load_state_dict(checkpoint["model"])
+    if fuse_batchnorm or compile_buckets:
+        _prepare_for_inference(model, fuse_batchnorm, compile_buckets)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def detr_resnet101_dc5(pretrained=False, num_classes=91, return_postprocessor=False):
+def detr_resnet101_dc5(pretrained=False, num_classes=91, return_postprocessor=False, fuse_batchnorm=False,
+                       compile_buckets=None):
     """
     DETR-DC5 R101 with 6 encoder and 6 decoder layers.
 
@@ -90,13 +114,16 @@ def detr_resnet101_dc5(pretrained=False, num_classes=91, return_postprocessor=Fa
             url="https://dl.fbaipublicfiles.com/detr/detr-r101-dc5-a2e86def.pth", map_location="cpu", check_hash=True
         )
         model.load_state_dict(checkpoint["model"])
+    if fuse_batchnorm or compile_buckets:
+        _prepare_for_inference(model, fuse_batchnorm, compile_buckets)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
 def detr_resnet50_panoptic(
-    pretrained=False, num_classes=250, threshold=0.85, return_postprocessor=False
+    pretrained=False, num_classes=250, threshold=0.85, return_postprocessor=False, fuse_batchnorm=False,
+    compile_buckets=None
 ):
     """
     DETR R50 with 6 encoder and 6 decoder layers.
@@ -113,13 +140,16 @@ def detr_resnet50_panoptic(
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    if fuse_batchnorm or compile_buckets:
+        _prepare_for_inference(model, fuse_batchnorm, compile_buckets)
     if return_postprocessor:
         return model, PostProcessPanoptic(is_thing_map, threshold=threshold)
     return model
 
 
 def detr_resnet50_dc5_panoptic(
-    pretrained=False, num_classes=250, threshold=0.85, return_postprocessor=False
+    pretrained=False, num_classes=250, threshold=0.85, return_postprocessor=False, fuse_batchnorm=False,
+    compile_buckets=None
 ):
     """
     DETR-DC5 R50 with 6 encoder and 6 decoder layers.
@@ -139,13 +169,16 @@ def detr_resnet50_dc5_panoptic(
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    if fuse_batchnorm or compile_buckets:
+        _prepare_for_inference(model, fuse_batchnorm, compile_buckets)
     if return_postprocessor:
         return model, PostProcessPanoptic(is_thing_map, threshold=threshold)
     return model
 
 
 def detr_resnet101_panoptic(
-    pretrained=False, num_classes=250, threshold=0.85, return_postprocessor=False
+    pretrained=False, num_classes=250, threshold=0.85, return_postprocessor=False, fuse_batchnorm=False,
+    compile_buckets=None
 ):
     """
     DETR-DC5 R101 with 6 encoder and 6 decoder layers.
@@ -163,6 +196,8 @@ def detr_resnet101_panoptic(
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    if fuse_batchnorm or compile_buckets:
+        _prepare_for_inference(model, fuse_batchnorm, compile_buckets)
     if return_postprocessor:
         return model, PostProcessPanoptic(is_thing_map, threshold=threshold)
     return model
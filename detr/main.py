@@ -13,8 +13,13 @@ from torch.utils.data import DataLoader, DistributedSampler
 import datasets
 import util.misc as utils
 from datasets import build_dataset, get_coco_api_from_dataset
+from datasets.coco_eval import CocoGroundTruth
+from datasets.feature_cache import CachedFeatureDataset, build_feature_cache, cached_backbone
 from engine import evaluate, train_one_epoch
 from models import build_model
+from models.backbone import fold_frozen_batchnorm
+from models.compilation import compile_and_warmup, parse_size_buckets
+from models.detr import prune_queries
 
 
 def get_args_parser():
@@ -38,8 +43,18 @@ def get_args_parser():
                         help="If true, we replace stride with dilation in the last convolutional block (DC5)")
     parser.add_argument('--position_embedding', default='sine', type=str, choices=('sine', 'learned'),
                         help="Type of positional embedding to use on top of the image features")
+    parser.add_argument('--position_embedding_cache', default=16, type=int,
+                        help="Number of sine position embeddings, keyed by mask shape, kept in a LRU cache "
+                             "(one hidden_dim x H x W tensor each, 0 to disable)")
 
     # * Transformer
+    parser.add_argument('--transformer', default='dense', type=str, choices=('dense', 'deformable'),
+                        help="Type of transformer: dense attention over all pixels, or deformable attention "
+                             "sampling a fixed number of points per query")
+    parser.add_argument('--enc_n_points', default=4, type=int,
+                        help="Number of sampling points per head in the deformable encoder attention")
+    parser.add_argument('--dec_n_points', default=4, type=int,
+                        help="Number of sampling points per head in the deformable decoder cross-attention")
     parser.add_argument('--enc_layers', default=6, type=int,
                         help="Number of encoding layers in the transformer")
     parser.add_argument('--dec_layers', default=6, type=int,
@@ -55,21 +70,65 @@ def get_args_parser():
     parser.add_argument('--num_queries', default=100, type=int,
                         help="Number of query slots")
     parser.add_argument('--pre_norm', action='store_true')
+    parser.add_argument('--exit_dec_layers', default=0, type=int,
+                        help="At inference, only run this many decoder layers (0 for all of them)")
+    parser.add_argument('--exit_threshold', default=0.0, type=float,
+                        help="At inference, stop decoding once the class confidences change by less than "
+                             "this between two decoder layers (0 to disable)")
+    parser.add_argument('--attention_backend', default='mha', type=str, choices=('mha', 'sdpa'),
+                        help="Attention implementation: nn.MultiheadAttention (mha) or batch-first "
+                             "F.scaled_dot_product_attention with fused q/k projection (sdpa)")
+
+    # * Post-processing
+    parser.add_argument('--postprocess_top_k', default=0, type=int,
+                        help="Only keep the top k (query, class) pairs of each image, instead of the best class of "
+                             "every query (0)")
+    parser.add_argument('--postprocess_score_threshold', default=0.0, type=float,
+                        help="Drop the detections scoring below this threshold")
+    parser.add_argument('--segm_paste_in_boxes', action='store_true',
+                        help="Only compute the segm masks inside their predicted box, at the original image size")
+    parser.add_argument('--segm_rle', action='store_true',
+                        help="Encode the segm masks to COCO RLE in the post-processing, instead of keeping "
+                             "full size uint8 masks")
 
     # * Segmentation
     parser.add_argument('--masks', action='store_true',
                         help="Train segmentation head if the flag is provided")
+    parser.add_argument('--panoptic_threads', default=4, type=int,
+                        help="Number of threads encoding the panoptic PNGs of a batch, 0 to encode them serially")
+    parser.add_argument('--mask_score_threshold', default=0.0, type=float,
+                        help="At inference, only run the mask head on the queries scoring above this threshold. "
+                             "Lossless for panoptic post-processing with the same threshold (0.85), "
+                             "but lowers the segm AP, which uses every query")
+    parser.add_argument('--mask_points', default=0, type=int,
+                        help="Compute the mask losses on this number of points per mask, sampled around the "
+                             "uncertain regions of the predictions, instead of at full resolution (0)")
 
     # Loss
     parser.add_argument('--no_aux_loss', dest='aux_loss', action='store_false',
                         help="Disables auxiliary decoding losses (loss at each layer)")
+    parser.add_argument('--aux_match_interval', default=1, type=int,
+                        help="Match the auxiliary outputs of every N-th decoder layer, counting back from the last "
+                             "one, the others reuse the matching of the next matched layer. 0 reuses the matching of "
+                             "the last layer for all the auxiliary outputs")
+    parser.add_argument('--fused_loss', action='store_true',
+                        help="Compute the losses of all the decoder layers in a single batched pass")
     # * Matcher
+    parser.add_argument('--matcher', default='hungarian', type=str, choices=('hungarian', 'auction'),
+                        help="Exact Hungarian matching with scipy, or approximate matching with a batched "
+                             "auction algorithm running on the device (see benchmark_matcher.py for its quality)")
+    parser.add_argument('--auction_epsilon', default=1e-3, type=float,
+                        help="Bid increment of the auction matcher, each image is matched within "
+                             "num_targets * auction_epsilon of the optimal cost")
     parser.add_argument('--set_cost_class', default=1, type=float,
                         help="Class coefficient in the matching cost")
     parser.add_argument('--set_cost_bbox', default=5, type=float,
                         help="L1 box coefficient in the matching cost")
     parser.add_argument('--set_cost_giou', default=2, type=float,
                         help="giou box coefficient in the matching cost")
+    parser.add_argument('--matcher_threads', default=4, type=int,
+                        help="Number of threads solving the per-image assignments in parallel, "
+                             "0 to solve them serially")
     # * Loss coefficients
     parser.add_argument('--mask_loss_coef', default=1, type=float)
     parser.add_argument('--dice_loss_coef', default=1, type=float)
@@ -83,6 +142,12 @@ def get_args_parser():
     parser.add_argument('--coco_path', type=str)
     parser.add_argument('--coco_panoptic_path', type=str)
     parser.add_argument('--remove_difficult', action='store_true')
+    parser.add_argument('--backbone_feature_cache', default='',
+                        help='directory where the features of the frozen backbone are precomputed once and stored, '
+                             'subsequent epochs then skip the backbone. Requires --lr_backbone 0')
+    parser.add_argument('--backbone_feature_cache_views', default=2, type=int, choices=(1, 2),
+                        help='number of deterministic views cached per training image: '
+                             '1 for the val transform, 2 to also cache its horizontal flip')
 
     parser.add_argument('--output_dir', default='',
                         help='path where to save, empty for no saving')
@@ -93,7 +158,23 @@ def get_args_parser():
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
                         help='start epoch')
     parser.add_argument('--eval', action='store_true')
+    parser.add_argument('--fuse_batchnorm', action='store_true',
+                        help='with --eval, fold the frozen batchnorms of the backbone into its convolutions '
+                             'and check that the outputs are unchanged')
     parser.add_argument('--num_workers', default=2, type=int)
+    parser.add_argument('--channels_last', action='store_true',
+                        help='use the channels_last memory format for the input images and the convolution weights')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the backbone and the transformer with torch.compile, '
+                             'and warm up each of the --size_buckets at startup')
+    parser.add_argument('--compile_mode', default='default', type=str,
+                        choices=('default', 'reduce-overhead', 'max-autotune'))
+    parser.add_argument('--size_buckets', default=[], type=str, nargs='*',
+                        help='input sizes, as HxW, that the batches are padded to (to the smallest one they fit in), '
+                             'e.g. --size_buckets 800x800 800x1066 800x1333')
+    parser.add_argument('--bf16', action='store_true',
+                        help='run the model forward under bfloat16 autocast, the losses and the matcher '
+                             'are still computed in float32')
 
     # distributed training parameters
     parser.add_argument('--world_size', default=1, type=int,
@@ -120,6 +201,8 @@ def main(args):
 
     model, criterion, postprocessors = build_model(args)
     model.to(device)
+    if args.channels_last:
+        model.to(memory_format=torch.channels_last)
 
     model_without_ddp = model
     if args.distributed:
@@ -139,9 +222,45 @@ def main(args):
                                   weight_decay=args.weight_decay)
     lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, args.lr_drop)
 
+    # loaded before the datasets, so that the backbone feature cache is computed with the final weights
+    if args.frozen_weights is not None:
+        checkpoint = torch.load(args.frozen_weights, map_location='cpu')
+        model_without_ddp.detr.load_state_dict(checkpoint['model'])
+
+    output_dir = Path(args.output_dir)
+    if args.resume:
+        if args.resume.startswith('https'):
+            checkpoint = torch.hub.load_state_dict_from_url(
+                args.resume, map_location='cpu', check_hash=True)
+        else:
+            checkpoint = torch.load(args.resume, map_location='cpu')
+        # checkpoints ranking their queries (see prune_queries.py) can be loaded with fewer queries
+        pruned = 'query_ranking' in checkpoint and args.num_queries < len(checkpoint['query_ranking'])
+        if pruned:
+            print("Keeping the {} most frequently firing of {} queries".format(
+                args.num_queries, len(checkpoint['query_ranking'])))
+            kept_queries = sorted(checkpoint['query_ranking'][:args.num_queries])
+            checkpoint['model'] = prune_queries(checkpoint['model'], kept_queries)
+        model_without_ddp.load_state_dict(checkpoint['model'])
+        if not args.eval and not pruned and 'optimizer' in checkpoint and 'lr_scheduler' in checkpoint \
+                and 'epoch' in checkpoint:
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+            args.start_epoch = checkpoint['epoch'] + 1
+
     dataset_train = build_dataset(image_set='train', args=args)
     dataset_val = build_dataset(image_set='val', args=args)
 
+    if args.backbone_feature_cache and not args.eval:
+        assert args.lr_backbone == 0, "Backbone features can only be cached with a frozen backbone"
+        assert not args.masks, "Backbone feature caching does not support the segmentation head"
+        assert args.dataset_file == 'coco', "Backbone feature caching is only supported for coco datasets"
+        assert not args.distributed, "Backbone feature caching is not supported in distributed mode"
+        assert not args.size_buckets, "Backbone feature caching does not support --size_buckets"
+        feature_cache = build_feature_cache(model_without_ddp.backbone[0], dataset_train, args.backbone_feature_cache,
+                                            args.backbone_feature_cache_views, args, device)
+        dataset_train = CachedFeatureDataset(feature_cache)
+
     if args.distributed:
         sampler_train = DistributedSampler(dataset_train)
         sampler_val = DistributedSampler(dataset_val, shuffle=False)
@@ -152,10 +271,12 @@ def main(args):
     batch_sampler_train = torch.utils.data.BatchSampler(
         sampler_train, args.batch_size, drop_last=True)
 
+    size_buckets = parse_size_buckets(args.size_buckets)
+    collate_fn = utils.BucketedCollate(size_buckets) if size_buckets else utils.collate_fn
     data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train,
-                                   collate_fn=utils.collate_fn, num_workers=args.num_workers)
+                                   collate_fn=collate_fn, num_workers=args.num_workers)
     data_loader_val = DataLoader(dataset_val, args.batch_size, sampler=sampler_val,
-                                 drop_last=False, collate_fn=utils.collate_fn, num_workers=args.num_workers)
+                                 drop_last=False, collate_fn=collate_fn, num_workers=args.num_workers)
 
     if args.dataset_file == "coco_panoptic":
         # We also evaluate AP during panoptic training, on original coco DS
@@ -163,27 +284,24 @@ def main(args):
         base_ds = get_coco_api_from_dataset(coco_val)
     else:
         base_ds = get_coco_api_from_dataset(dataset_val)
+    # indexed once, and shared by the evaluators of all the epochs
+    base_ds = CocoGroundTruth(base_ds)
 
-    if args.frozen_weights is not None:
-        checkpoint = torch.load(args.frozen_weights, map_location='cpu')
-        model_without_ddp.detr.load_state_dict(checkpoint['model'])
+    if args.eval and args.fuse_batchnorm:
+        samples = utils.nested_tensor_from_tensor_list([dataset_val[0][0].to(device)])
+        fold_frozen_batchnorm(model_without_ddp, samples)
 
-    output_dir = Path(args.output_dir)
-    if args.resume:
-        if args.resume.startswith('https'):
-            checkpoint = torch.hub.load_state_dict_from_url(
-                args.resume, map_location='cpu', check_hash=True)
-        else:
-            checkpoint = torch.load(args.resume, map_location='cpu')
-        model_without_ddp.load_state_dict(checkpoint['model'])
-        if not args.eval and 'optimizer' in checkpoint and 'lr_scheduler' in checkpoint and 'epoch' in checkpoint:
-            optimizer.load_state_dict(checkpoint['optimizer'])
-            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
-            args.start_epoch = checkpoint['epoch'] + 1
+    if args.compile:
+        assert size_buckets, "--compile requires --size_buckets, to avoid recompiling for every input size"
+        modes = ('eval',) if args.eval else ('train', 'eval')
+        # the last validation batch is smaller, unless the number of images divides the batch size
+        compile_and_warmup(model, size_buckets, args.batch_size, device, modes, args.compile_mode,
+                           args.channels_last, args.bf16, eval_tail_size=len(sampler_val) % args.batch_size)
 
     if args.eval:
         test_stats, coco_evaluator = evaluate(model, criterion, postprocessors,
-                                              data_loader_val, base_ds, device, args.output_dir)
+                                              data_loader_val, base_ds, device, args.output_dir,
+                                              args.channels_last, args.bf16)
         if args.output_dir:
             utils.save_on_master(coco_evaluator.coco_eval["bbox"].eval, output_dir / "eval.pth")
         return
@@ -193,9 +311,10 @@ def main(args):
     for epoch in range(args.start_epoch, args.epochs):
         if args.distributed:
             sampler_train.set_epoch(epoch)
-        train_stats = train_one_epoch(
-            model, criterion, data_loader_train, optimizer, device, epoch,
-            args.clip_max_norm)
+        with cached_backbone(model_without_ddp, enabled=bool(args.backbone_feature_cache)):
+            train_stats = train_one_epoch(
+                model, criterion, data_loader_train, optimizer, device, epoch,
+                args.clip_max_norm, args.channels_last, args.bf16)
         lr_scheduler.step()
         if args.output_dir:
             checkpoint_paths = [output_dir / 'checkpoint.pth']
@@ -212,13 +331,15 @@ def main(args):
                 }, checkpoint_path)
 
         test_stats, coco_evaluator = evaluate(
-            model, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir
+            model, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir,
+            args.channels_last, args.bf16
         )
 
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
                      **{f'test_{k}': v for k, v in test_stats.items()},
                      'epoch': epoch,
-                     'n_parameters': n_parameters}
+                     'n_parameters': n_parameters,
+                     'aux_match_interval': args.aux_match_interval}
 
         if args.output_dir and utils.is_main_process():
             with (output_dir / "log.txt").open("a") as f:
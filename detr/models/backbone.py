@@ -55,6 +55,50 @@ class FrozenBatchNorm2d(torch.nn.Module):
         return x * scale + bias
 
 
+@torch.no_grad()
+def _fuse_frozen_batchnorm(module: nn.Module):
+    """
+    Folds, in place, each FrozenBatchNorm2d of module into the Conv2d registered right before it
+    in the same parent module, and replaces it by an identity.
+    This relies on the registration order of the submodules following the execution order,
+    which is the case in torchvision ResNets. The module is returned for convenience.
+    """
+    previous = None
+    for name, child in list(module.named_children()):
+        if isinstance(child, FrozenBatchNorm2d) and isinstance(previous, nn.Conv2d):
+            scale = child.weight * (child.running_var + 1e-5).rsqrt()
+            bias = child.bias - child.running_mean * scale
+            conv_bias = previous.bias if previous.bias is not None else torch.zeros_like(bias)
+            previous.weight.mul_(scale.reshape(-1, 1, 1, 1))
+            previous.bias = nn.Parameter(conv_bias * scale + bias, requires_grad=previous.weight.requires_grad)
+            setattr(module, name, nn.Identity())
+        else:
+            _fuse_frozen_batchnorm(child)
+        previous = child
+    return module
+
+
+@torch.no_grad()
+def fold_frozen_batchnorm(model: nn.Module, samples=None, atol: float = 1e-4):
+    """
+    Prepares model (a DETR, a DETRsegm or a part of them) for inference by folding all its FrozenBatchNorm2d
+    layers into the preceding convolutions, which saves their elementwise ops at every forward.
+    If samples are given, the outputs of the model on them are checked to match before and after folding,
+    up to atol times the largest magnitude of each output (when above 1), as raw backbone features can be large.
+    """
+    model.eval()
+    reference = model(samples) if samples is not None else None
+    _fuse_frozen_batchnorm(model)
+    if reference is not None:
+        outputs = model(samples)
+        for k, v in reference.items():
+            if isinstance(v, torch.Tensor):
+                max_diff = (v - outputs[k]).abs().max().item()
+                if max_diff > atol * max(1.0, v.abs().max().item()):
+                    raise RuntimeError(f"folding the batchnorms changed {k} by up to {max_diff}")
+    return model
+
+
 class BackboneBase(nn.Module):
 
     def __init__(self, backbone: nn.Module, train_backbone: bool, num_channels: int, return_interm_layers: bool):
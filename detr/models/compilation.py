@@ -0,0 +1,107 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+torch.compile support.
+
+The backbone body and the transformer are compiled for static shapes. Since image sizes vary,
+batches are padded to a fixed set of size buckets (see util.misc.BucketedCollate). Each bucket is
+compiled at startup, once per mode (train and eval) and batch size, including the size of the last,
+smaller, evaluation batch, so that the training and evaluation loops do not recompile.
+Dynamo's recompile limit is raised to the number of graphs this takes, as the shapes beyond it
+would otherwise silently fall back to eager.
+"""
+import time
+
+import torch
+
+from util.misc import NestedTensor
+
+
+def parse_size_buckets(size_buckets):
+    """Parses a list of "HxW" strings into a list of (H, W) tuples, sorted by area"""
+    buckets = []
+    for bucket in size_buckets:
+        h, w = bucket.lower().split("x")
+        buckets.append((int(h), int(w)))
+    return sorted(buckets, key=lambda s: s[0] * s[1])
+
+
+def compile_model(model, mode="default"):
+    """Compiles, in place, the backbone body and the transformer of a DETR or DETRsegm model"""
+    if not hasattr(torch.nn.Module, "compile"):
+        raise RuntimeError("compiling the model requires torch>=2.2")
+    model = getattr(model, "module", model)  # unwrap DistributedDataParallel
+    detr = model.detr if hasattr(model, "detr") else model
+    for module in (detr.backbone[0], detr.transformer):
+        module.compile(mode=mode, dynamic=False)
+    return model
+
+
+def _raise_recompile_limit(num_graphs):
+    # named cache_size_limit before torch 2.6
+    config = torch._dynamo.config
+    for name in ("recompile_limit", "cache_size_limit"):
+        if hasattr(config, name):
+            if getattr(config, name) < num_graphs:
+                print("Raising torch._dynamo.config.{} to {}".format(name, num_graphs))
+                setattr(config, name, num_graphs)
+            return
+
+
+def _timed_step(model, samples, train, bf16):
+    device = samples.tensors.device
+    start_time = time.time()
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+        with torch.set_grad_enabled(train):
+            outputs = model(samples)
+    if train:
+        (outputs["pred_logits"].float().sum() + outputs["pred_boxes"].float().sum()).backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.time() - start_time
+
+
+def compile_and_warmup(model, size_buckets, batch_size, device, modes=("train", "eval"), compile_mode="default",
+                       channels_last=False, bf16=False, eval_tail_size=0):
+    """
+    Compiles model, and runs one step of each mode ("train" runs forward and backward, "eval" forward only)
+    on each (H, W) size bucket, so that all the graphs are compiled before the first real batch.
+    eval_tail_size is the size of the last evaluation batch when it is smaller than batch_size (0 otherwise),
+    which is warmed up as well.
+    Prints, for each bucket, mode and batch size, the compilation time and the per-step time before and after
+    compilation.
+    """
+    was_training = model.training
+    batch_sizes = {mode: [batch_size] for mode in modes}
+    if "eval" in batch_sizes and 0 < eval_tail_size < batch_size:
+        batch_sizes["eval"].append(eval_tail_size)
+    _raise_recompile_limit(len(size_buckets) * sum(len(sizes) for sizes in batch_sizes.values()))
+
+    def dummy_samples(b, h, w):
+        tensors = torch.zeros(b, 3, h, w, device=device)
+        if channels_last:
+            tensors = tensors.contiguous(memory_format=torch.channels_last)
+        return NestedTensor(tensors, torch.zeros(b, h, w, dtype=torch.bool, device=device))
+
+    def run_all():
+        times = {}
+        for h, w in size_buckets:
+            for mode in modes:
+                model.train(mode == "train")
+                for b in batch_sizes[mode]:
+                    samples = dummy_samples(b, h, w)
+                    times[h, w, mode, b] = [_timed_step(model, samples, mode == "train", bf16) for _ in range(2)]
+        return times
+
+    eager_times = run_all()
+    compile_model(model, compile_mode)
+    compiled_times = run_all()
+    model.zero_grad(set_to_none=True)
+    model.train(was_training)
+
+    print("{:>12} {:>6} {:>6} {:>12} {:>10} {:>13} {:>8}".format(
+        "bucket", "mode", "batch", "compile (s)", "eager (s)", "compiled (s)", "speedup"))
+    for (h, w, mode, b), (first, step) in compiled_times.items():
+        eager = eager_times[h, w, mode, b][1]
+        print("{:>12} {:>6} {:>6} {:>12.1f} {:>10.3f} {:>13.3f} {:>7.2f}x".format(
+            f"{h}x{w}", mode, b, first - step, eager, step, eager / step))
+    return model
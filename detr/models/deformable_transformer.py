@@ -0,0 +1,367 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+Deformable Transformer class.
+
+Drop-in alternative to models/transformer.py where the encoder self-attention and the decoder
+cross-attention only attend to a fixed number of points sampled around a reference point for each query,
+instead of densely attending over every pixel of the feature map (see https://arxiv.org/abs/2010.04159).
+The cost of the encoder is thus linear in H*W instead of quadratic.
+
+The multi-scale deformable attention is implemented in pure PyTorch (grid_sample), so that it runs on CPU.
+"""
+import math
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import nn, Tensor
+
+from .transformer import _get_activation_fn, _get_clones
+
+
+class DeformableTransformer(nn.Module):
+
+    def __init__(self, d_model=256, nhead=8, num_encoder_layers=6,
+                 num_decoder_layers=6, dim_feedforward=1024, dropout=0.1,
+                 activation="relu", return_intermediate_dec=False,
+                 enc_n_points=4, dec_n_points=4):
+        super().__init__()
+
+        # DETR only feeds the last feature map of the backbone to the transformer
+        n_levels = 1
+        encoder_layer = DeformableTransformerEncoderLayer(d_model, nhead, dim_feedforward, dropout, activation,
+                                                          n_levels, enc_n_points)
+        self.encoder = DeformableTransformerEncoder(encoder_layer, num_encoder_layers)
+
+        decoder_layer = DeformableTransformerDecoderLayer(d_model, nhead, dim_feedforward, dropout, activation,
+                                                          n_levels, dec_n_points)
+        decoder_norm = nn.LayerNorm(d_model)
+        self.decoder = DeformableTransformerDecoder(decoder_layer, num_decoder_layers, decoder_norm,
+                                                    return_intermediate=return_intermediate_dec)
+
+        # the decoder reference points are predicted from the object queries
+        self.reference_points = nn.Linear(d_model, 2)
+
+        self._reset_parameters()
+
+        self.d_model = d_model
+        self.nhead = nhead
+
+    def _reset_parameters(self):
+        for p in self.parameters():
+            if p.dim() > 1:
+                nn.init.xavier_uniform_(p)
+        for m in self.modules():
+            if isinstance(m, MSDeformAttn):
+                m._reset_parameters()
+        nn.init.constant_(self.reference_points.bias, 0.)
+
+    @staticmethod
+    def get_valid_ratio(mask):
+        """Fraction of each image that is not padding, as [batch_size x 2] (w, h) ratios"""
+        _, H, W = mask.shape
+        valid_H = torch.sum(~mask[:, :, 0], 1)
+        valid_W = torch.sum(~mask[:, 0, :], 1)
+        return torch.stack([valid_W.float() / W, valid_H.float() / H], -1)
+
+    def forward(self, src, mask, query_embed, pos_embed):
+        # flatten NxCxHxW to NxHWxC
+        bs, c, h, w = src.shape
+        spatial_shapes = [(h, w)]
+        valid_ratios = self.get_valid_ratio(mask)[:, None]
+        src = src.flatten(2).transpose(1, 2)
+        pos_embed = pos_embed.flatten(2).transpose(1, 2)
+        mask = mask.flatten(1)
+        query_embed = query_embed.unsqueeze(0).repeat(bs, 1, 1)
+
+        memory = self.encoder(src, spatial_shapes, valid_ratios, pos=pos_embed, padding_mask=mask)
+
+        tgt = torch.zeros_like(query_embed)
+        reference_points = self.reference_points(query_embed).sigmoid()
+        hs = self.decoder(tgt, reference_points, memory, spatial_shapes, valid_ratios,
+                          query_pos=query_embed, memory_padding_mask=mask)
+        return hs, memory.transpose(1, 2).view(bs, c, h, w)
+
+    @torch.jit.unused
+    def forward_early_exit(self, src, mask, query_embed, pos_embed, class_embed, max_layers=0, threshold=0.0):
+        """ Inference only decoding, that runs the decoder one layer at a time.
+        See Transformer.forward_early_exit for the exit criteria.
+        """
+        bs = src.shape[0]
+        spatial_shapes = [(src.shape[-2], src.shape[-1])]
+        valid_ratios = self.get_valid_ratio(mask)[:, None]
+        src = src.flatten(2).transpose(1, 2)
+        pos_embed = pos_embed.flatten(2).transpose(1, 2)
+        mask = mask.flatten(1)
+        query_embed = query_embed.unsqueeze(0).repeat(bs, 1, 1)
+
+        memory = self.encoder(src, spatial_shapes, valid_ratios, pos=pos_embed, padding_mask=mask)
+
+        decoder = self.decoder
+        reference_points = self.reference_points(query_embed).sigmoid()[:, :, None] * valid_ratios[:, None]
+        num_layers = decoder.num_layers if max_layers <= 0 else min(max_layers, decoder.num_layers)
+        output = torch.zeros_like(query_embed)
+        prev_scores = None
+        for i in range(num_layers):
+            output = decoder.layers[i](output, query_embed, reference_points, memory, spatial_shapes, mask)
+            if threshold > 0 and i < num_layers - 1:
+                scores = class_embed(decoder.norm(output)).softmax(-1)[..., :-1].max(-1)[0]
+                if prev_scores is not None and (scores - prev_scores).abs().max() < threshold:
+                    num_layers = i + 1
+                    break
+                prev_scores = scores
+
+        return decoder.norm(output), num_layers
+
+
+class DeformableTransformerEncoder(nn.Module):
+
+    def __init__(self, encoder_layer, num_layers):
+        super().__init__()
+        self.layers = _get_clones(encoder_layer, num_layers)
+        self.num_layers = num_layers
+
+    @staticmethod
+    def get_reference_points(spatial_shapes: List[Tuple[int, int]], valid_ratios, device: torch.device):
+        # one reference point at the center of each (unpadded) pixel, normalized by the valid image size
+        reference_points_list = []
+        for lvl, (h, w) in enumerate(spatial_shapes):
+            ref_y, ref_x = torch.meshgrid(torch.linspace(0.5, h - 0.5, h, dtype=torch.float32, device=device),
+                                          torch.linspace(0.5, w - 0.5, w, dtype=torch.float32, device=device))
+            ref_y = ref_y.reshape(-1)[None] / (valid_ratios[:, None, lvl, 1] * h)
+            ref_x = ref_x.reshape(-1)[None] / (valid_ratios[:, None, lvl, 0] * w)
+            reference_points_list.append(torch.stack((ref_x, ref_y), -1))
+        reference_points = torch.cat(reference_points_list, 1)
+        return reference_points[:, :, None] * valid_ratios[:, None]
+
+    def forward(self, src, spatial_shapes: List[Tuple[int, int]], valid_ratios,
+                pos: Optional[Tensor] = None,
+                padding_mask: Optional[Tensor] = None):
+        output = src
+        reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
+        for layer in self.layers:
+            output = layer(output, pos, reference_points, spatial_shapes, padding_mask)
+
+        return output
+
+
+class DeformableTransformerDecoder(nn.Module):
+
+    def __init__(self, decoder_layer, num_layers, norm=None, return_intermediate=False):
+        super().__init__()
+        self.layers = _get_clones(decoder_layer, num_layers)
+        self.num_layers = num_layers
+        self.norm = norm
+        self.return_intermediate = return_intermediate
+
+    def forward(self, tgt, reference_points, memory, spatial_shapes: List[Tuple[int, int]], valid_ratios,
+                query_pos: Optional[Tensor] = None,
+                memory_padding_mask: Optional[Tensor] = None):
+        output = tgt
+        reference_points_input = reference_points[:, :, None] * valid_ratios[:, None]
+
+        intermediate = []
+
+        for layer in self.layers:
+            output = layer(output, query_pos, reference_points_input, memory, spatial_shapes, memory_padding_mask)
+            if self.return_intermediate:
+                intermediate.append(self.norm(output))
+
+        if self.norm is not None:
+            output = self.norm(output)
+            if self.return_intermediate:
+                intermediate.pop()
+                intermediate.append(output)
+
+        if self.return_intermediate:
+            return torch.stack(intermediate)
+
+        return output.unsqueeze(0)
+
+
+class DeformableTransformerEncoderLayer(nn.Module):
+
+    def __init__(self, d_model, nhead, dim_feedforward=1024, dropout=0.1,
+                 activation="relu", n_levels=1, n_points=4):
+        super().__init__()
+        self.self_attn = MSDeformAttn(d_model, n_levels, nhead, n_points)
+        # Implementation of Feedforward model
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.dropout = nn.Dropout(dropout)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+
+        self.activation = _get_activation_fn(activation)
+
+    def with_pos_embed(self, tensor, pos: Optional[Tensor]):
+        return tensor if pos is None else tensor + pos
+
+    def forward(self, src, pos: Optional[Tensor], reference_points, spatial_shapes: List[Tuple[int, int]],
+                padding_mask: Optional[Tensor] = None):
+        src2 = self.self_attn(self.with_pos_embed(src, pos), reference_points, src, spatial_shapes, padding_mask)
+        src = src + self.dropout1(src2)
+        src = self.norm1(src)
+        src2 = self.linear2(self.dropout(self.activation(self.linear1(src))))
+        src = src + self.dropout2(src2)
+        src = self.norm2(src)
+        return src
+
+
+class DeformableTransformerDecoderLayer(nn.Module):
+
+    def __init__(self, d_model, nhead, dim_feedforward=1024, dropout=0.1,
+                 activation="relu", n_levels=1, n_points=4):
+        super().__init__()
+        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.cross_attn = MSDeformAttn(d_model, n_levels, nhead, n_points)
+        # Implementation of Feedforward model
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.dropout = nn.Dropout(dropout)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.norm3 = nn.LayerNorm(d_model)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+        self.dropout3 = nn.Dropout(dropout)
+
+        self.activation = _get_activation_fn(activation)
+
+    def with_pos_embed(self, tensor, pos: Optional[Tensor]):
+        return tensor if pos is None else tensor + pos
+
+    def forward(self, tgt, query_pos: Optional[Tensor], reference_points, memory,
+                spatial_shapes: List[Tuple[int, int]],
+                memory_padding_mask: Optional[Tensor] = None):
+        # dense self-attention between the queries, nn.MultiheadAttention expects [seq, batch, dim]
+        q = k = self.with_pos_embed(tgt, query_pos).transpose(0, 1)
+        tgt2 = self.self_attn(q, k, value=tgt.transpose(0, 1))[0].transpose(0, 1)
+        tgt = tgt + self.dropout1(tgt2)
+        tgt = self.norm1(tgt)
+        tgt2 = self.cross_attn(self.with_pos_embed(tgt, query_pos), reference_points, memory, spatial_shapes,
+                               memory_padding_mask)
+        tgt = tgt + self.dropout2(tgt2)
+        tgt = self.norm2(tgt)
+        tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt))))
+        tgt = tgt + self.dropout3(tgt2)
+        tgt = self.norm3(tgt)
+        return tgt
+
+
+class MSDeformAttn(nn.Module):
+    """
+    Multi-scale deformable attention: each query attends to n_points sampled locations per head and per
+    feature level, at learned offsets from its reference point.
+    """
+
+    def __init__(self, d_model=256, n_levels=1, n_heads=8, n_points=4):
+        super().__init__()
+        assert d_model % n_heads == 0, "d_model must be divisible by n_heads"
+        self.d_model = d_model
+        self.n_levels = n_levels
+        self.n_heads = n_heads
+        self.n_points = n_points
+
+        self.sampling_offsets = nn.Linear(d_model, n_heads * n_levels * n_points * 2)
+        self.attention_weights = nn.Linear(d_model, n_heads * n_levels * n_points)
+        self.value_proj = nn.Linear(d_model, d_model)
+        self.output_proj = nn.Linear(d_model, d_model)
+
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        # initially, the sampling points of each head are spread along a different direction
+        nn.init.constant_(self.sampling_offsets.weight, 0.)
+        thetas = torch.arange(self.n_heads, dtype=torch.float32) * (2.0 * math.pi / self.n_heads)
+        grid_init = torch.stack([thetas.cos(), thetas.sin()], -1)
+        grid_init = (grid_init / grid_init.abs().max(-1, keepdim=True)[0]).view(self.n_heads, 1, 1, 2)
+        grid_init = grid_init.repeat(1, self.n_levels, self.n_points, 1)
+        for i in range(self.n_points):
+            grid_init[:, :, i, :] *= i + 1
+        with torch.no_grad():
+            self.sampling_offsets.bias.copy_(grid_init.view(-1))
+        nn.init.constant_(self.attention_weights.weight, 0.)
+        nn.init.constant_(self.attention_weights.bias, 0.)
+        nn.init.xavier_uniform_(self.value_proj.weight)
+        nn.init.constant_(self.value_proj.bias, 0.)
+        nn.init.xavier_uniform_(self.output_proj.weight)
+        nn.init.constant_(self.output_proj.bias, 0.)
+
+    def forward(self, query, reference_points, input_flatten, spatial_shapes: List[Tuple[int, int]],
+                input_padding_mask: Optional[Tensor] = None):
+        """
+        Parameters:
+            query: [batch_size x num_queries x d_model]
+            reference_points: [batch_size x num_queries x n_levels x 2], normalized (x, y) in [0, 1]
+            input_flatten: [batch_size x sum_l(H_l * W_l) x d_model], the flattened feature levels
+            spatial_shapes: list of the (H_l, W_l) of each feature level
+            input_padding_mask: [batch_size x sum_l(H_l * W_l)], True on padded pixels
+        """
+        N, Lq, _ = query.shape
+        value = self.value_proj(input_flatten)
+        if input_padding_mask is not None:
+            value = value.masked_fill(input_padding_mask[..., None], 0.)
+        value = value.view(N, value.shape[1], self.n_heads, self.d_model // self.n_heads)
+
+        sampling_offsets = self.sampling_offsets(query).view(N, Lq, self.n_heads, self.n_levels, self.n_points, 2)
+        attention_weights = self.attention_weights(query).view(N, Lq, self.n_heads, self.n_levels * self.n_points)
+        attention_weights = F.softmax(attention_weights, -1).view(N, Lq, self.n_heads, self.n_levels, self.n_points)
+
+        # the offsets are expressed in pixels of each feature level
+        offset_normalizer = torch.tensor([[w, h] for h, w in spatial_shapes], dtype=query.dtype, device=query.device)
+        sampling_locations = reference_points[:, :, None, :, None, :] \
+            + sampling_offsets / offset_normalizer[None, None, None, :, None, :]
+
+        output = ms_deform_attn_core(value, spatial_shapes, sampling_locations, attention_weights)
+        return self.output_proj(output)
+
+
+def ms_deform_attn_core(value, spatial_shapes: List[Tuple[int, int]], sampling_locations, attention_weights):
+    """
+    Pure PyTorch multi-scale deformable attention.
+    Parameters:
+        value: [N x sum_l(H_l * W_l) x n_heads x head_dim]
+        spatial_shapes: list of the (H_l, W_l) of each feature level
+        sampling_locations: [N x num_queries x n_heads x n_levels x n_points x 2], normalized in [0, 1]
+        attention_weights: [N x num_queries x n_heads x n_levels x n_points]
+    Returns a [N x num_queries x (n_heads * head_dim)] tensor
+    """
+    N, _, M, D = value.shape
+    _, Lq, _, L, P, _ = sampling_locations.shape
+    value_list = value.split([h * w for h, w in spatial_shapes], dim=1)
+    # grid_sample expects coordinates in [-1, 1], in the dtype of the values (they may differ under autocast)
+    sampling_grids = (2 * sampling_locations - 1).to(value.dtype)
+    sampling_value_list = []
+    for lvl, (h, w) in enumerate(spatial_shapes):
+        # N x H_l*W_l x M x D -> N*M x D x H_l x W_l
+        value_l = value_list[lvl].flatten(2).transpose(1, 2).reshape(N * M, D, h, w)
+        # N x Lq x M x P x 2 -> N*M x Lq x P x 2
+        sampling_grid_l = sampling_grids[:, :, :, lvl].transpose(1, 2).flatten(0, 1)
+        # N*M x D x Lq x P
+        sampling_value_list.append(F.grid_sample(value_l, sampling_grid_l, mode="bilinear",
+                                                 padding_mode="zeros", align_corners=False))
+    # N x Lq x M x L x P -> N*M x 1 x Lq x L*P
+    attention_weights = attention_weights.transpose(1, 2).reshape(N * M, 1, Lq, L * P)
+    output = (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights).sum(-1)
+    return output.view(N, M * D, Lq).transpose(1, 2).contiguous()
+
+
+def build_deformable_transformer(args):
+    if args.pre_norm:
+        raise ValueError("the deformable transformer only supports post-normalization, drop --pre_norm")
+    return DeformableTransformer(
+        d_model=args.hidden_dim,
+        dropout=args.dropout,
+        nhead=args.nheads,
+        dim_feedforward=args.dim_feedforward,
+        num_encoder_layers=args.enc_layers,
+        num_decoder_layers=args.dec_layers,
+        return_intermediate_dec=True,
+        enc_n_points=args.enc_n_points,
+        dec_n_points=args.dec_n_points,
+    )
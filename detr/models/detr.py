@@ -2,9 +2,11 @@
 """
 DETR model and criterion classes.
 """
+from typing import Dict
+
 import torch
 import torch.nn.functional as F
-from torch import nn
+from torch import nn, Tensor
 
 from util import box_ops
 from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
@@ -14,13 +16,14 @@ from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
 from .backbone import build_backbone
 from .matcher import build_matcher
 from .segmentation import (DETRsegm, PostProcessPanoptic, PostProcessSegm,
-                           dice_loss, sigmoid_focal_loss)
+                           dice_loss, get_uncertain_point_coords, point_sample, sigmoid_focal_loss)
 from .transformer import build_transformer
 
 
 class DETR(nn.Module):
     """ This is the DETR module that performs object detection """
-    def __init__(self, backbone, transformer, num_classes, num_queries, aux_loss=False):
+    def __init__(self, backbone, transformer, num_classes, num_queries, aux_loss=False,
+                 exit_dec_layers=0, exit_threshold=0.0):
         """ Initializes the model.
         Parameters:
             backbone: torch module of the backbone to be used. See backbone.py
@@ -29,6 +32,10 @@ class DETR(nn.Module):
             num_queries: number of object queries, ie detection slot. This is the maximal number of objects
                          DETR can detect in a single image. For COCO, we recommend 100 queries.
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
+            exit_dec_layers: at inference, only run the first exit_dec_layers decoder layers (0 for all).
+            exit_threshold: at inference, stop decoding as soon as the class confidences of all queries change
+                            by less than exit_threshold between two decoder layers (0 to disable).
+                            Neither option returns aux_outputs. See calibrate_early_exit.py to pick them.
         """
         super().__init__()
         self.num_queries = num_queries
@@ -40,6 +47,8 @@ class DETR(nn.Module):
         self.input_proj = nn.Conv2d(backbone.num_channels, hidden_dim, kernel_size=1)
         self.backbone = backbone
         self.aux_loss = aux_loss
+        self.exit_dec_layers = exit_dec_layers
+        self.exit_threshold = exit_threshold
 
     def forward(self, samples: NestedTensor):
         """ The forward expects a NestedTensor, which consists of:
@@ -62,7 +71,12 @@ class DETR(nn.Module):
 
         src, mask = features[-1].decompose()
         assert mask is not None
+        if not self.training and (self.exit_dec_layers > 0 or self.exit_threshold > 0):
+            return self._forward_early_exit(self.input_proj(src), mask, pos[-1])
         hs = self.transformer(self.input_proj(src), mask, self.query_embed.weight, pos[-1])[0]
+        if not self.aux_loss:
+            # the intermediate decoder outputs are only used by the auxiliary losses
+            hs = hs[-1:]
 
         outputs_class = self.class_embed(hs)
         outputs_coord = self.bbox_embed(hs).sigmoid()
@@ -71,6 +85,12 @@ class DETR(nn.Module):
             out['aux_outputs'] = self._set_aux_loss(outputs_class, outputs_coord)
         return out
 
+    @torch.jit.unused
+    def _forward_early_exit(self, src, mask, pos) -> Dict[str, Tensor]:
+        hs, _ = self.transformer.forward_early_exit(src, mask, self.query_embed.weight, pos, self.class_embed,
+                                                    max_layers=self.exit_dec_layers, threshold=self.exit_threshold)
+        return {'pred_logits': self.class_embed(hs), 'pred_boxes': self.bbox_embed(hs).sigmoid()}
+
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, outputs_coord):
         # this is a workaround to make torchscript happy, as torchscript
@@ -86,7 +106,8 @@ class SetCriterion(nn.Module):
         1) we compute hungarian assignment between ground truth boxes and the outputs of the model
         2) we supervise each pair of matched ground-truth / prediction (supervise class and box)
     """
-    def __init__(self, num_classes, matcher, weight_dict, eos_coef, losses):
+    def __init__(self, num_classes, matcher, weight_dict, eos_coef, losses, aux_match_interval=1, fused_layers=False,
+                 mask_points=0):
         """ Create the criterion.
         Parameters:
             num_classes: number of object categories, omitting the special no-object category
@@ -94,6 +115,14 @@ class SetCriterion(nn.Module):
             weight_dict: dict containing as key the names of the losses and as values their relative weight.
             eos_coef: relative classification weight applied to the no-object category
             losses: list of all the losses to be applied. See get_loss for list of available losses.
+            aux_match_interval: how often the auxiliary outputs are matched to the targets. With 1, every decoder
+                                layer is matched. With N > 1, every N-th layer counting back from the last one is
+                                matched, and the layers in between reuse the matching of the next matched layer.
+                                With 0, all the layers reuse the matching of the last layer.
+            fused_layers: compute the labels, cardinality and boxes losses of all the decoder layers
+                          in a single batched pass, see fused_losses. The returned losses are the same.
+            mask_points: if > 0, the mask losses are computed on this number of points per mask, sampled around
+                         the uncertain regions of the predicted masks, instead of on every pixel.
         """
         super().__init__()
         self.num_classes = num_classes
@@ -101,6 +130,9 @@ class SetCriterion(nn.Module):
         self.weight_dict = weight_dict
         self.eos_coef = eos_coef
         self.losses = losses
+        self.aux_match_interval = aux_match_interval
+        self.fused_layers = fused_layers
+        self.mask_points = mask_points
         empty_weight = torch.ones(self.num_classes + 1)
         empty_weight[-1] = self.eos_coef
         self.register_buffer('empty_weight', empty_weight)
@@ -155,9 +187,9 @@ class SetCriterion(nn.Module):
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.paired_generalized_box_iou(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
         losses['loss_giou'] = loss_giou.sum() / num_boxes
         return losses
 
@@ -166,6 +198,8 @@ class SetCriterion(nn.Module):
            targets dicts must contain the key "masks" containing a tensor of dim [nb_target_boxes, h, w]
         """
         assert "pred_masks" in outputs
+        if self.mask_points > 0:
+            return self.loss_masks_points(outputs, targets, indices, num_boxes)
 
         src_idx = self._get_src_permutation_idx(indices)
         tgt_idx = self._get_tgt_permutation_idx(indices)
@@ -190,6 +224,93 @@ class SetCriterion(nn.Module):
         }
         return losses
 
+    def loss_masks_points(self, outputs, targets, indices, num_boxes):
+        """Same losses as loss_masks, computed on self.mask_points points per mask instead of on every pixel.
+           The target masks are neither padded nor upsampled, they are only sampled at the chosen points.
+        """
+        src_idx = self._get_src_permutation_idx(indices)
+        src_masks = outputs["pred_masks"][src_idx]
+
+        # As in loss_masks, the predicted masks span the target masks padded to the largest one of the batch
+        max_h = max(t["masks"].shape[-2] for t in targets)
+        max_w = max(t["masks"].shape[-1] for t in targets)
+        point_coords = get_uncertain_point_coords(src_masks, self.mask_points)
+        with torch.no_grad():
+            point_labels = []
+            point_coords_per_image = point_coords.split([len(J) for _, J in indices])
+            for t, (_, J), coords in zip(targets, indices, point_coords_per_image):
+                h, w = t["masks"].shape[-2:]
+                # coordinates relative to the unpadded target mask, the points in the padding get 0
+                scale = coords.new_tensor([max_w / w, max_h / h])
+                point_labels.append(point_sample(t["masks"][J][:, None].to(src_masks), coords * scale)[:, 0])
+            point_labels = torch.cat(point_labels)
+        point_logits = point_sample(src_masks[:, None], point_coords)[:, 0]
+
+        losses = {
+            "loss_mask": sigmoid_focal_loss(point_logits, point_labels, num_boxes),
+            "loss_dice": dice_loss(point_logits, point_labels, num_boxes),
+        }
+        return losses
+
+    def fused_losses(self, layer_outputs, targets, layer_indices, num_boxes):
+        """ Computes the labels, cardinality and boxes losses of all the decoder layers at once, by stacking
+        their outputs into [num_layers, batch_size, num_queries, ...] tensors.
+        Parameters:
+            layer_outputs: list of the outputs of each decoder layer, the final outputs being the last one
+            layer_indices: list of the matching of each decoder layer
+        Returns the list of the losses of each decoder layer, with the same keys as get_loss.
+        As in forward, class_error is only logged for the last layer.
+        """
+        num_layers = len(layer_outputs)
+        src_logits = torch.stack([o['pred_logits'] for o in layer_outputs])
+        device = src_logits.device
+        layer_losses = [{} for _ in range(num_layers)]
+
+        # The permutation indices of all the layers, with their layer as leading index
+        layer_idx = torch.cat([torch.full_like(src, layer) for layer, indices in enumerate(layer_indices)
+                               for src, _ in indices]).to(device)
+        batch_idx, src_idx = zip(*[self._get_src_permutation_idx(indices) for indices in layer_indices])
+        idx = (layer_idx, torch.cat(batch_idx).to(device), torch.cat(src_idx).to(device))
+
+        if 'labels' in self.losses:
+            target_classes_o = torch.cat([t["labels"][J] for indices in layer_indices
+                                          for t, (_, J) in zip(targets, indices)])
+            target_classes = torch.full(src_logits.shape[:3], self.num_classes, dtype=torch.int64, device=device)
+            target_classes[idx] = target_classes_o
+            # the weighted mean of F.cross_entropy, taken over each layer separately
+            loss_ce = F.cross_entropy(src_logits.permute(0, 3, 1, 2), target_classes, self.empty_weight,
+                                      reduction='none')
+            loss_ce = loss_ce.sum((1, 2)) / self.empty_weight[target_classes].sum((1, 2))
+            for layer in range(num_layers):
+                layer_losses[layer]['loss_ce'] = loss_ce[layer]
+            last = layer_idx == num_layers - 1
+            layer_losses[-1]['class_error'] = 100 - accuracy(src_logits[idx][last], target_classes_o[last])[0]
+
+        if 'boxes' in self.losses:
+            src_boxes = torch.stack([o['pred_boxes'] for o in layer_outputs])[idx]
+            target_boxes = torch.cat([t['boxes'][i] for indices in layer_indices
+                                      for t, (_, i) in zip(targets, indices)], dim=0)
+            loss_bbox = F.l1_loss(src_boxes, target_boxes, reduction='none').sum(1)
+            loss_giou = 1 - box_ops.paired_generalized_box_iou(
+                box_ops.box_cxcywh_to_xyxy(src_boxes),
+                box_ops.box_cxcywh_to_xyxy(target_boxes))
+            # sum the losses of the matched pairs of each layer
+            loss_bbox = loss_bbox.new_zeros(num_layers).index_add(0, layer_idx, loss_bbox) / num_boxes
+            loss_giou = loss_giou.new_zeros(num_layers).index_add(0, layer_idx, loss_giou) / num_boxes
+            for layer in range(num_layers):
+                layer_losses[layer]['loss_bbox'] = loss_bbox[layer]
+                layer_losses[layer]['loss_giou'] = loss_giou[layer]
+
+        if 'cardinality' in self.losses:
+            with torch.no_grad():
+                tgt_lengths = torch.as_tensor([len(v["labels"]) for v in targets], device=device)
+                card_pred = (src_logits.argmax(-1) != src_logits.shape[-1] - 1).sum(2)
+                card_err = (card_pred.float() - tgt_lengths.float()).abs().mean(1)
+            for layer in range(num_layers):
+                layer_losses[layer]['cardinality_error'] = card_err[layer]
+
+        return layer_losses
+
     def _get_src_permutation_idx(self, indices):
         # permute predictions following indices
         batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
@@ -231,32 +352,65 @@ class SetCriterion(nn.Module):
             torch.distributed.all_reduce(num_boxes)
         num_boxes = torch.clamp(num_boxes / get_world_size(), min=1).item()
 
+        # In case of auxiliary losses, the outputs of each intermediate layer are matched as well
+        aux_outputs = outputs.get('aux_outputs', [])
+        aux_indices = self._match_aux_outputs(aux_outputs, targets, indices)
+
+        if self.fused_layers:
+            layer_losses = self.fused_losses(aux_outputs + [outputs_without_aux], targets,
+                                             aux_indices + [indices], num_boxes)
+            losses = layer_losses.pop()
+            if 'masks' in self.losses:
+                losses.update(self.get_loss('masks', outputs, targets, indices, num_boxes))
+            for i, l_dict in enumerate(layer_losses):
+                losses.update({k + f'_{i}': v for k, v in l_dict.items()})
+            return losses
+
         # Compute all the requested losses
         losses = {}
         for loss in self.losses:
             losses.update(self.get_loss(loss, outputs, targets, indices, num_boxes))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
-        if 'aux_outputs' in outputs:
-            for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = self.matcher(aux_outputs, targets)
-                for loss in self.losses:
-                    if loss == 'masks':
-                        # Intermediate masks losses are too costly to compute, we ignore them.
-                        continue
-                    kwargs = {}
-                    if loss == 'labels':
-                        # Logging is enabled only for the last layer
-                        kwargs = {'log': False}
-                    l_dict = self.get_loss(loss, aux_outputs, targets, indices, num_boxes, **kwargs)
-                    l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
-                    losses.update(l_dict)
+        for i, (aux_outputs_i, indices_i) in enumerate(zip(aux_outputs, aux_indices)):
+            for loss in self.losses:
+                if loss == 'masks':
+                    # Intermediate masks losses are too costly to compute, we ignore them.
+                    continue
+                kwargs = {}
+                if loss == 'labels':
+                    # Logging is enabled only for the last layer
+                    kwargs = {'log': False}
+                l_dict = self.get_loss(loss, aux_outputs_i, targets, indices_i, num_boxes, **kwargs)
+                l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
+                losses.update(l_dict)
 
         return losses
 
+    def _match_aux_outputs(self, aux_outputs, targets, indices):
+        # The layers are visited from the last one backwards, so that skipped layers reuse the closest deeper matching
+        aux_indices = [indices] * len(aux_outputs)
+        for i in reversed(range(len(aux_outputs))):
+            if self.aux_match_interval > 0 and (len(aux_outputs) - i) % self.aux_match_interval == 0:
+                indices = self.matcher(aux_outputs[i], targets)
+            aux_indices[i] = indices
+        return aux_indices
+
 
 class PostProcess(nn.Module):
     """ This module converts the model's output into the format expected by the coco api"""
+    def __init__(self, top_k=0, score_threshold=0.0):
+        """ Parameters:
+            top_k: if > 0, only keep the top_k highest scoring (query, class) pairs of each image, so that a query
+                   can give several detections of different classes. Otherwise each query gives one detection,
+                   with its highest scoring class
+            score_threshold: drop the detections with a lower score
+        When filtering, the results also contain the "query_ids" the kept detections come from.
+        """
+        super().__init__()
+        self.top_k = top_k
+        self.score_threshold = score_threshold
+
     @torch.no_grad()
     def forward(self, outputs, target_sizes):
         """ Perform the computation
@@ -271,8 +425,16 @@ class PostProcess(nn.Module):
         assert len(out_logits) == len(target_sizes)
         assert target_sizes.shape[1] == 2
 
-        prob = F.softmax(out_logits, -1)
-        scores, labels = prob[..., :-1].max(-1)
+        prob = F.softmax(out_logits, -1)[..., :-1]
+        if self.top_k > 0:
+            num_classes = prob.shape[-1]
+            scores, index = prob.flatten(1).topk(min(self.top_k, prob[0].numel()), dim=1)
+            query_ids = torch.div(index, num_classes, rounding_mode='floor')
+            labels = index % num_classes
+            out_bbox = out_bbox.gather(1, query_ids.unsqueeze(-1).expand(-1, -1, 4))
+        else:
+            scores, labels = prob.max(-1)
+            query_ids = torch.arange(prob.shape[1], device=prob.device).expand(len(prob), -1)
 
         # convert to [x0, y0, x1, y1] format
         boxes = box_ops.box_cxcywh_to_xyxy(out_bbox)
@@ -281,11 +443,29 @@ class PostProcess(nn.Module):
         scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
         boxes = boxes * scale_fct[:, None, :]
 
-        results = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
+        if self.top_k <= 0 and self.score_threshold <= 0:
+            return [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
+
+        keep = scores >= self.score_threshold
+        results = [{'scores': s[k], 'labels': l[k], 'boxes': b[k], 'query_ids': q[k]}
+                   for s, l, b, q, k in zip(scores, labels, boxes, query_ids, keep)]
 
         return results
 
 
+def prune_queries(state_dict, query_indices):
+    """ Returns a copy of a DETR (or DETRsegm) state dict that only keeps the given object queries.
+    The model loading it must be built with num_queries = len(query_indices).
+    Note that the queries interact in the decoder self-attention, so the pruned model should be fine-tuned.
+    """
+    state_dict = dict(state_dict)
+    query_indices = torch.as_tensor(query_indices, dtype=torch.int64)
+    for key in ('query_embed.weight', 'detr.query_embed.weight'):
+        if key in state_dict:
+            state_dict[key] = state_dict[key][query_indices].clone()
+    return state_dict
+
+
 class MLP(nn.Module):
     """ Very simple multi-layer perceptron (also called FFN)"""
 
@@ -327,9 +507,12 @@ def build(args):
         num_classes=num_classes,
         num_queries=args.num_queries,
         aux_loss=args.aux_loss,
+        exit_dec_layers=args.exit_dec_layers,
+        exit_threshold=args.exit_threshold,
     )
     if args.masks:
-        model = DETRsegm(model, freeze_detr=(args.frozen_weights is not None))
+        model = DETRsegm(model, freeze_detr=(args.frozen_weights is not None),
+                         mask_score_threshold=args.mask_score_threshold)
     matcher = build_matcher(args)
     weight_dict = {'loss_ce': 1, 'loss_bbox': args.bbox_loss_coef}
     weight_dict['loss_giou'] = args.giou_loss_coef
@@ -347,13 +530,16 @@ def build(args):
     if args.masks:
         losses += ["masks"]
     criterion = SetCriterion(num_classes, matcher=matcher, weight_dict=weight_dict,
-                             eos_coef=args.eos_coef, losses=losses)
+                             eos_coef=args.eos_coef, losses=losses, aux_match_interval=args.aux_match_interval,
+                             fused_layers=args.fused_loss, mask_points=args.mask_points)
     criterion.to(device)
-    postprocessors = {'bbox': PostProcess()}
+    postprocessors = {'bbox': PostProcess(top_k=args.postprocess_top_k,
+                                          score_threshold=args.postprocess_score_threshold)}
     if args.masks:
-        postprocessors['segm'] = PostProcessSegm()
+        postprocessors['segm'] = PostProcessSegm(paste_in_boxes=args.segm_paste_in_boxes, rle=args.segm_rle)
         if args.dataset_file == "coco_panoptic":
             is_thing_map = {i: i <= 90 for i in range(201)}
-            postprocessors["panoptic"] = PostProcessPanoptic(is_thing_map, threshold=0.85)
+            postprocessors["panoptic"] = PostProcessPanoptic(is_thing_map, threshold=0.85,
+                                                             num_threads=args.panoptic_threads)
 
     return model, criterion, postprocessors
@@ -0,0 +1,84 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+ONNX export of DETR, with the post-processing of PostProcess included in the graph, so that the
+exported model returns final detections and can be deployed with onnxruntime alone.
+"""
+import inspect
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from util import box_ops
+from util.misc import NestedTensor
+
+from .detr import DETR
+
+INPUT_NAMES = ("images", "target_sizes")
+OUTPUT_NAMES = ("scores", "labels", "boxes")
+
+
+class ExportableDETR(nn.Module):
+    """
+    Wraps DETR so that it takes plain tensors and returns the detections in the format of PostProcess.
+    Inputs:
+        images: float tensor of dimension [batch_size x 3 x H x W], normalized as in datasets/coco.py.
+                The images of a batch must share the same size, as no padding mask is given to the model
+        target_sizes: int64 tensor of dimension [batch_size x 2], the (height, width) boxes are scaled to
+    Outputs:
+        scores, labels: tensors of dimension [batch_size x K]
+        boxes: tensor of dimension [batch_size x K x 4], in absolute (x0, y0, x1, y1) coordinates
+    K is num_queries, or top_k when it is set, in which case the detections are sorted by decreasing score.
+    """
+    def __init__(self, model, top_k=0):
+        super().__init__()
+        if top_k > model.num_queries:
+            raise ValueError("top_k ({}) is larger than num_queries ({})".format(top_k, model.num_queries))
+        self.model = model
+        self.top_k = top_k
+
+    def forward(self, images, target_sizes):
+        # the images are not padded, building the NestedTensor directly keeps the batch size dynamic
+        mask = torch.zeros_like(images[:, 0], dtype=torch.bool)
+        outputs = self.model(NestedTensor(images, mask))
+        out_logits, out_bbox = outputs['pred_logits'], outputs['pred_boxes']
+
+        prob = F.softmax(out_logits, -1)
+        scores, labels = prob[..., :-1].max(-1)
+
+        boxes = box_ops.box_cxcywh_to_xyxy(out_bbox)
+        img_h, img_w = target_sizes.to(boxes.dtype).unbind(1)
+        scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
+        boxes = boxes * scale_fct[:, None, :]
+
+        if self.top_k > 0:
+            scores, index = scores.topk(self.top_k, dim=1)
+            labels = labels.gather(1, index)
+            boxes = boxes.gather(1, index.unsqueeze(-1).expand(-1, -1, 4))
+        return scores, labels, boxes
+
+
+def export_onnx(model, f, top_k=0, opset_version=12, image_size=(800, 800)):
+    """
+    Exports model, a DETR detection model, to f (a path or a file-like object) with dynamic batch,
+    height and width axes. Returns the ExportableDETR wrapper that was exported.
+    """
+    if not isinstance(model, DETR):
+        raise ValueError("Only detection models can be exported, got {}".format(type(model).__name__))
+    if model.exit_dec_layers or model.exit_threshold:
+        raise ValueError("Early exit is data dependent and cannot be exported, "
+                         "set exit_dec_layers and exit_threshold to 0")
+    wrapper = ExportableDETR(model, top_k).eval()
+    images = torch.rand(1, 3, *image_size)
+    target_sizes = torch.tensor([image_size], dtype=torch.int64)
+    dynamic_axes = {"images": {0: "batch", 2: "height", 3: "width"}, "target_sizes": {0: "batch"}}
+    dynamic_axes.update({name: {0: "batch"} for name in OUTPUT_NAMES})
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # torch.export specializes the shapes of DETR, use the TorchScript based exporter
+        kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(wrapper, (images, target_sizes), f, input_names=list(INPUT_NAMES),
+                          output_names=list(OUTPUT_NAMES), dynamic_axes=dynamic_axes,
+                          opset_version=opset_version, do_constant_folding=True, **kwargs)
+    return wrapper
@@ -2,12 +2,24 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from scipy.optimize import linear_sum_assignment
 from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 
 from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
 
+_executors = {}
+
+
+def _get_executor(num_threads):
+    # shared across matchers, and kept out of the module so that it can still be deep-copied and pickled
+    if num_threads not in _executors:
+        _executors[num_threads] = ThreadPoolExecutor(num_threads, thread_name_prefix="matcher")
+    return _executors[num_threads]
+
 
 class HungarianMatcher(nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
@@ -17,20 +29,57 @@ class HungarianMatcher(nn.Module):
     while the others are un-matched (and thus treated as non-objects).
     """
 
-    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1):
+    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1, num_threads: int = 0):
         """Creates the matcher
 
         Params:
             cost_class: This is the relative weight of the classification error in the matching cost
             cost_bbox: This is the relative weight of the L1 error of the bounding box coordinates in the matching cost
             cost_giou: This is the relative weight of the giou loss of the bounding box in the matching cost
+            num_threads: Number of threads the per-image LSAPs are solved in, 0 or 1 to solve them serially.
+                         scipy releases the GIL while solving, so the images of a batch are matched in parallel
         """
         super().__init__()
         self.cost_class = cost_class
         self.cost_bbox = cost_bbox
         self.cost_giou = cost_giou
+        self.num_threads = num_threads
         assert cost_class != 0 or cost_bbox != 0 or cost_giou != 0, "all costs cant be 0"
 
+    @torch.no_grad()
+    def cost_matrix(self, outputs, targets):
+        """ Computes the matching cost of each image with its own targets only
+
+        Params:
+            outputs, targets: as in forward
+
+        Returns:
+            A tensor of dim [batch_size, num_queries, max_num_target_boxes], where the targets of each image are
+            padded to the largest number of targets in the batch. The padded columns are meaningless.
+        """
+        bs, num_queries = outputs["pred_logits"].shape[:2]
+
+        out_prob = outputs["pred_logits"].softmax(-1)  # [batch_size, num_queries, num_classes]
+        out_bbox = outputs["pred_boxes"]  # [batch_size, num_queries, 4]
+
+        # Pad the target labels and boxes of each image, so that the costs are computed in a batch
+        tgt_ids = pad_sequence([v["labels"] for v in targets], batch_first=True)  # [batch_size, max_num_targets]
+        tgt_bbox = pad_sequence([v["boxes"] for v in targets], batch_first=True)  # [batch_size, max_num_targets, 4]
+
+        # Compute the classification cost. Contrary to the loss, we don't use the NLL,
+        # but approximate it in 1 - proba[target class].
+        # The 1 is a constant that doesn't change the matching, it can be ommitted.
+        cost_class = -out_prob.gather(2, tgt_ids.unsqueeze(1).expand(-1, num_queries, -1))
+
+        # Compute the L1 cost between boxes
+        cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
+
+        # Compute the giou cost betwen boxes
+        cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
+
+        # Final cost matrix
+        return self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
+
     @torch.no_grad()
     def forward(self, outputs, targets):
         """ Performs the matching
@@ -52,35 +101,102 @@ class HungarianMatcher(nn.Module):
             For each batch element, it holds:
                 len(index_i) = len(index_j) = min(num_queries, num_target_boxes)
         """
-        bs, num_queries = outputs["pred_logits"].shape[:2]
+        sizes = [len(v["boxes"]) for v in targets]
+        C = self.cost_matrix(outputs, targets).cpu().numpy()
+
+        # The cost matrix of image i is the block of its own, unpadded, targets
+        cost_matrices = [c[:, :size] for c, size in zip(C, sizes)]
+        if self.num_threads > 1 and len(targets) > 1:
+            indices = list(_get_executor(self.num_threads).map(linear_sum_assignment, cost_matrices))
+        else:
+            indices = [linear_sum_assignment(c) for c in cost_matrices]
+        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
 
-        # We flatten to compute the cost matrices in a batch
-        out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)  # [batch_size * num_queries, num_classes]
-        out_bbox = outputs["pred_boxes"].flatten(0, 1)  # [batch_size * num_queries, 4]
 
-        # Also concat the target labels and boxes
-        tgt_ids = torch.cat([v["labels"] for v in targets])
-        tgt_bbox = torch.cat([v["boxes"] for v in targets])
+class AuctionMatcher(HungarianMatcher):
+    """Approximate matcher, which solves the assignments of the whole batch at once with a vectorized
+    auction algorithm (Bertsekas, 1988) running on the device of the outputs.
 
-        # Compute the classification cost. Contrary to the loss, we don't use the NLL,
-        # but approximate it in 1 - proba[target class].
-        # The 1 is a constant that doesn't change the matching, it can be ommitted.
-        cost_class = -out_prob[:, tgt_ids]
+    The targets bid for the predictions, starting from zero prices, and all the unassigned targets bid at each round.
+    The resulting matching costs at most num_target_boxes * epsilon more than the optimal one, and the number of
+    rounds grows as the cost range over epsilon.
+    Images with more targets than queries, or whose auction has not converged after max_iter rounds,
+    are matched exactly with linear_sum_assignment.
+    """
 
-        # Compute the L1 cost between boxes
-        cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
+    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1, epsilon: float = 1e-3,
+                 max_iter: int = 1000):
+        super().__init__(cost_class, cost_bbox, cost_giou)
+        self.epsilon = epsilon
+        self.max_iter = max_iter
 
-        # Compute the giou cost betwen boxes
-        cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
+    @torch.no_grad()
+    def auction(self, C, sizes):
+        """ Runs the auction on the padded cost matrices C of dim [batch_size, num_queries, max_num_target_boxes]
 
-        # Final cost matrix
-        C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-        C = C.view(bs, num_queries, -1).cpu()
+        Returns:
+            A tensor of dim [batch_size, max_num_target_boxes] with the query matched to each target,
+            -1 for the padded targets and for those left unassigned.
+        """
+        bs, num_queries, max_targets = C.shape
+        target_idx = torch.arange(max_targets, device=C.device)
+        valid = (target_idx[None] < sizes[:, None]) & (sizes <= num_queries)[:, None]
+        target_to_query = torch.full((bs, max_targets), -1, dtype=torch.int64, device=C.device)
+        if num_queries < 2:
+            return target_to_query
+
+        benefit = -C.transpose(1, 2).float()  # [batch_size, max_num_target_boxes, num_queries]
+        prices = benefit.new_zeros(bs, num_queries)
+        query_to_target = torch.full((bs, num_queries), -1, dtype=torch.int64, device=C.device)
+        for _ in range(self.max_iter):
+            active = valid & (target_to_query < 0)
+            if not active.any():
+                break
+            # Each active target bids for its best query, raising its price by the margin over the second best
+            top_values, top_queries = (benefit - prices[:, None, :]).topk(2, dim=2)
+            best_query = top_queries[..., 0]
+            bids = prices.gather(1, best_query) + top_values[..., 0] - top_values[..., 1] + self.epsilon
+            bids = bids.masked_fill(~active, float("-inf"))
+
+            # Each query goes to its highest bidder, ties being broken by the target index
+            best_bids = torch.full_like(prices, float("-inf")).scatter_reduce(1, best_query, bids, "amax")
+            winners = active & (bids == best_bids.gather(1, best_query))
+            winner_ids = torch.where(winners, target_idx[None], -1)
+            winner_of_query = torch.full_like(query_to_target, -1).scatter_reduce(1, best_query, winner_ids, "amax")
+
+            b, q = (winner_of_query >= 0).nonzero(as_tuple=True)
+            previous = query_to_target[b, q]
+            outbid = previous >= 0
+            target_to_query[b[outbid], previous[outbid]] = -1
+            target_to_query[b, winner_of_query[b, q]] = q
+            query_to_target[b, q] = winner_of_query[b, q]
+            prices[b, q] = best_bids[b, q]
+        return target_to_query.masked_fill(~valid, -1)
 
+    @torch.no_grad()
+    def forward(self, outputs, targets):
+        """ Performs the matching, see HungarianMatcher.forward """
         sizes = [len(v["boxes"]) for v in targets]
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        C = self.cost_matrix(outputs, targets)
+        target_to_query = self.auction(C, torch.as_tensor(sizes, device=C.device)).cpu()
+
+        indices = []
+        for i, size in enumerate(sizes):
+            query_ids = target_to_query[i, :size]
+            if (query_ids < 0).any():
+                query_ids, target_ids = linear_sum_assignment(C[i, :, :size].cpu().numpy())
+                indices.append((torch.as_tensor(query_ids, dtype=torch.int64),
+                                torch.as_tensor(target_ids, dtype=torch.int64)))
+            else:
+                # sorted by query, as returned by linear_sum_assignment
+                query_ids, target_ids = query_ids.sort()
+                indices.append((query_ids, target_ids))
+        return indices
 
 
 def build_matcher(args):
-    return HungarianMatcher(cost_class=args.set_cost_class, cost_bbox=args.set_cost_bbox, cost_giou=args.set_cost_giou)
+    if args.matcher == "auction":
+        return AuctionMatcher(cost_class=args.set_cost_class, cost_bbox=args.set_cost_bbox,
+                              cost_giou=args.set_cost_giou, epsilon=args.auction_epsilon)
+    return HungarianMatcher(cost_class=args.set_cost_class, cost_bbox=args.set_cost_bbox, cost_giou=args.set_cost_giou,
+                            num_threads=args.matcher_threads)
@@ -3,8 +3,12 @@
 Various positional encodings for the transformer.
 """
 import math
+from collections import OrderedDict
+from typing import Optional
+
 import torch
-from torch import nn
+import torchvision
+from torch import nn, Tensor
 
 from util.misc import NestedTensor
 
@@ -13,8 +17,15 @@ class PositionEmbeddingSine(nn.Module):
     """
     This is a more standard version of the position embedding, very similar to the one
     used by the Attention is all you need paper, generalized to work on images.
+
+    The embedding of an image only depends on the padded mask size and on the size of its
+    unpadded (top-left) region. If cache_size > 0, the embeddings of such images are kept in
+    a LRU cache of at most cache_size entries, and are only recomputed for irregular masks.
     """
-    def __init__(self, num_pos_feats=64, temperature=10000, normalize=False, scale=None):
+    # the cache is never used by scripted modules, and its keys cannot be typed
+    __jit_ignored_attributes__ = ["_cache"]
+
+    def __init__(self, num_pos_feats=64, temperature=10000, normalize=False, scale=None, cache_size=0):
         super().__init__()
         self.num_pos_feats = num_pos_feats
         self.temperature = temperature
@@ -24,11 +35,20 @@ class PositionEmbeddingSine(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
 
     def forward(self, tensor_list: NestedTensor):
-        x = tensor_list.tensors
         mask = tensor_list.mask
         assert mask is not None
+        # cached embeddings would be baked as constants in a traced graph
+        if self.cache_size > 0 and not torch.jit.is_scripting() and not torchvision._is_tracing():
+            pos = self._cached_embedding(mask)
+            if pos is not None:
+                return pos
+        return self._embedding(mask)
+
+    def _embedding(self, mask):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -37,7 +57,7 @@ class PositionEmbeddingSine(nn.Module):
             y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
 
         pos_x = x_embed[:, :, :, None] / dim_t
@@ -47,6 +67,41 @@ class PositionEmbeddingSine(nn.Module):
         pos = torch.cat((pos_y, pos_x), dim=3).permute(0, 3, 1, 2)
         return pos
 
+    @torch.jit.unused
+    def _cached_embedding(self, mask: Tensor) -> Optional[Tensor]:
+        """
+        Looks up the embedding of each image of the batch in the cache, keyed by
+        (mask height, mask width, unpadded height, unpadded width, device).
+        Returns None if the unpadded region of some image is not a top-left rectangle, or when the
+        module is being exported with torch.export.
+        """
+        is_compiling = getattr(getattr(torch, "compiler", None), "is_compiling", None)
+        if is_compiling is not None and is_compiling():
+            return None
+        _, h, w = mask.shape
+        not_mask = ~mask
+        valid_h = not_mask[:, :, 0].sum(1)
+        valid_w = not_mask[:, 0, :].sum(1)
+        rows = torch.arange(h, device=mask.device)
+        cols = torch.arange(w, device=mask.device)
+        rect = (rows[None, :, None] < valid_h[:, None, None]) & (cols[None, None, :] < valid_w[:, None, None])
+        if not torch.equal(rect, not_mask):
+            return None
+
+        pos = []
+        for i, (vh, vw) in enumerate(zip(valid_h.tolist(), valid_w.tolist())):
+            key = (h, w, vh, vw, mask.device)
+            embedding = self._cache.get(key)
+            if embedding is None:
+                embedding = self._embedding(mask[i:i + 1])[0]
+                self._cache[key] = embedding
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(key)
+            pos.append(embedding)
+        return torch.stack(pos)
+
 
 class PositionEmbeddingLearned(nn.Module):
     """
@@ -80,7 +135,8 @@ def build_position_encoding(args):
     N_steps = args.hidden_dim // 2
     if args.position_embedding in ('v2', 'sine'):
         # TODO find a better way of exposing other arguments
-        position_embedding = PositionEmbeddingSine(N_steps, normalize=True)
+        position_embedding = PositionEmbeddingSine(N_steps, normalize=True,
+                                                   cache_size=args.position_embedding_cache)
     elif args.position_embedding in ('v3', 'learned'):
         position_embedding = PositionEmbeddingLearned(N_steps)
     else:
@@ -0,0 +1,54 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+Post-training int8 quantization of DETR for CPU inference.
+
+    * the Linear layers (transformer and prediction heads) are dynamically quantized
+    * the ResNet body of the backbone is statically quantized with FX graph mode quantization,
+      after folding its FrozenBatchNorm2d layers into the convolutions, and calibrated on a few batches
+
+The quantized model is meant for CPU inference only.
+"""
+import torch
+from torch import nn
+
+from .backbone import fold_frozen_batchnorm
+
+
+def quantize_dynamic_linear(model):
+    """Replaces, in place, the nn.Linear layers of model by dynamically quantized int8 ones"""
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+@torch.no_grad()
+def quantize_backbone_static(backbone, calibration_data, backend="fbgemm"):
+    """
+    Statically quantizes, in place, the body of a BackboneBase.
+    Parameters:
+        backbone: the BackboneBase to quantize, ie model.backbone[0]
+        calibration_data: iterable of NestedTensor batches, used to calibrate the activation ranges
+        backend: quantized engine, "fbgemm" (x86) or "qnnpack" (ARM)
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = backend
+    calibration_data = iter(calibration_data)
+    samples = next(calibration_data)
+    body = fold_frozen_batchnorm(backbone.body, samples.tensors)
+    prepared = prepare_fx(body, get_default_qconfig_mapping(backend), example_inputs=(samples.tensors,))
+    prepared(samples.tensors)
+    for samples in calibration_data:
+        prepared(samples.tensors)
+    backbone.body = convert_fx(prepared)
+    return backbone
+
+
+def quantize_model(model, calibration_data=None, backend="fbgemm"):
+    """
+    Quantizes, in place, a DETR model for CPU inference.
+    The backbone is only quantized if calibration_data (an iterable of NestedTensor batches) is given.
+    """
+    model.eval()
+    if calibration_data is not None:
+        quantize_backbone_static(model.backbone[0], calibration_data, backend)
+    return quantize_dynamic_linear(model)
@@ -3,28 +3,34 @@
 This file provides the definition of the convolutional heads used to predict masks, as well as the losses
 """
 import io
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
 from PIL import Image
 
-import util.box_ops as box_ops
 from util.misc import NestedTensor, interpolate, nested_tensor_from_tensor_list
 
 try:
-    from panopticapi.utils import id2rgb, rgb2id
+    import pycocotools.mask as mask_util
 except ImportError:
     pass
 
 
 class DETRsegm(nn.Module):
-    def __init__(self, detr, freeze_detr=False):
+    def __init__(self, detr, freeze_detr=False, mask_score_threshold=0.0):
+        """
+        mask_score_threshold: if > 0, at inference the mask head is only run on the queries whose score
+                              (highest non no-object probability) is above it. The masks of the other
+                              queries are filled with a large negative logit.
+        """
         super().__init__()
         self.detr = detr
+        self.mask_score_threshold = mask_score_threshold
 
         if freeze_detr:
             for p in self.parameters():
@@ -54,16 +60,39 @@ class DETRsegm(nn.Module):
 
         # FIXME h_boxes takes the last one computed, keep this in mind
         bbox_mask = self.bbox_attention(hs[-1], memory, mask=mask)
+        fpns = [features[2].tensors, features[1].tensors, features[0].tensors]
+
+        if not self.training and self.mask_score_threshold > 0:
+            out["pred_masks"] = self._masks_of_kept_queries(outputs_class[-1], src_proj, bbox_mask, fpns)
+            return out
 
-        seg_masks = self.mask_head(src_proj, bbox_mask, [features[2].tensors, features[1].tensors, features[0].tensors])
+        seg_masks = self.mask_head(src_proj, bbox_mask, fpns)
         outputs_seg_masks = seg_masks.view(bs, self.detr.num_queries, seg_masks.shape[-2], seg_masks.shape[-1])
 
         out["pred_masks"] = outputs_seg_masks
         return out
 
+    def _masks_of_kept_queries(self, pred_logits, src_proj, bbox_mask, fpns: List[Tensor]):
+        scores = pred_logits.softmax(-1)[..., :-1].max(-1)[0]
+        kept = (scores > self.mask_score_threshold).nonzero()
+        image_idx, query_idx = kept[:, 0], kept[:, 1]
+        seg_masks = self.mask_head(src_proj, bbox_mask[image_idx, query_idx], fpns, image_idx)
 
-def _expand(tensor, length: int):
-    return tensor.unsqueeze(1).repeat(1, int(length), 1, 1, 1).flatten(0, 1)
+        masks = seg_masks.new_full(scores.shape + seg_masks.shape[-2:], -1e4)
+        masks[image_idx, query_idx] = seg_masks[:, 0]
+        return masks
+
+
+def _add_per_image(per_query: Tensor, per_image: Tensor, image_idx: Optional[Tensor]):
+    """
+    Adds to the [N, C, H, W] features of each query the [C, H, W] features of its image. If image_idx is None,
+    the N queries are grouped by image, and the image features are broadcast instead of being replicated.
+    """
+    if image_idx is not None:
+        return per_query + per_image.index_select(0, image_idx)
+    bs = per_image.shape[0]
+    per_query = per_query.view(bs, -1, per_query.shape[1], per_query.shape[2], per_query.shape[3])
+    return (per_query + per_image.unsqueeze(1)).flatten(0, 1)
 
 
 class MaskHeadSmallConv(nn.Module):
@@ -99,10 +128,22 @@ class MaskHeadSmallConv(nn.Module):
                 nn.init.kaiming_uniform_(m.weight, a=1)
                 nn.init.constant_(m.bias, 0)
 
-    def forward(self, x: Tensor, bbox_mask: Tensor, fpns: List[Tensor]):
-        x = torch.cat([_expand(x, bbox_mask.shape[1]), bbox_mask.flatten(0, 1)], 1)
-
-        x = self.lay1(x)
+    def forward(self, x: Tensor, bbox_mask: Tensor, fpns: List[Tensor], image_idx: Optional[Tensor] = None):
+        """
+        Parameters:
+            x: the projected backbone features, of dimension [batch_size, C, H, W]
+            bbox_mask: the attention maps of all the queries, of dimension [batch_size, num_queries, nheads, H, W],
+                       or of a subset of them, of dimension [N, nheads, H, W], image_idx then giving their image
+        Returns the [batch_size * num_queries (or N), 1, H', W'] mask logits
+        """
+        if image_idx is None:
+            bbox_mask = bbox_mask.flatten(0, 1)
+
+        # lay1 is linear in the concatenation of x and bbox_mask, so its part on x, which does not
+        # depend on the query, is computed once per image instead of on x replicated for every query
+        x_dim = x.shape[1]
+        x = F.conv2d(x, self.lay1.weight[:, :x_dim], self.lay1.bias, padding=1)
+        x = _add_per_image(F.conv2d(bbox_mask, self.lay1.weight[:, x_dim:], padding=1), x, image_idx)
         x = self.gn1(x)
         x = F.relu(x)
         x = self.lay2(x)
@@ -110,25 +151,19 @@ class MaskHeadSmallConv(nn.Module):
         x = F.relu(x)
 
         cur_fpn = self.adapter1(fpns[0])
-        if cur_fpn.size(0) != x.size(0):
-            cur_fpn = _expand(cur_fpn, x.size(0) // cur_fpn.size(0))
-        x = cur_fpn + F.interpolate(x, size=cur_fpn.shape[-2:], mode="nearest")
+        x = _add_per_image(F.interpolate(x, size=cur_fpn.shape[-2:], mode="nearest"), cur_fpn, image_idx)
         x = self.lay3(x)
         x = self.gn3(x)
         x = F.relu(x)
 
         cur_fpn = self.adapter2(fpns[1])
-        if cur_fpn.size(0) != x.size(0):
-            cur_fpn = _expand(cur_fpn, x.size(0) // cur_fpn.size(0))
-        x = cur_fpn + F.interpolate(x, size=cur_fpn.shape[-2:], mode="nearest")
+        x = _add_per_image(F.interpolate(x, size=cur_fpn.shape[-2:], mode="nearest"), cur_fpn, image_idx)
         x = self.lay4(x)
         x = self.gn4(x)
         x = F.relu(x)
 
         cur_fpn = self.adapter3(fpns[2])
-        if cur_fpn.size(0) != x.size(0):
-            cur_fpn = _expand(cur_fpn, x.size(0) // cur_fpn.size(0))
-        x = cur_fpn + F.interpolate(x, size=cur_fpn.shape[-2:], mode="nearest")
+        x = _add_per_image(F.interpolate(x, size=cur_fpn.shape[-2:], mode="nearest"), cur_fpn, image_idx)
         x = self.lay5(x)
         x = self.gn5(x)
         x = F.relu(x)
@@ -169,6 +204,37 @@ class MHAttentionMap(nn.Module):
         return weights
 
 
+def point_sample(input, point_coords):
+    """
+    Samples input, of dimension [N, C, H, W], at the points point_coords of dimension [N, P, 2], given as (x, y)
+    in [0, 1] relative to the size of input, with bilinear interpolation. Points outside of input get 0.
+    Returns a [N, C, P] tensor.
+    """
+    output = F.grid_sample(input, 2.0 * point_coords.unsqueeze(2) - 1.0, align_corners=False)
+    return output.squeeze(3)
+
+
+@torch.no_grad()
+def get_uncertain_point_coords(mask_logits, num_points: int, oversample_ratio: float = 3.0,
+                               importance_sample_ratio: float = 0.75):
+    """
+    Picks the points of the [N, H, W] mask_logits the mask losses are computed on, as in PointRend:
+    importance_sample_ratio of them are the most uncertain (logit closest to 0) of oversample_ratio * num_points
+    random points, and the others are drawn uniformly.
+    Returns their (x, y) coordinates in [0, 1], as a [N, num_points, 2] tensor.
+    """
+    num_masks = mask_logits.shape[0]
+    num_uncertain_points = int(importance_sample_ratio * num_points)
+    num_random_points = num_points - num_uncertain_points
+    point_coords = torch.rand(num_masks, int(oversample_ratio * num_points), 2,
+                              dtype=mask_logits.dtype, device=mask_logits.device)
+    uncertainty = -point_sample(mask_logits[:, None], point_coords)[:, 0].abs()
+    idx = uncertainty.topk(num_uncertain_points, dim=1)[1]
+    point_coords = point_coords.gather(1, idx.unsqueeze(-1).expand(-1, -1, 2))
+    random_coords = torch.rand(num_masks, num_random_points, 2, dtype=mask_logits.dtype, device=mask_logits.device)
+    return torch.cat([point_coords, random_coords], dim=1)
+
+
 def dice_loss(inputs, targets, num_boxes):
     """
     Compute the DICE loss, similar to generalized IOU for masks
@@ -216,42 +282,174 @@ def sigmoid_focal_loss(inputs, targets, num_boxes, alpha: float = 0.25, gamma: f
 
 
 class PostProcessSegm(nn.Module):
-    def __init__(self, threshold=0.5):
+    def __init__(self, threshold=0.5, paste_in_boxes=False, rle=False):
+        """
+        Parameters:
+            threshold: probability above which a pixel belongs to the mask
+            paste_in_boxes: only compute each mask inside its predicted box, by sampling the low resolution mask
+                            at the pixels of the box in the original image, and leave it empty elsewhere.
+                            Otherwise the masks are upsampled to the padded batch size, then to the original size
+            rle: return the masks as COCO run-length encodings, in results[i]["rles"], instead of as
+                 [num_detections, 1, H, W] uint8 tensors in results[i]["masks"]
+        """
         super().__init__()
         self.threshold = threshold
+        self.paste_in_boxes = paste_in_boxes
+        self.rle = rle
 
     @torch.no_grad()
     def forward(self, results, outputs, orig_target_sizes, max_target_sizes):
         assert len(orig_target_sizes) == len(max_target_sizes)
         max_h, max_w = max_target_sizes.max(0)[0].tolist()
         outputs_masks = outputs["pred_masks"].squeeze(2)
-        outputs_masks = F.interpolate(outputs_masks, size=(max_h, max_w), mode="bilinear", align_corners=False)
-        outputs_masks = (outputs_masks.sigmoid() > self.threshold).cpu()
 
         for i, (cur_mask, t, tt) in enumerate(zip(outputs_masks, max_target_sizes, orig_target_sizes)):
-            img_h, img_w = t[0], t[1]
-            results[i]["masks"] = cur_mask[:, :img_h, :img_w].unsqueeze(1)
-            results[i]["masks"] = F.interpolate(
-                results[i]["masks"].float(), size=tuple(tt.tolist()), mode="nearest"
-            ).byte()
+            if "query_ids" in results[i]:
+                # PostProcess filtered the detections, only their masks are computed
+                cur_mask = cur_mask[results[i]["query_ids"]]
+            orig_size = tuple(tt.tolist())
+            if self.paste_in_boxes:
+                crops, offsets = self._masks_in_boxes(cur_mask, results[i]["boxes"], t.tolist(), orig_size,
+                                                      (max_h, max_w))
+                if self.rle:
+                    results[i]["rles"] = _encode_rles(crops, offsets, orig_size)
+                    continue
+                masks = torch.zeros((len(crops), 1) + orig_size, dtype=torch.uint8)
+                for mask, crop, (x0, y0) in zip(masks, crops, offsets):
+                    mask[0, y0:y0 + crop.shape[0], x0:x0 + crop.shape[1]] = crop
+            else:
+                cur_mask = F.interpolate(cur_mask[None], size=(max_h, max_w), mode="bilinear",
+                                         align_corners=False)[0]
+                cur_mask = (cur_mask.sigmoid() > self.threshold).cpu()
+                img_h, img_w = t[0], t[1]
+                masks = cur_mask[:, :img_h, :img_w].unsqueeze(1)
+                if self.rle:
+                    # upsampled one at a time, rather than all the masks at the original size at once
+                    upsampled = (F.interpolate(mask[None].float(), size=orig_size, mode="nearest")[0, 0].byte()
+                                 for mask in masks)
+                    results[i]["rles"] = _encode_rles(upsampled, [(0, 0)] * len(masks), orig_size)
+                    continue
+                masks = F.interpolate(masks.float(), size=orig_size, mode="nearest").byte()
+            results[i]["masks"] = masks
 
         return results
 
+    def _masks_in_boxes(self, masks, boxes, img_size, orig_size, batch_size):
+        """
+        Computes the binary masks inside their boxes only.
+        Parameters:
+            masks: the [K, h, w] mask logits, which span the padded batch of size batch_size
+            boxes: the [K, 4] boxes, in absolute [x0, y0, x1, y1] coordinates in the original image
+            img_size, orig_size: the (height, width) of the image after data augmentation, and the original one
+        Returns the list of the K uint8 crops, on CPU, and the list of their (x0, y0) offsets in the original image.
+        """
+        num_masks = len(masks)
+        if num_masks == 0:
+            return [], []
+        orig_h, orig_w = orig_size
+        boxes = boxes.clone()
+        boxes[:, 0::2] = boxes[:, 0::2].clamp(0, orig_w)
+        boxes[:, 1::2] = boxes[:, 1::2].clamp(0, orig_h)
+        x0 = boxes[:, 0].floor().long().clamp(max=orig_w - 1)
+        y0 = boxes[:, 1].floor().long().clamp(max=orig_h - 1)
+        widths = (boxes[:, 2].ceil().long() - x0).clamp(min=1)
+        heights = (boxes[:, 3].ceil().long() - y0).clamp(min=1)
+
+        # The centers of the pixels of the boxes, from the original image to grid_sample coordinates in the masks.
+        # Each crop is sampled at the size of its own box, so that one large box does not make all of them large
+        scale_x = img_size[1] / orig_w / batch_size[1]
+        scale_y = img_size[0] / orig_h / batch_size[0]
+        crops = []
+        offsets = list(zip(x0.tolist(), y0.tolist()))
+        for mask, (x, y), w, h in zip(masks, offsets, widths.tolist(), heights.tolist()):
+            xs = (x + torch.arange(w, device=masks.device) + 0.5) * (2 * scale_x) - 1
+            ys = (y + torch.arange(h, device=masks.device) + 0.5) * (2 * scale_y) - 1
+            grid = torch.stack([xs[None, :].expand(h, -1), ys[:, None].expand(-1, w)], dim=-1)
+            crop = F.grid_sample(mask[None, None], grid[None].to(masks.dtype), align_corners=False)[0, 0]
+            crops.append((crop.sigmoid() > self.threshold).byte().cpu())
+        return crops, offsets
+
+
+def _encode_rles(crops, offsets, size):
+    """
+    COCO run-length encodings of the masks of the given size, made of the uint8 crops pasted at the offsets.
+    The runs are computed from the crops only, without going through a mask of the full size.
+    """
+    height, width = size
+    rles = []
+    for crop, (x0, y0) in zip(crops, offsets):
+        h, w = crop.shape
+        # column-major, as COCO, with a zero row above and below each column so that no run spans two columns
+        padded = np.zeros((w, h + 2), dtype=np.int8)
+        padded[:, 1:-1] = crop.numpy().T
+        changes = np.flatnonzero(np.diff(padded.ravel())) + 1
+        # the changes alternate between the starts and the ends of the runs of ones, from their position in the crop
+        # to their position in the full mask
+        positions = (x0 + changes // (h + 2)) * height + y0 + changes % (h + 2) - 1
+        # a run ending at the bottom of a column and the next one starting at the top of the next column are merged
+        joined = np.flatnonzero(np.diff(positions) == 0)
+        positions = np.delete(positions, np.concatenate([joined, joined + 1]))
+        counts = np.diff(np.concatenate([[0], positions, [height * width]]))
+        if len(counts) > 1 and counts[-1] == 0:
+            # as pycocotools, which does not end with an empty run of zeros
+            counts = counts[:-1]
+        rle = mask_util.frPyObjects({"size": [height, width], "counts": counts.tolist()}, height, width)
+        rle["counts"] = rle["counts"].decode("utf-8")
+        rles.append(rle)
+    return rles
+
+
+def _pil_nearest_indices(in_size: int, out_size: int, device):
+    """
+    Indices of the source pixels of a nearest neighbour resizing from in_size to out_size, computed as PIL does:
+    the source coordinates are accumulated in double precision and truncated, which differs from
+    F.interpolate(mode="nearest-exact") at some scale ratios, e.g. 2.5.
+    """
+    in_size, out_size = int(in_size), int(out_size)
+    scale = in_size / out_size
+    steps = np.full(out_size, scale)
+    steps[0] = scale * 0.5
+    indices = np.minimum(np.add.accumulate(steps).astype(np.int64), in_size - 1)
+    return torch.from_numpy(indices).to(device)
+
+
+def _id2rgb(id_map):
+    # same encoding as panopticapi.utils.id2rgb
+    return torch.stack([id_map % 256, id_map // 256 % 256, id_map // (256 * 256) % 256], dim=-1).to(torch.uint8)
+
+
+_executors = {}
+
+
+def _get_executor(num_threads):
+    # reused across batches, and kept out of the module so that it can still be deep-copied and pickled
+    if num_threads not in _executors:
+        _executors[num_threads] = ThreadPoolExecutor(num_threads, thread_name_prefix="panoptic_png")
+    return _executors[num_threads]
+
+
+def _encode_png(rgb):
+    with io.BytesIO() as out:
+        Image.fromarray(rgb).save(out, format="PNG")
+        return out.getvalue()
+
 
 class PostProcessPanoptic(nn.Module):
     """This class converts the output of the model to the final panoptic result, in the format expected by the
     coco panoptic API """
 
-    def __init__(self, is_thing_map, threshold=0.85):
+    def __init__(self, is_thing_map, threshold=0.85, num_threads=0):
         """
         Parameters:
            is_thing_map: This is a whose keys are the class ids, and the values a boolean indicating whether
                           the class is  a thing (True) or a stuff (False) class
            threshold: confidence threshold: segments with confidence lower than this will be deleted
+           num_threads: number of threads encoding the PNGs of the batch, 0 or 1 to encode them serially
         """
         super().__init__()
         self.threshold = threshold
         self.is_thing_map = is_thing_map
+        self.num_threads = num_threads
 
     def forward(self, outputs, processed_sizes, target_sizes=None):
         """ This function computes the panoptic prediction from the model's predictions.
@@ -265,99 +463,73 @@ class PostProcessPanoptic(nn.Module):
         if target_sizes is None:
             target_sizes = processed_sizes
         assert len(processed_sizes) == len(target_sizes)
-        out_logits, raw_masks, raw_boxes = outputs["pred_logits"], outputs["pred_masks"], outputs["pred_boxes"]
+        out_logits, raw_masks = outputs["pred_logits"], outputs["pred_masks"]
         assert len(out_logits) == len(raw_masks) == len(target_sizes)
-        preds = []
+        num_classes = out_logits.shape[-1] - 1
 
         def to_tuple(tup):
             if isinstance(tup, tuple):
                 return tup
             return tuple(tup.cpu().tolist())
 
-        for cur_logits, cur_masks, cur_boxes, size, target_size in zip(
-            out_logits, raw_masks, raw_boxes, processed_sizes, target_sizes
-        ):
+        seg_imgs, all_segments_info = [], []
+        for cur_logits, cur_masks, size, target_size in zip(out_logits, raw_masks, processed_sizes, target_sizes):
             # we filter empty queries and detection below threshold
-            scores, labels = cur_logits.softmax(-1).max(-1)
-            keep = labels.ne(outputs["pred_logits"].shape[-1] - 1) & (scores > self.threshold)
             cur_scores, cur_classes = cur_logits.softmax(-1).max(-1)
-            cur_scores = cur_scores[keep]
+            keep = cur_classes.ne(num_classes) & (cur_scores > self.threshold)
             cur_classes = cur_classes[keep]
-            cur_masks = cur_masks[keep]
-            cur_masks = interpolate(cur_masks[:, None], to_tuple(size), mode="bilinear").squeeze(1)
-            cur_boxes = box_ops.box_cxcywh_to_xyxy(cur_boxes[keep])
-
-            h, w = cur_masks.shape[-2:]
-            assert len(cur_boxes) == len(cur_classes)
-
-            # It may be that we have several predicted masks for the same stuff class.
-            # In the following, we track the list of masks ids for each stuff class (they are merged later on)
-            cur_masks = cur_masks.flatten(1)
-            stuff_equiv_classes = defaultdict(lambda: [])
-            for k, label in enumerate(cur_classes):
-                if not self.is_thing_map[label.item()]:
-                    stuff_equiv_classes[label.item()].append(k)
-
-            def get_ids_area(masks, scores, dedup=False):
-                # This helper function creates the final panoptic segmentation image
-                # It also returns the area of the masks that appears on the image
-
-                m_id = masks.transpose(0, 1).softmax(-1)
-
-                if m_id.shape[-1] == 0:
-                    # We didn't detect any mask :(
-                    m_id = torch.zeros((h, w), dtype=torch.long, device=m_id.device)
-                else:
-                    m_id = m_id.argmax(-1).view(h, w)
-
-                if dedup:
-                    # Merge the masks corresponding to the same stuff class
-                    for equiv in stuff_equiv_classes.values():
-                        if len(equiv) > 1:
-                            for eq_id in equiv:
-                                m_id.masked_fill_(m_id.eq(eq_id), equiv[0])
-
-                final_h, final_w = to_tuple(target_size)
-
-                seg_img = Image.fromarray(id2rgb(m_id.view(h, w).cpu().numpy()))
-                seg_img = seg_img.resize(size=(final_w, final_h), resample=Image.NEAREST)
-
-                np_seg_img = (
-                    torch.ByteTensor(torch.ByteStorage.from_buffer(seg_img.tobytes())).view(final_h, final_w, 3).numpy()
-                )
-                m_id = torch.from_numpy(rgb2id(np_seg_img))
-
-                area = []
-                for i in range(len(scores)):
-                    area.append(m_id.eq(i).sum().item())
-                return area, seg_img
-
-            area, seg_img = get_ids_area(cur_masks, cur_scores, dedup=True)
-            if cur_classes.numel() > 0:
-                # We know filter empty masks as long as we find some
-                while True:
-                    filtered_small = torch.as_tensor(
-                        [area[i] <= 4 for i, c in enumerate(cur_classes)], dtype=torch.bool, device=keep.device
-                    )
-                    if filtered_small.any().item():
-                        cur_scores = cur_scores[~filtered_small]
-                        cur_classes = cur_classes[~filtered_small]
-                        cur_masks = cur_masks[~filtered_small]
-                        area, seg_img = get_ids_area(cur_masks, cur_scores)
-                    else:
-                        break
-
-            else:
-                cur_classes = torch.ones(1, dtype=torch.long, device=cur_classes.device)
-
-            segments_info = []
-            for i, a in enumerate(area):
-                cat = cur_classes[i].item()
-                segments_info.append({"id": i, "isthing": self.is_thing_map[cat], "category_id": cat, "area": a})
-            del cur_classes
-
-            with io.BytesIO() as out:
-                seg_img.save(out, format="PNG")
-                predictions = {"png_string": out.getvalue(), "segments_info": segments_info}
-            preds.append(predictions)
-        return preds
+            cur_masks = interpolate(cur_masks[keep][:, None], to_tuple(size), mode="bilinear").squeeze(1)
+            m_id, segments_info = self._segments(cur_masks, cur_classes, to_tuple(target_size))
+            seg_imgs.append(_id2rgb(m_id).cpu().numpy())
+            all_segments_info.append(segments_info)
+
+        # The PNGs are only encoded at the end, possibly in parallel as PIL releases the GIL while compressing
+        if self.num_threads > 1 and len(seg_imgs) > 1:
+            png_strings = list(_get_executor(self.num_threads).map(_encode_png, seg_imgs))
+        else:
+            png_strings = [_encode_png(seg_img) for seg_img in seg_imgs]
+        return [{"png_string": png_string, "segments_info": segments_info}
+                for png_string, segments_info in zip(png_strings, all_segments_info)]
+
+    def _segments(self, masks, classes, target_size):
+        """
+        Computes the segment id of each pixel, at target_size, from the [K, h, w] mask logits of the kept queries,
+        and the info of each segment. The masks predicted for the same stuff class are merged into the first one,
+        and the segments of at most 4 pixels are removed.
+        """
+        num_masks = len(classes)
+        empty = torch.zeros(target_size, dtype=torch.int64, device=masks.device)
+        if num_masks == 0:
+            # We didn't detect any mask :(
+            return empty, []
+
+        # merged_into[k] is the mask that mask k is merged into, the first one with the same class for stuff
+        is_stuff = torch.as_tensor([not self.is_thing_map[c] for c in classes.tolist()], device=classes.device)
+        same_stuff = is_stuff[:, None] & is_stuff[None, :] & (classes[:, None] == classes[None, :])
+        mask_ids = torch.arange(num_masks, device=classes.device)
+        merged_into = torch.where(is_stuff, same_stuff.int().argmax(0), mask_ids)
+
+        def get_ids_area(removed):
+            m_id = masks.masked_fill(removed[:, None, None], float("-inf")).argmax(0)
+            m_id = merged_into[m_id]
+            # same resizing as PIL's nearest neighbour
+            m_id = m_id[_pil_nearest_indices(m_id.shape[0], target_size[0], m_id.device)]
+            m_id = m_id[:, _pil_nearest_indices(m_id.shape[1], target_size[1], m_id.device)]
+            return m_id, torch.bincount(m_id.flatten(), minlength=num_masks)
+
+        removed = torch.zeros(num_masks, dtype=torch.bool, device=masks.device)
+        m_id, area = get_ids_area(removed)
+        # We now filter the small segments, along with the masks merged into them, in one pass
+        removed = (area <= 4)[merged_into]
+        if removed.all():
+            return empty, []
+        if removed.any():
+            m_id, area = get_ids_area(removed)
+
+        # Renumber the remaining segments from 0
+        kept = (merged_into == mask_ids) & ~removed
+        m_id = (kept.cumsum(0) - 1)[m_id]
+        segments_info = []
+        for i, (cat, a) in enumerate(zip(classes[kept].tolist(), area[kept].tolist())):
+            segments_info.append({"id": i, "isthing": self.is_thing_map[cat], "category_id": cat, "area": a})
+        return m_id, segments_info
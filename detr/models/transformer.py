@@ -6,9 +6,10 @@ Copy-paste from torch.nn.Transformer with modifications:
     * positional encodings are passed in MHattention
     * extra LN at the end of encoder is removed
     * decoder returns a stack of activations from all decoding layers
+    * optional batch-first attention backend built on F.scaled_dot_product_attention
 """
 import copy
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -20,16 +21,16 @@ class Transformer(nn.Module):
     def __init__(self, d_model=512, nhead=8, num_encoder_layers=6,
                  num_decoder_layers=6, dim_feedforward=2048, dropout=0.1,
                  activation="relu", normalize_before=False,
-                 return_intermediate_dec=False):
+                 return_intermediate_dec=False, attention_backend="mha"):
         super().__init__()
 
         encoder_layer = TransformerEncoderLayer(d_model, nhead, dim_feedforward,
-                                                dropout, activation, normalize_before)
+                                                dropout, activation, normalize_before, attention_backend)
         encoder_norm = nn.LayerNorm(d_model) if normalize_before else None
         self.encoder = TransformerEncoder(encoder_layer, num_encoder_layers, encoder_norm)
 
         decoder_layer = TransformerDecoderLayer(d_model, nhead, dim_feedforward,
-                                                dropout, activation, normalize_before)
+                                                dropout, activation, normalize_before, attention_backend)
         decoder_norm = nn.LayerNorm(d_model)
         self.decoder = TransformerDecoder(decoder_layer, num_decoder_layers, decoder_norm,
                                           return_intermediate=return_intermediate_dec)
@@ -38,26 +39,75 @@ class Transformer(nn.Module):
 
         self.d_model = d_model
         self.nhead = nhead
+        # the sdpa backend works on [batch, seq, dim] tensors, the mha one on [seq, batch, dim]
+        self.batch_first = attention_backend == "sdpa"
 
     def _reset_parameters(self):
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+    def _flatten(self, src, mask, query_embed, pos_embed):
+        bs = src.shape[0]
+        if self.batch_first:
+            # flatten NxCxHxW to NxHWxC
+            src = src.flatten(2).permute(0, 2, 1)
+            pos_embed = pos_embed.flatten(2).permute(0, 2, 1)
+            query_embed = query_embed.unsqueeze(0).repeat(bs, 1, 1)
+            # the padding mask is turned into an attention bias once, and shared by all layers
+            mask = _padding_mask_to_attn_bias(mask.flatten(1), src.dtype)
+        else:
+            # flatten NxCxHxW to HWxNxC
+            src = src.flatten(2).permute(2, 0, 1)
+            pos_embed = pos_embed.flatten(2).permute(2, 0, 1)
+            query_embed = query_embed.unsqueeze(1).repeat(1, bs, 1)
+            mask = mask.flatten(1)
+        return src, mask, query_embed, pos_embed
+
     def forward(self, src, mask, query_embed, pos_embed):
-        # flatten NxCxHxW to HWxNxC
         bs, c, h, w = src.shape
-        src = src.flatten(2).permute(2, 0, 1)
-        pos_embed = pos_embed.flatten(2).permute(2, 0, 1)
-        query_embed = query_embed.unsqueeze(1).repeat(1, bs, 1)
-        mask = mask.flatten(1)
+        src, mask, query_embed, pos_embed = self._flatten(src, mask, query_embed, pos_embed)
 
         tgt = torch.zeros_like(query_embed)
         memory = self.encoder(src, src_key_padding_mask=mask, pos=pos_embed)
         hs = self.decoder(tgt, memory, memory_key_padding_mask=mask,
                           pos=pos_embed, query_pos=query_embed)
+        if self.batch_first:
+            return hs, memory.permute(0, 2, 1).view(bs, c, h, w)
         return hs.transpose(1, 2), memory.permute(1, 2, 0).view(bs, c, h, w)
 
+    @torch.jit.unused
+    def forward_early_exit(self, src, mask, query_embed, pos_embed, class_embed, max_layers=0, threshold=0.0):
+        """ Inference only decoding, that runs the decoder one layer at a time.
+        The decoder stops after max_layers layers (0 for all of them), or as soon as the highest class
+        confidence of every query, as predicted by class_embed, changes by less than threshold
+        between two consecutive layers (0 to disable).
+
+        Returns the normalized output of the last decoder layer that was run, as [batch_size x num_queries x d_model],
+        and the number of decoder layers that were run.
+        """
+        src, mask, query_embed, pos_embed = self._flatten(src, mask, query_embed, pos_embed)
+        memory = self.encoder(src, src_key_padding_mask=mask, pos=pos_embed)
+
+        decoder = self.decoder
+        num_layers = decoder.num_layers if max_layers <= 0 else min(max_layers, decoder.num_layers)
+        output = torch.zeros_like(query_embed)
+        prev_scores = None
+        for i in range(num_layers):
+            output = decoder.layers[i](output, memory, memory_key_padding_mask=mask,
+                                       pos=pos_embed, query_pos=query_embed)
+            if threshold > 0 and i < num_layers - 1:
+                scores = class_embed(decoder.norm(output)).softmax(-1)[..., :-1].max(-1)[0]
+                if prev_scores is not None and (scores - prev_scores).abs().max() < threshold:
+                    num_layers = i + 1
+                    break
+                prev_scores = scores
+
+        hs = decoder.norm(output)
+        if not self.batch_first:
+            hs = hs.transpose(0, 1)
+        return hs, num_layers
+
 
 class TransformerEncoder(nn.Module):
 
@@ -124,12 +174,72 @@ class TransformerDecoder(nn.Module):
         return output.unsqueeze(0)
 
 
+class ScaledDotProductAttention(nn.Module):
+    """
+    Batch-first replacement for nn.MultiheadAttention, built on F.scaled_dot_product_attention.
+
+    The parameters are laid out as in nn.MultiheadAttention, so a checkpoint trained with one
+    attention backend can be loaded with the other.
+    When fused_qk is set, query and key must be the same tensor (as in the DETR self-attention
+    layers), and they are projected with a single matmul.
+    Masks are expected as additive float biases broadcastable to [batch, nhead, tgt_len, src_len],
+    see _padding_mask_to_attn_bias.
+    """
+
+    def __init__(self, embed_dim, num_heads, dropout=0.0, fused_qk=False):
+        super().__init__()
+        if not hasattr(F, "scaled_dot_product_attention"):
+            raise RuntimeError("the sdpa attention backend requires torch>=2.0")
+        assert embed_dim % num_heads == 0, "embed_dim must be divisible by num_heads"
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.dropout = dropout
+        self.fused_qk = fused_qk
+
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.constant_(self.in_proj_bias, 0.)
+        nn.init.constant_(self.out_proj.bias, 0.)
+
+    def _split_heads(self, x):
+        # [batch, seq, dim] -> [batch, nhead, seq, dim // nhead]
+        return x.view(x.shape[0], x.shape[1], self.num_heads, -1).transpose(1, 2)
+
+    def forward(self, query, key, value,
+                attn_mask: Optional[Tensor] = None,
+                key_padding_mask: Optional[Tensor] = None) -> Tuple[Tensor, Optional[Tensor]]:
+        E = self.embed_dim
+        w, b = self.in_proj_weight, self.in_proj_bias
+        if self.fused_qk:
+            q, k = F.linear(query, w[:2 * E], b[:2 * E]).chunk(2, dim=-1)
+        else:
+            q = F.linear(query, w[:E], b[:E])
+            k = F.linear(key, w[E:2 * E], b[E:2 * E])
+        v = F.linear(value, w[2 * E:], b[2 * E:])
+
+        bias = key_padding_mask
+        if attn_mask is not None:
+            if bias is None:
+                bias = attn_mask
+            else:
+                bias = bias + attn_mask
+
+        dropout_p = self.dropout if self.training else 0.0
+        out = F.scaled_dot_product_attention(self._split_heads(q), self._split_heads(k), self._split_heads(v),
+                                             attn_mask=bias, dropout_p=dropout_p)
+        out = out.transpose(1, 2).flatten(2)
+        return self.out_proj(out), None
+
+
 class TransformerEncoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attention_backend="mha"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _get_attention(attention_backend, d_model, nhead, dropout, fused_qk=True)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -187,10 +297,10 @@ class TransformerEncoderLayer(nn.Module):
 class TransformerDecoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attention_backend="mha"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
-        self.multihead_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _get_attention(attention_backend, d_model, nhead, dropout, fused_qk=True)
+        self.multihead_attn = _get_attention(attention_backend, d_model, nhead, dropout, fused_qk=False)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -274,6 +384,10 @@ def _get_clones(module, N):
 
 
 def build_transformer(args):
+    if args.transformer == "deformable":
+        # imported here, as the deformable transformer reuses the helpers of this file
+        from .deformable_transformer import build_deformable_transformer
+        return build_deformable_transformer(args)
     return Transformer(
         d_model=args.hidden_dim,
         dropout=args.dropout,
@@ -283,9 +397,25 @@ def build_transformer(args):
         num_decoder_layers=args.dec_layers,
         normalize_before=args.pre_norm,
         return_intermediate_dec=True,
+        attention_backend=args.attention_backend,
     )
 
 
+def _get_attention(backend, d_model, nhead, dropout, fused_qk):
+    """Return an attention module given a backend name"""
+    if backend == "mha":
+        return nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+    if backend == "sdpa":
+        return ScaledDotProductAttention(d_model, nhead, dropout=dropout, fused_qk=fused_qk)
+    raise RuntimeError(F"attention backend should be mha/sdpa, not {backend}.")
+
+
+def _padding_mask_to_attn_bias(mask, dtype: torch.dtype):
+    """Convert a [batch, seq] boolean padding mask (True on padding) to a [batch, 1, 1, seq] additive bias"""
+    bias = torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill(mask, float("-inf"))
+    return bias[:, None, None, :]
+
+
 def _get_activation_fn(activation):
     """Return an activation function given a string"""
     if activation == "relu":
@@ -0,0 +1,90 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+A script to rank the object queries of a trained DETR by how often they fire on a dataset,
+and to write a checkpoint that only keeps the most frequent ones.
+
+The output checkpoint is built for --keep_queries queries (pass the same value as --num_queries when
+loading it), and stores the ranking of its queries, so that it can in turn be loaded with an even smaller
+--num_queries. As the queries interact in the decoder self-attention, the pruned model should be fine-tuned
+(the optimizer state is not kept).
+"""
+import argparse
+
+import torch
+from torch.utils.data import DataLoader
+
+import util.misc as utils
+from datasets import build_dataset
+from main import get_args_parser
+from models import build_model
+from models.detr import prune_queries
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("DETR query pruning", parents=[get_args_parser()])
+    parser.add_argument("--keep_queries", required=True, type=int, help="Number of queries to keep")
+    parser.add_argument("--score_threshold", default=0.7, type=float,
+                        help="A query fires on an image when its highest object class probability is above this")
+    parser.add_argument("--image_set", default="val", choices=("train", "val"),
+                        help="Dataset split the query firings are counted on")
+    parser.add_argument("--pruned_checkpoint", required=True, type=str, help="Path of the output checkpoint")
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def count_query_firings(model, data_loader, device, score_threshold):
+    """Returns, for each query, the number of images it fired on and the sum of its scores"""
+    model.eval()
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    header = 'Counting query firings:'
+    counts, score_sums = 0, 0
+    max_targets = 0
+    for samples, targets in metric_logger.log_every(data_loader, 10, header):
+        outputs = model(samples.to(device))
+        scores = outputs['pred_logits'].softmax(-1)[..., :-1].max(-1)[0]
+        counts = counts + (scores > score_threshold).sum(0).cpu()
+        score_sums = score_sums + scores.sum(0).cpu()
+        max_targets = max([max_targets] + [len(t["labels"]) for t in targets])
+    return counts, score_sums, max_targets
+
+
+def main(args):
+    checkpoint = torch.load(args.resume, map_location='cpu')
+    state_dict = checkpoint['model']
+    query_key = 'detr.query_embed.weight' if args.masks else 'query_embed.weight'
+    args.num_queries = state_dict[query_key].shape[0]
+    assert 0 < args.keep_queries <= args.num_queries, "--keep_queries must be in [1, {}]".format(args.num_queries)
+    device = torch.device(args.device)
+
+    model, _, _ = build_model(args)
+    model.load_state_dict(state_dict)
+    model.to(device)
+
+    dataset = build_dataset(image_set=args.image_set, args=args)
+    data_loader = DataLoader(dataset, args.batch_size, sampler=torch.utils.data.SequentialSampler(dataset),
+                             drop_last=False, collate_fn=utils.collate_fn, num_workers=args.num_workers)
+    counts, score_sums, max_targets = count_query_firings(model, data_loader, device, args.score_threshold)
+
+    # most frequently firing first, ties broken by the average score
+    ranking = sorted(range(args.num_queries), key=lambda q: (counts[q].item(), score_sums[q].item()), reverse=True)
+    print("query firings (query: count):")
+    print(", ".join("{}: {}".format(q, counts[q].item()) for q in ranking))
+    if args.keep_queries < max_targets:
+        print("Warning: keeping {} queries, but some images have {} objects, which cannot all be matched".format(
+            args.keep_queries, max_targets))
+
+    kept_queries = sorted(ranking[:args.keep_queries])
+    position = {q: i for i, q in enumerate(kept_queries)}
+    args.num_queries = args.keep_queries
+    utils.save_on_master({
+        'model': prune_queries(state_dict, kept_queries),
+        'args': args,
+        # ranking of the kept queries, in the numbering of the pruned model
+        'query_ranking': [position[q] for q in ranking[:args.keep_queries]],
+        'query_counts': counts[kept_queries],
+    }, args.pruned_checkpoint)
+    print("Kept queries {}, saved to {}".format(kept_queries, args.pruned_checkpoint))
+
+
+if __name__ == '__main__':
+    main(parse_args())
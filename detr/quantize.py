@@ -0,0 +1,86 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+A script to quantize a trained DETR to int8 for CPU inference, and to report the resulting
+AP, latency and model size against the float32 model.
+
+See models/quantization.py for what is quantized.
+"""
+import argparse
+import copy
+import io
+import itertools
+
+import torch
+from torch.utils.data import DataLoader
+
+import util.misc as utils
+from datasets import build_dataset, get_coco_api_from_dataset
+from datasets.coco_eval import CocoGroundTruth
+from engine import evaluate, measure_latency
+from main import get_args_parser
+from models import build_model
+from models.quantization import quantize_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("DETR int8 quantization", parents=[get_args_parser()])
+    parser.add_argument("--no_quantize_backbone", dest="quantize_backbone", action="store_false",
+                        help="Only quantize the Linear layers, and keep the backbone in float32")
+    parser.add_argument("--calibration_batches", default=10, type=int,
+                        help="Number of training batches used to calibrate the backbone activations")
+    parser.add_argument("--quantized_backend", default="fbgemm", choices=("fbgemm", "qnnpack"),
+                        help="Quantized engine: fbgemm for x86, qnnpack for ARM")
+    parser.add_argument("--latency_batches", default=20, type=int,
+                        help="Number of val batches used to measure the model latency")
+    parser.add_argument("--quantized_model", default="", type=str,
+                        help="Path where the quantized model is saved (with torch.save), empty for no saving")
+    return parser.parse_args()
+
+
+def model_size(model):
+    """Size of the serialized state dict, in bytes"""
+    with io.BytesIO() as f:
+        torch.save(model.state_dict(), f)
+        return f.tell()
+
+
+def main(args):
+    assert args.resume, "The checkpoint to quantize must be given with --resume"
+    assert args.device == 'cpu', "Quantized models only run on CPU, pass --device cpu"
+    device = torch.device(args.device)
+
+    model, criterion, postprocessors = build_model(args)
+    checkpoint = torch.load(args.resume, map_location='cpu')
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+
+    dataset_train = build_dataset(image_set='train', args=args)
+    dataset_val = build_dataset(image_set='val', args=args)
+    data_loader_train = DataLoader(dataset_train, args.batch_size, shuffle=True,
+                                   collate_fn=utils.collate_fn, num_workers=args.num_workers)
+    data_loader_val = DataLoader(dataset_val, args.batch_size, sampler=torch.utils.data.SequentialSampler(dataset_val),
+                                 drop_last=False, collate_fn=utils.collate_fn, num_workers=args.num_workers)
+    # indexed once, and shared by all the evaluations
+    base_ds = CocoGroundTruth(get_coco_api_from_dataset(dataset_val))
+
+    calibration_data = None
+    if args.quantize_backbone:
+        calibration_data = (samples for samples, _ in itertools.islice(data_loader_train, args.calibration_batches))
+    quantized_model = quantize_model(copy.deepcopy(model), calibration_data, args.quantized_backend)
+
+    report = []
+    for name, m in (("float32", model), ("int8", quantized_model)):
+        test_stats, _ = evaluate(m, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir)
+        latency = measure_latency(m, data_loader_val, device, args.latency_batches)
+        report.append((name, 100 * test_stats['coco_eval_bbox'][0], latency, model_size(m)))
+
+    print("{:>8} {:>8} {:>15} {:>10}".format("model", "AP", "latency (ms)", "size (MB)"))
+    for name, ap, latency, size in report:
+        print("{:>8} {:>8.2f} {:>15.1f} {:>10.1f}".format(name, ap, 1000 * latency, size / 2 ** 20))
+
+    if args.quantized_model:
+        torch.save(quantized_model, args.quantized_model)
+
+
+if __name__ == '__main__':
+    main(parse_args())
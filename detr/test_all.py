@@ -1,17 +1,28 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+import copy
 import io
+import threading
 import unittest
+from unittest import mock
 
 import torch
 from torch import nn, Tensor
 from typing import List
 
-from models.matcher import HungarianMatcher
+from models.matcher import AuctionMatcher, HungarianMatcher
 from models.position_encoding import PositionEmbeddingSine, PositionEmbeddingLearned
-from models.backbone import Backbone, Joiner, BackboneBase
+from models.backbone import Backbone, Joiner, BackboneBase, FrozenBatchNorm2d, fold_frozen_batchnorm
+from models.transformer import Transformer
+from models.deformable_transformer import DeformableTransformer
 from util import box_ops
-from util.misc import nested_tensor_from_tensor_list
+from util.misc import nested_tensor_from_tensor_list, BucketedCollate
+from datasets.feature_cache import cached_backbone, weights_fingerprint
 from hubconf import detr_resnet50, detr_resnet50_panoptic
+from models.segmentation import PostProcessPanoptic, PostProcessSegm, sigmoid_focal_loss, _encode_rles
+from models.detr import PostProcess, SetCriterion, prune_queries
+from models.export import export_onnx
+from engine import _prepare_samples, _to_float
+from datasets.coco_eval import CocoEvaluator, CocoGroundTruth
 
 # onnxruntime requires python 3.5 or above
 try:
@@ -31,6 +42,18 @@ class Tester(unittest.TestCase):
     def indices_torch2python(indices):
         return [(i.tolist(), j.tolist()) for i, j in indices]
 
+    def test_paired_generalized_box_iou(self):
+        boxes1 = box_ops.box_cxcywh_to_xyxy(torch.rand(20, 4, dtype=torch.float64) * 0.5 + 0.1).requires_grad_()
+        boxes2 = box_ops.box_cxcywh_to_xyxy(torch.rand(20, 4, dtype=torch.float64) * 0.5 + 0.1).requires_grad_()
+        paired = box_ops.paired_generalized_box_iou(boxes1, boxes2)
+        pairwise = torch.diag(box_ops.generalized_box_iou(boxes1, boxes2))
+        self.assertTrue(torch.allclose(paired, pairwise))
+        grads = torch.autograd.grad(paired.sum(), (boxes1, boxes2))
+        grads_pairwise = torch.autograd.grad(pairwise.sum(), (boxes1, boxes2))
+        for grad, grad_pairwise in zip(grads, grads_pairwise):
+            self.assertTrue(torch.allclose(grad, grad_pairwise))
+        self.assertTrue(torch.autograd.gradcheck(box_ops.paired_generalized_box_iou, (boxes1, boxes2)))
+
     def test_hungarian(self):
         n_queries, n_targets, n_classes = 100, 15, 91
         logits = torch.rand(1, n_queries, n_classes + 1)
@@ -60,14 +83,202 @@ class Tester(unittest.TestCase):
                            'pred_boxes': boxes.repeat(2, 1, 1)}, targets_empty * 2)
         self.assertEqual(len(indices[0][0]), 0)
 
+    def test_hungarian_threads(self):
+        bs, n_queries, n_classes = 4, 100, 91
+        outputs = {'pred_logits': torch.rand(bs, n_queries, n_classes + 1), 'pred_boxes': torch.rand(bs, n_queries, 4)}
+        targets = [{'labels': torch.randint(high=n_classes, size=(n,)), 'boxes': torch.rand(n, 4)}
+                   for n in (15, 0, 3, 40)]
+        indices_serial = HungarianMatcher()(outputs, targets)
+        indices_threads = HungarianMatcher(num_threads=4)(outputs, targets)
+        self.assertEqual(self.indices_torch2python(indices_serial), self.indices_torch2python(indices_threads))
+
+    def test_hungarian_cost_matrix_blocks(self):
+        bs, n_queries, n_classes = 3, 100, 91
+        outputs = {'pred_logits': torch.rand(bs, n_queries, n_classes + 1), 'pred_boxes': torch.rand(bs, n_queries, 4)}
+        sizes = [5, 0, 12]
+        targets = [{'labels': torch.randint(high=n_classes, size=(n,)), 'boxes': torch.rand(n, 4)} for n in sizes]
+        matcher = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2)
+        C = matcher.cost_matrix(outputs, targets)
+        self.assertEqual(C.shape, (bs, n_queries, max(sizes)))
+        for i, target in enumerate(targets):
+            single = matcher.cost_matrix({k: v[i:i + 1] for k, v in outputs.items()}, [target])
+            self.assertTrue(torch.allclose(C[i, :, :sizes[i]], single[0], atol=1e-6))
+
+    def test_auction_matcher(self):
+        bs, n_queries, n_classes = 3, 50, 91
+        outputs = {'pred_logits': torch.rand(bs, n_queries, n_classes + 1), 'pred_boxes': torch.rand(bs, n_queries, 4)}
+        sizes = [10, 0, 60]  # the last image has more targets than queries
+        targets = [{'labels': torch.randint(high=n_classes, size=(n,)), 'boxes': torch.rand(n, 4)} for n in sizes]
+        exact_matcher = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2)
+        auction_matcher = AuctionMatcher(cost_class=1, cost_bbox=5, cost_giou=2, epsilon=1e-4)
+        C = exact_matcher.cost_matrix(outputs, targets)
+        exact_indices = exact_matcher(outputs, targets)
+        auction_indices = auction_matcher(outputs, targets)
+        for i, ((i_e, j_e), (i_a, j_a)) in enumerate(zip(exact_indices, auction_indices)):
+            self.assertEqual(len(i_a), min(n_queries, sizes[i]))
+            self.assertEqual(len(set(i_a.tolist())), len(i_a))
+            self.assertLessEqual(C[i, i_a, j_a].sum().item(), C[i, i_e, j_e].sum().item() + sizes[i] * 1e-4 + 1e-4)
+
+    def test_criterion_aux_match_interval(self):
+        class CountingMatcher(HungarianMatcher):
+            calls = 0
+
+            def forward(self, outputs, targets):
+                self.calls += 1
+                return super().forward(outputs, targets)
+
+        def random_outputs():
+            return {'pred_logits': torch.rand(2, 10, 6), 'pred_boxes': torch.rand(2, 10, 4)}
+        outputs = random_outputs()
+        outputs['aux_outputs'] = [random_outputs() for _ in range(5)]
+        targets = [{'labels': torch.randint(high=5, size=(3,)), 'boxes': torch.rand(3, 4)} for _ in range(2)]
+        for interval, expected_calls in ((1, 6), (2, 3), (0, 1)):
+            matcher = CountingMatcher()
+            criterion = SetCriterion(5, matcher, weight_dict={}, eos_coef=0.1, losses=['labels', 'boxes'],
+                                     aux_match_interval=interval)
+            losses = criterion(outputs, targets)
+            self.assertEqual(matcher.calls, expected_calls)
+            self.assertIn('loss_giou_0', losses)
+
+    def test_criterion_fused_layers(self):
+        def random_outputs():
+            return {'pred_logits': torch.rand(2, 10, 6), 'pred_boxes': torch.rand(2, 10, 4) * 0.5 + 0.25}
+        outputs = random_outputs()
+        outputs['aux_outputs'] = [random_outputs() for _ in range(5)]
+        targets = [{'labels': torch.randint(high=5, size=(n,)), 'boxes': torch.rand(n, 4) * 0.5 + 0.25}
+                   for n in (3, 0)]
+        losses = ['labels', 'boxes', 'cardinality']
+        criterion = SetCriterion(5, HungarianMatcher(), weight_dict={}, eos_coef=0.1, losses=losses)
+        fused_criterion = SetCriterion(5, HungarianMatcher(), weight_dict={}, eos_coef=0.1, losses=losses,
+                                       fused_layers=True)
+        expected = criterion(outputs, targets)
+        fused = fused_criterion(outputs, targets)
+        self.assertEqual(set(expected.keys()), set(fused.keys()))
+        for k, v in expected.items():
+            self.assertTrue(torch.allclose(v, fused[k], atol=1e-6), k)
+
+    def test_criterion_mask_points(self):
+        outputs = {'pred_logits': torch.rand(3, 10, 6), 'pred_boxes': torch.rand(3, 10, 4) * 0.5 + 0.25,
+                   'pred_masks': torch.randn(3, 10, 25, 30)}
+        targets = [{'labels': torch.randint(high=5, size=(n,)), 'boxes': torch.rand(n, 4) * 0.5 + 0.25,
+                    'masks': torch.rand(n, h, w) > 0.5} for n, h, w in ((3, 100, 120), (0, 90, 110), (2, 80, 120))]
+        criterion = SetCriterion(5, HungarianMatcher(), weight_dict={}, eos_coef=0.1, losses=['masks'],
+                                 mask_points=112 * 112)
+        losses = criterion(outputs, targets)
+        self.assertEqual(set(losses.keys()), {'loss_mask', 'loss_dice'})
+        self.assertTrue(all(torch.isfinite(v) for v in losses.values()))
+
+    def test_criterion_mask_points_labels(self):
+        class FixedMatcher(nn.Module):
+            def forward(self, outputs, targets):
+                return [(torch.tensor([0]), torch.tensor([0])), (torch.tensor([1]), torch.tensor([0]))]
+
+        # image 0 is 40 x 60 with its left half in the mask, image 1 is 80 x 30 and fully in the mask,
+        # so that the batch is padded to 80 x 60
+        mask0 = torch.zeros(1, 40, 60, dtype=torch.bool)
+        mask0[:, :, :30] = True
+        targets = [{'labels': torch.tensor([1]), 'boxes': torch.rand(1, 4), 'masks': mask0},
+                   {'labels': torch.tensor([2]), 'boxes': torch.rand(1, 4), 'masks': torch.ones(1, 80, 30) > 0}]
+        outputs = {'pred_logits': torch.rand(2, 3, 6), 'pred_boxes': torch.rand(2, 3, 4),
+                   'pred_masks': torch.randn(2, 3, 20, 15)}
+        # centers of the pixels (x, y) = (10, 20), (45, 20) and (10, 60) of the padded batch
+        coords = torch.tensor([[10.5, 20.5], [45.5, 20.5], [10.5, 60.5]]) / torch.tensor([60., 80.])
+        criterion = SetCriterion(5, FixedMatcher(), weight_dict={}, eos_coef=0.1, losses=['masks'], mask_points=3)
+        with mock.patch('models.detr.get_uncertain_point_coords', return_value=coords.repeat(2, 1, 1)), \
+                mock.patch('models.detr.sigmoid_focal_loss', wraps=sigmoid_focal_loss) as focal_loss:
+            criterion(outputs, targets)
+        point_labels = focal_loss.call_args[0][1]
+        # in image 0, the second point is in the right half and the third one in the padding,
+        # in image 1, the second point is in the padding
+        self.assertEqual(point_labels.tolist(), [[1., 0., 0.], [1., 0., 1.]])
+
+    def test_postprocess_top_k(self):
+        outputs = {'pred_logits': torch.randn(2, 10, 6), 'pred_boxes': torch.rand(2, 10, 4)}
+        target_sizes = torch.tensor([[480, 640], [600, 800]])
+        results = PostProcess()(outputs, target_sizes)
+        filtered = PostProcess(top_k=5, score_threshold=0.05)(outputs, target_sizes)
+        prob = outputs['pred_logits'].softmax(-1)[..., :-1]
+        for i, (result, res) in enumerate(zip(results, filtered)):
+            self.assertLessEqual(len(res['scores']), 5)
+            self.assertTrue((res['scores'] >= 0.05).all())
+            self.assertTrue(torch.equal(res['scores'], prob[i][res['query_ids'], res['labels']]))
+            self.assertTrue(torch.equal(res['boxes'], result['boxes'][res['query_ids']]))
+            expected = prob[i].flatten().topk(5)[0]
+            self.assertTrue(torch.equal(res['scores'], expected[expected >= 0.05]))
+
     def test_position_encoding_script(self):
         m1, m2 = PositionEmbeddingSine(), PositionEmbeddingLearned()
         mm1, mm2 = torch.jit.script(m1), torch.jit.script(m2)  # noqa
 
+    def test_position_encoding_cache(self):
+        m1, m2 = PositionEmbeddingSine(normalize=True), PositionEmbeddingSine(normalize=True, cache_size=2)
+        x = nested_tensor_from_tensor_list([torch.rand(3, 20, 20), torch.rand(3, 15, 25)])
+        self.assertTrue(m1(x).equal(m2(x)))
+        self.assertEqual(len(m2._cache), 2)
+        # cache hit
+        self.assertTrue(m1(x).equal(m2(x)))
+        # irregular masks are not cached
+        x.mask[0, 0, 0] = True
+        self.assertTrue(m1(x).equal(m2(x)))
+        self.assertEqual(len(m2._cache), 2)
+        x = nested_tensor_from_tensor_list([torch.rand(3, 10, 10)])
+        self.assertTrue(m1(x).equal(m2(x)))
+        self.assertEqual(len(m2._cache), 2)
+        # a module with a filled cache can still be scripted
+        self.assertTrue(torch.jit.script(m2)(x).equal(m1(x)))
+
     def test_backbone_script(self):
         backbone = Backbone('resnet50', True, False, False)
         torch.jit.script(backbone)  # noqa
 
+    def test_transformer_sdpa_backend(self):
+        mha = Transformer(d_model=64, nhead=4, dim_feedforward=128, return_intermediate_dec=True).eval()
+        sdpa = Transformer(d_model=64, nhead=4, dim_feedforward=128, return_intermediate_dec=True,
+                           attention_backend="sdpa").eval()
+        # both backends share the same parameter layout
+        sdpa.load_state_dict(mha.state_dict())
+        src, pos = torch.rand(2, 64, 6, 7), torch.rand(2, 64, 6, 7)
+        mask = torch.zeros(2, 6, 7, dtype=torch.bool)
+        mask[1, 4:, 5:] = True
+        query_embed = torch.rand(10, 64)
+        hs, memory = mha(src, mask, query_embed, pos)
+        hs_sdpa, memory_sdpa = sdpa(src, mask, query_embed, pos)
+        self.assertEqual(hs.shape, hs_sdpa.shape)
+        self.assertTrue(torch.allclose(hs, hs_sdpa, atol=1e-5))
+        self.assertTrue(torch.allclose(memory, memory_sdpa, atol=1e-5))
+        torch.jit.script(sdpa)  # noqa
+
+    def test_deformable_transformer(self):
+        transformer = DeformableTransformer(d_model=64, nhead=4, dim_feedforward=128, return_intermediate_dec=True,
+                                            num_encoder_layers=2, num_decoder_layers=3)
+        src, pos = torch.rand(2, 64, 6, 7), torch.rand(2, 64, 6, 7)
+        mask = torch.zeros(2, 6, 7, dtype=torch.bool)
+        mask[1, 4:, :] = True
+        mask[1, :, 5:] = True
+        hs, memory = transformer(src, mask, torch.rand(10, 64), pos)
+        self.assertEqual(hs.shape, (3, 2, 10, 64))
+        self.assertEqual(memory.shape, src.shape)
+        hs.sum().backward()
+        self.assertIsNotNone(transformer.encoder.layers[0].self_attn.sampling_offsets.weight.grad)
+
+    def test_fold_frozen_batchnorm(self):
+        model = detr_resnet50(pretrained=False).eval()
+        for m in model.modules():
+            if isinstance(m, FrozenBatchNorm2d):
+                m.weight.uniform_(0.5, 1.5)
+                m.bias.uniform_(-0.1, 0.1)
+                m.running_mean.uniform_(-0.1, 0.1)
+                m.running_var.uniform_(0.5, 1.5)
+        x = nested_tensor_from_tensor_list([torch.rand(3, 200, 200), torch.rand(3, 200, 250)])
+        out = model(x)
+        # the check of the folded backbone body is relative to its large raw features
+        fold_frozen_batchnorm(copy.deepcopy(model.backbone[0].body), x.tensors)
+        fold_frozen_batchnorm(model, x)
+        self.assertFalse(any(isinstance(m, FrozenBatchNorm2d) for m in model.modules()))
+        out_folded = model(x)
+        self.assertTrue(torch.allclose(out["pred_boxes"], out_folded["pred_boxes"], atol=1e-4))
+        torch.jit.script(model)  # noqa
+
     def test_model_script_detection(self):
         model = detr_resnet50(pretrained=False).eval()
         scripted_model = torch.jit.script(model)
@@ -87,6 +298,106 @@ class Tester(unittest.TestCase):
         self.assertTrue(out["pred_boxes"].equal(out_script["pred_boxes"]))
         self.assertTrue(out["pred_masks"].equal(out_script["pred_masks"]))
 
+    def test_model_panoptic_kept_queries(self):
+        model = detr_resnet50_panoptic(pretrained=False).eval()
+        x = nested_tensor_from_tensor_list([torch.rand(3, 200, 200), torch.rand(3, 200, 250)])
+        out = model(x)
+        scores = out["pred_logits"].softmax(-1)[..., :-1].max(-1)[0]
+        model.mask_score_threshold = scores.median().item()
+        out_kept = model(x)
+        kept = scores > model.mask_score_threshold
+        self.assertTrue(kept.any() and not kept.all())
+        self.assertTrue(torch.allclose(out["pred_masks"][kept], out_kept["pred_masks"][kept], atol=1e-4))
+        self.assertTrue((out_kept["pred_masks"][~kept] < -1e3).all())
+
+    def test_postprocess_panoptic(self):
+        num_classes = 250
+        logits = torch.full((1, 4, num_classes + 1), -10.)
+        for query, label in enumerate((100, 100, 1, num_classes)):
+            logits[0, query, label] = 10.
+        masks = torch.full((1, 4, 8, 8), -10.)
+        masks[0, 0, :, :4] = 10.
+        masks[0, 1, :, 4:] = 10.
+        masks[0, 2, 3, 3] = 20.  # a thing covering 4 pixels once resized, which is removed
+        postprocess = PostProcessPanoptic({i: i <= 90 for i in range(num_classes + 1)}, num_threads=2)
+        outputs = {"pred_logits": logits.repeat(2, 1, 1), "pred_masks": masks.repeat(2, 1, 1, 1)}
+        preds = postprocess(outputs, [(8, 8)] * 2, [(16, 16)] * 2)
+        # the encoding threads are reused across batches
+        postprocess(outputs, [(8, 8)] * 2, [(16, 16)] * 2)
+        encoding_threads = [t for t in threading.enumerate() if t.name.startswith("panoptic_png")]
+        self.assertIn(len(encoding_threads), (1, 2))
+        for pred in preds:
+            # the two masks of stuff class 100 are merged, and take over the removed thing
+            self.assertEqual(pred["segments_info"], [{"id": 0, "isthing": False, "category_id": 100, "area": 256}])
+            self.assertTrue(pred["png_string"].startswith(b"\x89PNG"))
+
+    def test_postprocess_panoptic_resize_as_pil(self):
+        import numpy as np
+        from PIL import Image
+        torch.manual_seed(0)
+        masks = torch.randn(6, 80, 120)
+        classes = torch.arange(6)
+        postprocess = PostProcessPanoptic({i: True for i in range(7)})
+        # a 2.5 scale ratio, where F.interpolate(mode="nearest-exact") differs from PIL
+        m_id, segments_info = postprocess._segments(masks, classes, (200, 300))
+        self.assertEqual(len(segments_info), 6)
+        ids = masks.argmax(0).byte().numpy()
+        expected = np.asarray(Image.fromarray(ids).resize((300, 200), Image.NEAREST))
+        self.assertTrue(m_id.equal(torch.from_numpy(expected).long()))
+
+    def test_postprocess_segm_paste_in_boxes(self):
+        masks = torch.full((2, 3, 1, 50, 60), -10.)
+        masks[:, 0, :, 10:30, 5:25] = 10.
+        masks[:, 1, :, 20:45, 30:55] = 10.
+        outputs = {'pred_logits': torch.randn(2, 3, 6), 'pred_masks': masks}
+        orig_target_sizes = torch.tensor([[300, 400], [250, 320]])
+        max_target_sizes = torch.tensor([[200, 240], [180, 230]])
+        boxes = torch.tensor([[[15., 60., 170., 190.], [190., 120., 400., 300.], [0., 0., 10., 10.]]] * 2)
+
+        def get_results():
+            return [{'scores': torch.ones(3), 'labels': torch.ones(3, dtype=torch.int64), 'boxes': b} for b in boxes]
+        expected = PostProcessSegm()(get_results(), outputs, orig_target_sizes, max_target_sizes)
+        results = PostProcessSegm(paste_in_boxes=True)(get_results(), outputs, orig_target_sizes, max_target_sizes)
+        for res, exp, size in zip(results, expected, orig_target_sizes):
+            self.assertEqual(res['masks'].shape, (3, 1) + tuple(size.tolist()))
+            self.assertEqual(res['masks'].dtype, torch.uint8)
+            for mask, exp_mask, box in zip(res['masks'][:, 0], exp['masks'][:, 0], res['boxes'].long().tolist()):
+                outside = torch.ones_like(mask, dtype=torch.bool)
+                outside[box[1]:box[3] + 1, box[0]:box[2] + 1] = False
+                self.assertFalse(mask[outside].any())
+                inside = ~outside
+                agreement = (mask[inside] == exp_mask[inside]).float().mean()
+                self.assertGreater(agreement.item(), 0.95)
+        # the run-length encodings decode to the same masks
+        from pycocotools import mask as mask_util
+        for paste_in_boxes, pasted in ((True, results), (False, expected)):
+            encoded = PostProcessSegm(paste_in_boxes=paste_in_boxes, rle=True)(
+                get_results(), outputs, orig_target_sizes, max_target_sizes)
+            for res, exp in zip(encoded, pasted):
+                self.assertNotIn('masks', res)
+                decoded = torch.from_numpy(mask_util.decode(res['rles'])).permute(2, 0, 1)
+                self.assertTrue(decoded.equal(exp['masks'][:, 0]))
+
+    def test_encode_rles_from_crops(self):
+        from pycocotools import mask as mask_util
+        torch.manual_seed(0)
+        height, width = 37, 51
+        crops = [torch.zeros(5, 7, dtype=torch.uint8), torch.ones(height, width, dtype=torch.uint8)]
+        offsets = [(3, 4), (0, 0)]
+        for _ in range(30):
+            h, w = torch.randint(1, height + 1, ()).item(), torch.randint(1, width + 1, ()).item()
+            # crops touching the borders of the image, and random ones
+            y0 = torch.randint(0, height - h + 1, ()).item() if torch.rand(()) < 0.7 else height - h
+            x0 = torch.randint(0, width - w + 1, ()).item() if torch.rand(()) < 0.7 else 0
+            crops.append((torch.rand(h, w) < torch.rand(())).byte())
+            offsets.append((x0, y0))
+        for rle, crop, (x0, y0) in zip(_encode_rles(crops, offsets, (height, width)), crops, offsets):
+            mask = torch.zeros(height, width, dtype=torch.uint8)
+            mask[y0:y0 + crop.shape[0], x0:x0 + crop.shape[1]] = crop
+            expected = mask_util.encode(mask.numpy()[:, :, None].copy(order="F"))[0]
+            self.assertEqual(rle["counts"], expected["counts"].decode("utf-8"))
+            self.assertEqual(rle["size"], [height, width])
+
     def test_model_detection_different_inputs(self):
         model = detr_resnet50(pretrained=False).eval()
         # support NestedTensor
@@ -102,6 +413,191 @@ class Tester(unittest.TestCase):
         out = model([x])
         self.assertIn('pred_logits', out)
 
+    def test_model_bf16_autocast(self):
+        model = detr_resnet50(pretrained=False).eval()
+        model.aux_loss = True
+        x = nested_tensor_from_tensor_list([torch.rand(3, 200, 200), torch.rand(3, 200, 250)])
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            outputs = model(x)
+        self.assertEqual(outputs["pred_logits"].dtype, torch.bfloat16)
+        outputs = _to_float(outputs)
+        self.assertEqual(outputs["pred_logits"].dtype, torch.float32)
+        self.assertTrue(all(v.dtype == torch.float32 for aux in outputs["aux_outputs"] for v in aux.values()))
+        targets = [{'labels': torch.randint(high=91, size=(n,)), 'boxes': torch.rand(n, 4) * 0.5 + 0.25}
+                   for n in (3, 1)]
+        criterion = SetCriterion(91, HungarianMatcher(), weight_dict={}, eos_coef=0.1,
+                                 losses=['labels', 'boxes', 'cardinality'])
+        losses = criterion(outputs, targets)
+        self.assertTrue(all(v.dtype == torch.float32 and torch.isfinite(v) for v in losses.values()))
+        results = PostProcess()(outputs, torch.tensor([[480, 640], [600, 800]]))
+        self.assertTrue(all(res["boxes"].dtype == torch.float32 for res in results))
+
+    def test_model_channels_last(self):
+        model = detr_resnet50(pretrained=False).eval()
+        x = nested_tensor_from_tensor_list([torch.rand(3, 200, 200), torch.rand(3, 200, 250)])
+        out = model(x)
+        x = _prepare_samples(x, torch.device("cpu"), channels_last=True)
+        self.assertTrue(x.tensors.is_contiguous(memory_format=torch.channels_last))
+        out_channels_last = model(x)
+        self.assertTrue(torch.allclose(out["pred_logits"], out_channels_last["pred_logits"], atol=1e-4))
+        self.assertTrue(torch.allclose(out["pred_boxes"], out_channels_last["pred_boxes"], atol=1e-4))
+
+    def test_model_early_exit(self):
+        model = detr_resnet50(pretrained=False).eval()
+        model.aux_loss = True
+        x = nested_tensor_from_tensor_list([torch.rand(3, 200, 200), torch.rand(3, 200, 250)])
+        out = model(x)
+        model.exit_dec_layers = 2
+        out_exit = model(x)
+        self.assertNotIn("aux_outputs", out_exit)
+        self.assertTrue(torch.allclose(out["aux_outputs"][1]["pred_logits"], out_exit["pred_logits"], atol=1e-5))
+        self.assertTrue(torch.allclose(out["aux_outputs"][1]["pred_boxes"], out_exit["pred_boxes"], atol=1e-5))
+        model.exit_dec_layers = 6
+        out_exit = model(x)
+        self.assertTrue(torch.allclose(out["pred_logits"], out_exit["pred_logits"], atol=1e-5))
+        # a threshold no confidence change can reach runs all the layers
+        model.exit_dec_layers, model.exit_threshold = 0, 1e-12
+        out_exit = model(x)
+        self.assertTrue(torch.allclose(out["pred_logits"], out_exit["pred_logits"], atol=1e-5))
+
+    def test_prune_queries(self):
+        model = detr_resnet50(pretrained=False).eval()
+        kept_queries = [3, 17, 42]
+        state_dict = prune_queries(model.state_dict(), kept_queries)
+        self.assertTrue(state_dict["query_embed.weight"].equal(model.query_embed.weight[kept_queries]))
+        self.assertEqual(model.state_dict()["query_embed.weight"].shape[0], 100)
+        pruned = detr_resnet50(pretrained=False).eval()
+        pruned.query_embed = nn.Embedding(len(kept_queries), pruned.transformer.d_model)
+        pruned.num_queries = len(kept_queries)
+        pruned.load_state_dict(state_dict)
+        out = pruned(nested_tensor_from_tensor_list([torch.rand(3, 200, 200)]))
+        self.assertEqual(out["pred_logits"].shape[:2], (1, 3))
+
+    def test_model_cached_backbone(self):
+        model = detr_resnet50(pretrained=False).eval()
+        x = nested_tensor_from_tensor_list([torch.rand(3, 200, 250)])
+        out = model(x)
+        with torch.no_grad():
+            features = model.backbone[0].body(x.tensors)["0"]
+        with cached_backbone(model):
+            out_cached = model(nested_tensor_from_tensor_list([features[0]]))
+        self.assertTrue(torch.allclose(out["pred_logits"], out_cached["pred_logits"], atol=1e-6))
+        self.assertTrue(torch.allclose(out["pred_boxes"], out_cached["pred_boxes"], atol=1e-6))
+        self.assertIsInstance(model.backbone[0], Backbone)
+        # a cache built from other backbone weights is not reused
+        fingerprint = weights_fingerprint(model.backbone[0])
+        self.assertEqual(fingerprint, weights_fingerprint(model.backbone[0]))
+        with torch.no_grad():
+            model.backbone[0].body.layer4[-1].conv3.weight[0, 0, 0, 0] += 1
+        self.assertNotEqual(fingerprint, weights_fingerprint(model.backbone[0]))
+
+    def test_bucketed_collate(self):
+        collate = BucketedCollate([(800, 1333), (600, 600)])
+        batch = [(torch.rand(3, 500, 550), {}), (torch.rand(3, 580, 400), {})]
+        samples, _ = collate(batch)
+        self.assertEqual(samples.tensors.shape, (2, 3, 600, 600))
+        self.assertEqual(samples.mask.shape, (2, 600, 600))
+        self.assertFalse(samples.mask[0, :500, :550].any())
+        self.assertTrue(samples.mask[0, 500:].all() and samples.mask[1, :, 400:].all())
+        samples, _ = collate([(torch.rand(3, 900, 900), {})])
+        self.assertEqual(samples.tensors.shape, (1, 3, 900, 900))
+
+    @staticmethod
+    def random_coco_gt_and_predictions(num_images=20, num_classes=5, height=120, width=160):
+        from pycocotools.coco import COCO
+        images, annotations, predictions = [], [], {}
+        for img_id in range(1, num_images + 1):
+            images.append({"id": img_id, "width": width, "height": height})
+            n = int(torch.randint(0, 10, ()))
+            xy = torch.rand(n, 2) * 100
+            boxes = torch.cat([xy, xy + 3 + torch.rand(n, 2) * 60], dim=1).round()
+            labels = torch.randint(num_classes, (n,))
+            for box, label, crowd in zip(boxes.tolist(), labels.tolist(), (torch.rand(n) < 0.1).tolist()):
+                x0, y0, x1, y1 = box
+                annotations.append({"id": len(annotations) + 1, "image_id": img_id, "category_id": label,
+                                    "bbox": [x0, y0, x1 - x0, y1 - y0], "area": (x1 - x0) * (y1 - y0),
+                                    "segmentation": [[x0, y0, x1, y0, x1, y1, x0, y1]], "iscrowd": int(crowd)})
+            # detections around the annotations, and random ones with some ties in score
+            m = int(torch.randint(0, 30, ()))
+            xy = torch.rand(m, 2) * 100
+            pred_boxes = torch.cat([boxes + torch.randn(n, 4) * 4, torch.cat([xy, xy + 30], dim=1)])
+            masks = torch.zeros(n + m, 1, height, width)
+            for mask, (x0, y0, x1, y1) in zip(masks, pred_boxes.clamp(min=0).long().tolist()):
+                mask[:, y0:y1, x0:x1] = 1
+            predictions[img_id] = {"boxes": pred_boxes, "masks": masks, "scores": (torch.rand(n + m) * 10).round() / 10,
+                                   "labels": torch.cat([labels, torch.randint(num_classes, (m,))])}
+        coco_gt = COCO()
+        coco_gt.dataset = {"images": images, "annotations": annotations,
+                           "categories": [{"id": i} for i in range(num_classes)]}
+        coco_gt.createIndex()
+        return coco_gt, predictions
+
+    def test_coco_evaluator(self):
+        from pycocotools.coco import COCO
+        from pycocotools.cocoeval import COCOeval
+        torch.manual_seed(0)
+        coco_gt, predictions = self.random_coco_gt_and_predictions()
+        annotations = copy.deepcopy(coco_gt.anns)
+        ground_truth = CocoGroundTruth(coco_gt)
+        img_ids = sorted(predictions.keys())
+        # two epochs sharing the ground truth, which must be left untouched
+        for _ in range(2):
+            evaluator = CocoEvaluator(ground_truth, ["bbox", "segm"])
+            for i in range(0, len(img_ids), 4):
+                evaluator.update({img_id: predictions[img_id] for img_id in img_ids[i:i + 4]})
+            evaluator.synchronize_between_processes()
+            evaluator.accumulate()
+            evaluator.summarize()
+            self.assertEqual(coco_gt.anns, annotations)
+
+        for iou_type in ("bbox", "segm"):
+            results = evaluator.prepare(predictions, iou_type)
+            reference = COCOeval(coco_gt, COCO.loadRes(coco_gt, results), iou_type)
+            reference.evaluate()
+            reference.accumulate()
+            reference.summarize()
+            coco_eval = evaluator.coco_eval[iou_type]
+            self.assertTrue((coco_eval.eval["precision"] == reference.eval["precision"]).all())
+            self.assertTrue((coco_eval.eval["recall"] == reference.eval["recall"]).all())
+            self.assertEqual(coco_eval.stats.tolist(), reference.stats.tolist())
+
+    def test_coco_ground_truth_missing_iscrowd(self):
+        torch.manual_seed(0)
+        coco_gt, _ = self.random_coco_gt_and_predictions(num_images=5)
+        expected = CocoGroundTruth(coco_gt).images
+        # as in pycocotools, annotations without iscrowd are not crowds
+        for ann in coco_gt.dataset["annotations"]:
+            if not ann["iscrowd"]:
+                del ann["iscrowd"]
+        images = CocoGroundTruth(coco_gt).images
+        for img_id, gt in expected.items():
+            for k, v in gt.items():
+                self.assertTrue((images[img_id][k] == v).all(), k)
+
+    def test_coco_evaluator_rles(self):
+        from pycocotools import mask as mask_util
+        torch.manual_seed(0)
+        coco_gt, predictions = self.random_coco_gt_and_predictions(num_images=8)
+        ground_truth = CocoGroundTruth(coco_gt)
+        # the masks encoded by PostProcessSegm(rle=True) are evaluated as the uint8 ones
+        encoded = {}
+        for img_id, prediction in predictions.items():
+            rles = mask_util.encode(prediction["masks"][:, 0].permute(1, 2, 0).byte().numpy().copy(order="F"))
+            for rle in rles:
+                rle["counts"] = rle["counts"].decode("utf-8")
+            encoded[img_id] = {k: v for k, v in prediction.items() if k != "masks"}
+            encoded[img_id]["rles"] = rles
+        stats = []
+        for preds in (predictions, encoded):
+            evaluator = CocoEvaluator(ground_truth, ["segm"])
+            evaluator.update(preds)
+            evaluator.synchronize_between_processes()
+            evaluator.accumulate()
+            evaluator.summarize()
+            stats.append(evaluator.coco_eval["segm"].stats.tolist())
+        self.assertEqual(stats[0], stats[1])
+        self.assertGreater(stats[0][0], 0)
+
     def test_warpped_model_script_detection(self):
         class WrappedDETR(nn.Module):
             def __init__(self, model):
@@ -189,6 +685,20 @@ class ONNXExporterTester(unittest.TestCase):
             tolerate_small_mismatch=True,
         )
 
+    def test_model_onnx_export_postprocess(self):
+        model = detr_resnet50(pretrained=False).eval()
+        onnx_io = io.BytesIO()
+        wrapper = export_onnx(model, onnx_io, top_k=10)
+        ort_session = onnxruntime.InferenceSession(onnx_io.getvalue())
+        for images in (torch.rand(1, 3, 750, 800), torch.rand(2, 3, 600, 900)):
+            target_sizes = torch.tensor([[480, 640]] * len(images))
+            with torch.no_grad():
+                outputs = wrapper(images, target_sizes)
+            ort_outs = ort_session.run(None, {"images": images.numpy(), "target_sizes": target_sizes.numpy()})
+            self.assertEqual(outputs[2].shape, (len(images), 10, 4))
+            for element, ort_out in zip(outputs, ort_outs):
+                torch.testing.assert_allclose(element, ort_out, rtol=1e-03, atol=1e-03)
+
     @unittest.skip("CI doesn't have enough memory")
     def test_model_onnx_detection_panoptic(self):
         model = detr_resnet50_panoptic(pretrained=False).eval()
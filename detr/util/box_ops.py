@@ -3,7 +3,6 @@
 Utilities for bounding box manipulation and GIoU.
 """
 import torch
-from torchvision.ops.boxes import box_area
 
 
 def box_cxcywh_to_xyxy(x):
@@ -20,18 +19,22 @@ def box_xyxy_to_cxcywh(x):
     return torch.stack(b, dim=-1)
 
 
-# modified from torchvision to also return the union
+def box_area(boxes):
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+# modified from torchvision to also return the union, and to support leading batch dimensions
 def box_iou(boxes1, boxes2):
     area1 = box_area(boxes1)
     area2 = box_area(boxes2)
 
-    lt = torch.max(boxes1[:, None, :2], boxes2[:, :2])  # [N,M,2]
-    rb = torch.min(boxes1[:, None, 2:], boxes2[:, 2:])  # [N,M,2]
+    lt = torch.max(boxes1[..., :, None, :2], boxes2[..., None, :, :2])  # [...,N,M,2]
+    rb = torch.min(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])  # [...,N,M,2]
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    inter = wh[:, :, 0] * wh[:, :, 1]  # [N,M]
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [...,N,M]
 
-    union = area1[:, None] + area2 - inter
+    union = area1[..., :, None] + area2[..., None, :] - inter
 
     iou = inter / union
     return iou, union
@@ -44,19 +47,64 @@ def generalized_box_iou(boxes1, boxes2):
     The boxes should be in [x0, y0, x1, y1] format
 
     Returns a [N, M] pairwise matrix, where N = len(boxes1)
-    and M = len(boxes2)
+    and M = len(boxes2). Boxes of shape [B, N, 4] and [B, M, 4]
+    give the [B, N, M] pairwise matrices of each batch element.
     """
     # degenerate boxes gives inf / nan results
     # so do an early check
-    assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
-    assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
+    assert (boxes1[..., 2:] >= boxes1[..., :2]).all()
+    assert (boxes2[..., 2:] >= boxes2[..., :2]).all()
     iou, union = box_iou(boxes1, boxes2)
 
-    lt = torch.min(boxes1[:, None, :2], boxes2[:, :2])
-    rb = torch.max(boxes1[:, None, 2:], boxes2[:, 2:])
+    lt = torch.min(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+    rb = torch.max(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])
+
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    area = wh[..., 0] * wh[..., 1]
+
+    return iou - (area - union) / area
+
+
+def paired_box_iou(boxes1, boxes2):
+    """
+    Same as box_iou, but between the boxes of boxes1 and boxes2 with the same index only,
+    ie the diagonal of box_iou(boxes1, boxes2). Returns the [N] iou and union.
+    """
+    area1 = box_area(boxes1)
+    area2 = box_area(boxes2)
+
+    lt = torch.max(boxes1[..., :2], boxes2[..., :2])  # [...,N,2]
+    rb = torch.min(boxes1[..., 2:], boxes2[..., 2:])  # [...,N,2]
+
+    wh = (rb - lt).clamp(min=0)  # [...,N,2]
+    inter = wh[..., 0] * wh[..., 1]  # [...,N]
+
+    union = area1 + area2 - inter
+
+    iou = inter / union
+    return iou, union
+
+
+def paired_generalized_box_iou(boxes1, boxes2):
+    """
+    Generalized IoU between the boxes of boxes1 and boxes2 with the same index only,
+    ie the diagonal of generalized_box_iou(boxes1, boxes2), in O(N) instead of O(N^2).
+
+    The boxes should be in [x0, y0, x1, y1] format, boxes1 and boxes2 of the same shape [N, 4]
+
+    Returns a [N] tensor
+    """
+    # degenerate boxes gives inf / nan results
+    # so do an early check
+    assert (boxes1[..., 2:] >= boxes1[..., :2]).all()
+    assert (boxes2[..., 2:] >= boxes2[..., :2]).all()
+    iou, union = paired_box_iou(boxes1, boxes2)
+
+    lt = torch.min(boxes1[..., :2], boxes2[..., :2])
+    rb = torch.max(boxes1[..., 2:], boxes2[..., 2:])
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    area = wh[:, :, 0] * wh[:, :, 1]
+    wh = (rb - lt).clamp(min=0)  # [...,N,2]
+    area = wh[..., 0] * wh[..., 1]
 
     return iou - (area - union) / area
 
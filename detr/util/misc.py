@@ -304,6 +304,34 @@ class NestedTensor(object):
         return str(self.tensors)
 
 
+def pad_to_bucket(samples: NestedTensor, size_buckets):
+    """
+    Pads a batch to the smallest (H, W) size bucket it fits in, buckets being sorted by area.
+    Batches larger than every bucket are returned as is.
+    """
+    tensor, mask = samples.decompose()
+    h, w = tensor.shape[-2:]
+    for bucket_h, bucket_w in size_buckets:
+        if bucket_h >= h and bucket_w >= w:
+            padded_tensor = tensor.new_zeros(tensor.shape[:-2] + (bucket_h, bucket_w))
+            padded_tensor[..., :h, :w].copy_(tensor)
+            padded_mask = mask.new_ones((mask.shape[0], bucket_h, bucket_w))
+            padded_mask[:, :h, :w].copy_(mask)
+            return NestedTensor(padded_tensor, padded_mask)
+    return samples
+
+
+class BucketedCollate(object):
+    """Same as collate_fn, but pads the images to a fixed set of sizes, to keep input shapes static"""
+
+    def __init__(self, size_buckets):
+        self.size_buckets = sorted(size_buckets, key=lambda s: s[0] * s[1])
+
+    def __call__(self, batch):
+        samples, targets = collate_fn(batch)
+        return pad_to_bucket(samples, self.size_buckets), targets
+
+
 def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
     # TODO make this more general
     if tensor_list[0].ndim == 3: